@@ -0,0 +1,144 @@
+"""Run waypoint actions (photos, recordings) on the host while the machine
+waits at the waypoint, instead of dwelling for a fixed time.
+
+Handlers are plain callables taking the Command that carries the action.
+They run one at a time, in order, on a worker thread; the serial thread
+holds back the following moves until the handler returns, unless the action
+is allowed to overlap with motion. Photos taken on the move have a worker of
+their own, so a slow camera never holds up the waypoint actions.
+"""
+import time
+import shlex
+import logging
+import subprocess
+import concurrent.futures
+from commands import Action
+
+# profile keys under 'actions' for each action
+ACTION_KEYS = {
+    Action.TAKE_PHOTO: 'take-photo',
+    Action.START_RECORDING: 'start-recording',
+    Action.STOP_RECORDING: 'stop-recording',
+}
+
+# what an action costs when the profile doesn't say how to run it: the same
+# as the old fixed dwell
+STUB_SECONDS = 5
+# seconds a photo on the move may wait for the camera before it is skipped:
+# by then the machine has moved well past the place it was due
+CAPTURE_LATE = 0.5
+
+class StubHandler():
+    """ Stand-in for a capture device: takes a fixed time and succeeds """
+    def __init__(self, seconds=STUB_SECONDS):
+        self.seconds = seconds
+
+    def __call__(self, cmd):
+        time.sleep(self.seconds)
+        return True
+
+class SubprocessHandler():
+    """ Run a local program for the action and wait for it to exit.
+
+    The command line is a format string; {action}, {sequence} and the
+    machine position {x}, {y}, {z} are filled in. A non-zero exit status
+    counts as a failure.
+    """
+    def __init__(self, command, timeout=None):
+        self.command = command
+        self.timeout = timeout
+
+    def __call__(self, cmd):
+        pos = cmd.pos or {}
+        argv = shlex.split(self.command.format(action=cmd.action.name.lower(),
+            sequence=cmd.sequence, x=pos.get('x'), y=pos.get('y'),
+            z=pos.get('z')))
+        return subprocess.run(argv, timeout=self.timeout).returncode == 0
+
+class ActionExecutor():
+    """ Runs each action's handler and reports back when it is done.
+
+    `config` is a machine profile's 'actions' section:
+
+        take-photo: a command line for SubprocessHandler, or null
+        start-recording / stop-recording: likewise
+        timeout: seconds before a handler command is abandoned
+        stub-seconds: time taken by actions without a command
+        overlap-recording: let recording actions run while the next moves
+            are sent, rather than holding the machine until they return
+        overlap-photo: likewise for photos
+        photo-on-the-move: take photos spaced along a path as the machine
+            passes them, read by the scan compiler; these never hold it
+        capture-late: seconds a photo on the move may wait for the one
+            before it to finish before it is skipped
+    """
+    def __init__(self, config=None):
+        config = config or {}
+        stub = StubHandler(config.get('stub-seconds', STUB_SECONDS))
+        self.handlers = {}
+        for action, key in ACTION_KEYS.items():
+            command = config.get(key)
+            self.handlers[action] = SubprocessHandler(command,
+                    config.get('timeout')) if command else stub
+        self.overlapping = set()
+        if config.get('overlap-recording'):
+            self.overlapping = {Action.START_RECORDING, Action.STOP_RECORDING}
+        if config.get('overlap-photo'):
+            self.overlapping.add(Action.TAKE_PHOTO)
+        self.capture_late = config.get('capture-late', CAPTURE_LATE)
+        # a single worker, so actions finish in the order they were reached
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # and another for photos on the move, with the ones not done yet
+        self._capture_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1)
+        self._capturing = set()
+
+    def blocks(self, action):
+        """Whether moves have to wait for action to finish"""
+        return action not in self.overlapping
+
+    def submit(self, cmd, done=None):
+        """Start cmd's action. Returns a future that resolves to
+        (success, seconds taken); done(cmd, future) is called from the
+        worker thread when it resolves."""
+        future = self._pool.submit(self._run, cmd)
+        if done is not None:
+            future.add_done_callback(lambda f: done(cmd, f))
+        return future
+
+    def capture(self, cmd, where, done=None):
+        """Take a photo on the move, like submit(). where() gives the
+        machine position when the photo is actually taken, which is stored
+        in cmd.pos. One that can't start within capture-late seconds is
+        skipped: cmd.late is set and it resolves to (False, 0)."""
+        future = self._capture_pool.submit(self._capture, cmd, where,
+                time.perf_counter())
+        self._capturing.add(future)
+        future.add_done_callback(self._capturing.discard)
+        if done is not None:
+            future.add_done_callback(lambda f: done(cmd, f))
+        return future
+
+    def capturing(self):
+        """Whether photos on the move are waiting or being taken"""
+        return bool(self._capturing)
+
+    def _capture(self, cmd, where, due):
+        if time.perf_counter() - due > self.capture_late:
+            cmd.late = True
+            return False, 0.
+        cmd.pos = where()
+        return self._run(cmd)
+
+    def _run(self, cmd):
+        start = time.perf_counter()
+        try:
+            ok = bool(self.handlers[cmd.action](cmd))
+        except Exception:
+            logging.exception("Action {} failed".format(cmd.action))
+            ok = False
+        return ok, time.perf_counter() - start
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+        self._capture_pool.shutdown(wait=False)
@@ -0,0 +1,93 @@
+"""Shared helpers for the benchmark scripts: summary statistics, and writing
+and comparing the JSON result files.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__),'..'))
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'results')
+
+# make the app's modules importable when run as a script
+if ROOT not in sys.path:
+    sys.path.insert(0,ROOT)
+
+def summarize(samples,scale=1.):
+    """Summary statistics of samples, multiplied by scale (eg. 1000 for ms)"""
+    if not samples:
+        return {"n":0}
+    ordered = sorted(s*scale for s in samples)
+    def pct(p):
+        return ordered[min(len(ordered)-1,int(p/100.*len(ordered)))]
+    return {
+        "n":len(ordered),
+        "mean":statistics.fmean(ordered),
+        "stdev":statistics.pstdev(ordered),
+        "min":ordered[0],
+        "p50":pct(50),
+        "p95":pct(95),
+        "p99":pct(99),
+        "max":ordered[-1],
+    }
+
+def version():
+    try:
+        return subprocess.check_output(['git','describe','--always','--dirty'],
+                cwd=ROOT,stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        return "unknown"
+
+def save(suite,results,path=None):
+    """Write results with enough context to compare runs across versions"""
+    doc = {
+        "suite":suite,
+        "version":version(),
+        "timestamp":time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python":platform.python_version(),
+        "platform":platform.platform(),
+        "results":results,
+    }
+    if path is None:
+        os.makedirs(RESULTS_DIR,exist_ok=True)
+        path = os.path.join(RESULTS_DIR,'{}-{}.json'.format(
+            suite,time.strftime('%Y%m%d-%H%M%S')))
+    with open(path,'w') as f:
+        json.dump(doc,f,indent=1,sort_keys=True)
+    return path
+
+def _flatten(results):
+    """{case name: {metric path: value}} for every numeric result"""
+    flat = {}
+    for case in results:
+        values = {}
+        def walk(prefix,d):
+            for key,value in d.items():
+                if isinstance(value,dict):
+                    walk(prefix + key + '.',value)
+                elif isinstance(value,(int,float)) and key != 'n':
+                    values[prefix + key] = value
+        walk('',case['metrics'])
+        flat[case['name']] = values
+    return flat
+
+def compare(old_path,results,threshold=0.2):
+    """Print every metric that moved more than threshold (as a fraction)
+    against the results in old_path. Returns the number of changes.
+    """
+    with open(old_path) as f:
+        old = _flatten(json.load(f)['results'])
+    new = _flatten(results)
+    changes = 0
+    for name in sorted(set(old) & set(new)):
+        for key in sorted(set(old[name]) & set(new[name])):
+            a, b = old[name][key], new[name][key]
+            if a and abs(b - a)/abs(a) > threshold:
+                changes += 1
+                print('{:40s} {:30s} {:12.4g} -> {:12.4g} ({:+.0%})'.format(
+                    name,key,a,b,(b - a)/abs(a)))
+    return changes
@@ -0,0 +1,240 @@
+"""How the path editor scales with path size: QClickAndDraw and its QCDScene,
+with the main window's info panel listening to the selection. Runs without a
+display. From the repository root:
+
+    python benchmarks/scene_bench.py [--sizes 1000 10000] [--compare old.json]
+
+Each repeat loads a fresh view and times, for every path size:
+  load      loadWaypointsInfo of the whole path
+  dump      dumpWaypointsInfo
+  zoom_in   zoomIn, which rescales every waypoint marker
+  zoom_out  zoomOut
+  rotate    rotateL and the repaint it causes
+  repaint   a full repaint with the whole path in view
+  select    a Shift rubber band drag over a tenth of the path, as mouse
+            events to the view, including the showWaypointInfo it triggers
+  drag      a 20 step drag of a hundredth of the path, as mouse events
+            through the view to the scene's press, move and release
+            handlers, including the info refresh when it is let go
+
+Mouse events are delivered synchronously; the repaints they cause aren't
+part of the timing (see repaint).
+  remove    removeMultiple of a tenth of the path
+
+A case that takes longer than --budget seconds at one size isn't run at the
+larger ones, and is reported there as skipped.
+"""
+import os
+import gc
+import time
+import argparse
+
+os.environ.setdefault('QT_QPA_PLATFORM','offscreen')
+
+import benchutil
+from PyQt5 import QtCore, QtGui, QtWidgets
+import clickanddraw
+import gui
+from commands import Action
+
+CASES = ('load','dump','zoom_in','zoom_out','rotate','repaint','select',
+         'drag','remove')
+VIEW_SIZE = (1024,768)
+DRAG_STEPS = 20
+# viewport pixels the mouse moves on each drag step
+DRAG_PIXELS = 5
+
+def path(size,machine):
+    """size waypoints in a serpentine over the bed, one snap step apart,
+    running on past its far end for the larger sizes. Every 50th takes a
+    photo."""
+    step = machine['units-scale']
+    cols = max(1,int(machine['dimensions']['x-axis']//step))
+    info = [{"x":0,"y":0,"z":0,"v":machine['default-speed'],
+             "action":Action.NO_ACTION}]
+    for i in range(size):
+        row, col = divmod(i,cols)
+        if row % 2:
+            col = cols - 1 - col
+        info.append({"x":col*step,"y":row*step,"z":0,
+                     "v":machine['default-speed'],
+                     "action":Action.TAKE_PHOTO if i % 50 == 49
+                     else Action.NO_ACTION})
+    return info
+
+def band(rect,fraction,offset=0.):
+    """A scene polygon over fraction of the rows in rect, as a rubber band
+    dragged across the whole width would give"""
+    top = rect.top() + rect.height()*offset
+    return QtGui.QPolygonF(QtCore.QRectF(rect.left() - 1,top,
+            rect.width() + 2,rect.height()*fraction))
+
+def mouse(view,kind,pos,modifiers=QtCore.Qt.NoModifier):
+    """Send a left button mouse event at viewport position pos to view, as
+    the window system would"""
+    buttons = QtCore.Qt.NoButton if kind == QtCore.QEvent.MouseButtonRelease \
+            else QtCore.Qt.LeftButton
+    button = QtCore.Qt.NoButton if kind == QtCore.QEvent.MouseMove \
+            else QtCore.Qt.LeftButton
+    QtWidgets.QApplication.sendEvent(view.viewport(),QtGui.QMouseEvent(kind,
+        QtCore.QPointF(pos),button,buttons,modifiers))
+
+def gesture(view,start,end,steps):
+    """Press at start, move to end in steps, and let go there"""
+    mouse(view,QtCore.QEvent.MouseButtonPress,start)
+    for i in range(1,steps + 1):
+        mouse(view,QtCore.QEvent.MouseMove,start + (end - start)*i/steps)
+    mouse(view,QtCore.QEvent.MouseButtonRelease,end)
+
+def empty_spot(view):
+    """A viewport position with no waypoint under it, to start a group
+    drag from"""
+    scene = view.scene
+    for x in range(2,VIEW_SIZE[0],16):
+        for y in range(2,VIEW_SIZE[1],16):
+            pos = QtCore.QPoint(x,y)
+            if scene.pick(view.mapToScene(pos)) is None:
+                return pos
+    raise RuntimeError("the path covers the whole view")
+
+class Bench():
+    def __init__(self,window,budget,skip=()):
+        self.window = window
+        self.machine = window.machines[window.cncSelect.currentText()]
+        self.budget = budget
+        # cases over budget at a smaller size, and at this one
+        self.skip = set(skip)
+        self.slow = set()
+        self.samples = {}
+        self.selected = {}
+
+    def time(self,case,fn,*args):
+        """Time fn(*args) as a sample of case. Returns whether it ran"""
+        if case in self.skip:
+            return False
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        self.samples.setdefault(case,[]).append(elapsed)
+        if elapsed > self.budget:
+            self.slow.add(case)
+        return True
+
+    def view(self):
+        """A fresh view, wired to the window's info panel like its own"""
+        view = clickanddraw.QClickAndDraw(None)
+        view.resize(*VIEW_SIZE)
+        view.setMachine(self.machine)
+        view.show()
+        self.window.freeDrawView = view
+        view.scene.selectionChanged.connect(self.window.showWaypointInfo)
+        return view
+
+    def repaint(self,view):
+        view.viewport().repaint()
+
+    def run(self,info):
+        app = QtWidgets.QApplication.instance()
+        view = self.view()
+        scene = view.scene
+        if not self.time('load',view.loadWaypointsInfo,info):
+            # nothing else can run without the path
+            view.close()
+            return
+        xs = [wp['x'] for wp in info]
+        ys = [wp['y'] for wp in info]
+        extent = QtCore.QRectF(min(xs),min(ys),max(xs) - min(xs),
+                max(ys) - min(ys))
+        view.fitInView(scene.itemsBoundingRect(),QtCore.Qt.KeepAspectRatio)
+        app.processEvents()
+        self.time('dump',view.dumpWaypointsInfo)
+        self.time('zoom_in',view.zoomIn)
+        self.time('zoom_out',view.zoomOut)
+        def rotate():
+            view.rotateL()
+            self.repaint(view)
+        self.time('rotate',rotate)
+        view.rotateR()
+        self.time('repaint',self.repaint,view)
+
+        # the rubber band covers the band's rows, as the user would drag it
+        rect = view.mapFromScene(band(extent,0.1,0.45)).boundingRect()
+        view.setRBSelect()
+        if self.time('select',gesture,view,rect.topLeft(),rect.bottomRight(),
+                DRAG_STEPS):
+            self.selected['select'] = len(scene.selectedItems())
+            scene.clearSelection()
+        view.unsetRBSelect()
+
+        waypoints = list(view.waypoints)
+        first = len(waypoints)//5
+        points = waypoints[first:first + max(1,len(waypoints)//100)]
+        scene.blockSignals(True)
+        for point in points:
+            point.setSelected(True)
+        scene.blockSignals(False)
+        self.selected['drag'] = len(points)
+        # pressing off the path drags the whole selection
+        start = empty_spot(view)
+        self.time('drag',gesture,view,start,
+                start + QtCore.QPoint(DRAG_PIXELS*DRAG_STEPS,0),DRAG_STEPS)
+        scene.clearSelection()
+
+        if 'remove' not in self.skip:
+            scene.selectArea(band(extent,0.1,0.6))
+            self.selected['remove'] = len(scene.selectedItems())
+            self.time('remove',scene.removeMultiple)
+            app.processEvents()
+
+        view.close()
+        view.deleteLater()
+        app.processEvents()
+        gc.collect()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes',type=int,nargs='+',
+            default=[1000,10000,50000,200000],
+            help='path sizes to test, in waypoints')
+    parser.add_argument('--repeats',type=int,default=3,
+            help='fresh views loaded per size')
+    parser.add_argument('--budget',type=float,default=10.,
+            help='seconds a case may take before larger sizes skip it')
+    parser.add_argument('--output',help='where to write the JSON results')
+    parser.add_argument('--compare',help='earlier results to compare against')
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication([])
+    window = gui.TouchOMaticApp()
+    results = []
+    skip = set()
+    for size in args.sizes:
+        bench = Bench(window,args.budget,skip)
+        info = path(size,bench.machine)
+        for _ in range(args.repeats):
+            bench.run(info)
+        for case in CASES:
+            params = {"size":size}
+            if case in bench.selected:
+                params["selected"] = bench.selected[case]
+            name = '{}/n{}'.format(case,size)
+            if case not in bench.samples:
+                results.append({"name":name,"params":params,"skipped":True,
+                    "metrics":{}})
+                print('{:16s} skipped, {} over budget at a smaller size'
+                    .format(name,case if case in bench.skip else 'load'))
+                continue
+            metrics = {"ms":benchutil.summarize(bench.samples[case],1000)}
+            results.append({"name":name,"params":params,"metrics":metrics})
+            print('{:16s} p50={:10.2f}ms max={:10.2f}ms'.format(
+                name,metrics["ms"]["p50"],metrics["ms"]["max"]))
+        skip |= bench.slow
+    window.portScanner.stop()
+
+    print('results written to',benchutil.save('scene',results,args.output))
+    if args.compare:
+        benchutil.compare(args.compare,results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Throughput and latency of the SerialInfoThread path, against the GRBL
+simulator. Run from the repository root:
+
+    python benchmarks/serial_bench.py [--compare results/old.json]
+
+Cases, for each poll interval and path size:
+  rate      sustained commands per second through a path of G1 moves, and
+            the enqueue() to write latency of each command
+  ack       write to reply round trip of commands sent with response=True
+  stop      latency of realtime feed holds issued while a path is running
+  poll      period and jitter of the position polls while idle
+"""
+import time
+import argparse
+import threading
+
+import benchutil
+from PyQt5 import QtCore
+import grblsim
+from serialinfo import SerialInfoThread
+from commands import Command
+
+INFO = {
+    'command':'?',
+    'regex':r'WPos:(-?[0-9]+\.?[0-9]*),(-?[0-9]+\.?[0-9]*),(-?[0-9]+\.?[0-9]*)',
+    'order':'xyz',
+}
+
+def start(interval,speedup):
+    sim = grblsim.Serial(speedup=speedup,default_feed=6000)
+    sim.settings.update({110:6000.,111:6000.,112:6000.,
+                         120:500.,121:500.,122:500.})
+    thread = SerialInfoThread(None,sim,INFO,interval)
+    thread.start()
+    return sim, thread
+
+def path(size,step=5):
+    return [Command('G90 G01 X{} Y{}'.format(step*(i % 2),step*i),i)
+            for i in range(size)]
+
+def wait_for(commands,timeout):
+    end = time.perf_counter() + timeout
+    while time.perf_counter() < end:
+        if all(c.written for c in commands):
+            return True
+        time.sleep(0.005)
+    return False
+
+def bench_rate(interval,size,speedup):
+    sim, thread = start(interval,speedup)
+    commands = path(size)
+    thread.enqueue(commands)
+    done = wait_for(commands,timeout=size*interval/1000.*10 + 5)
+    thread.stop()
+    written = [c for c in commands if c.written]
+    span = max(c.written for c in written) - commands[0].enqueued
+    return {
+        "complete":done,
+        "commands_per_s":len(written)/span,
+        "enqueue_to_write_ms":benchutil.summarize(
+            [c.written - c.enqueued for c in written],1000),
+    }
+
+def bench_ack(interval,count,speedup):
+    sim, thread = start(interval,speedup)
+    commands = [Command('G90',response=True) for _ in range(count)]
+    thread.enqueue(commands)
+    wait_for(commands,timeout=count*interval/1000.*10 + 5)
+    thread.stop()
+    return {
+        "ack_round_trip_ms":benchutil.summarize(
+            [c.replied - c.written for c in commands if c.replied],1000),
+    }
+
+def bench_stop(interval,count,speedup):
+    sim, thread = start(interval,speedup)
+    thread.enqueue(path(count*4))
+    latencies = []
+    for _ in range(count):
+        time.sleep(interval/1000.)
+        latencies.append(thread.realtime('hold'))
+        thread.realtime('resume')
+    thread.stop()
+    return {"stop_latency_ms":benchutil.summarize(latencies,1000)}
+
+def bench_poll(interval,duration,speedup):
+    sim, thread = start(interval,speedup)
+    stamps = []
+    lock = threading.Lock()
+    def updated(pos):
+        with lock:
+            stamps.append(time.perf_counter())
+    thread.updated.connect(updated,QtCore.Qt.DirectConnection)
+    time.sleep(duration)
+    thread.stop()
+    periods = [b - a for a,b in zip(stamps,stamps[1:])]
+    target = interval/1000.
+    return {
+        "poll_period_ms":benchutil.summarize(periods,1000),
+        "poll_jitter_ms":benchutil.summarize(
+            [abs(p - target) for p in periods],1000),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--intervals',type=int,nargs='+',default=[10,50,100],
+            help='poll intervals to test, in ms')
+    parser.add_argument('--sizes',type=int,nargs='+',default=[10,100],
+            help='path sizes to test, in commands')
+    parser.add_argument('--speedup',type=float,default=1000.,
+            help='simulated seconds per real second')
+    parser.add_argument('--output',help='where to write the JSON results')
+    parser.add_argument('--compare',help='earlier results to compare against')
+    args = parser.parse_args()
+
+    app = QtCore.QCoreApplication([])
+    results = []
+    def record(name,params,metrics):
+        results.append({"name":name,"params":params,"metrics":metrics})
+        print('{:28s} {}'.format(name,', '.join(
+            '{}={:.3g}'.format(k,v) if isinstance(v,float) else
+            '{}(p50={:.3g} p99={:.3g})'.format(k,v.get('p50',0),v.get('p99',0))
+            for k,v in metrics.items() if isinstance(v,(float,dict)))))
+
+    for interval in args.intervals:
+        for size in args.sizes:
+            record('rate/i{}/n{}'.format(interval,size),
+                    {"interval_ms":interval,"size":size},
+                    bench_rate(interval,size,args.speedup))
+        record('ack/i{}'.format(interval),{"interval_ms":interval},
+                bench_ack(interval,20,args.speedup))
+        record('stop/i{}'.format(interval),{"interval_ms":interval},
+                bench_stop(interval,20,args.speedup))
+        record('poll/i{}'.format(interval),{"interval_ms":interval},
+                bench_poll(interval,max(1.,interval/1000.*30),args.speedup))
+
+    print('results written to',benchutil.save('serial',results,args.output))
+    if args.compare:
+        benchutil.compare(args.compare,results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Cost of decoding a status report: the profile regex that
+SerialInfoThread.parse_position used on its own, against grblstatus. Run
+from the repository root:
+
+    python benchmarks/status_bench.py [--compare results/old.json]
+
+Cases, for each kind of report:
+  regex     re.search for WPos, then a dict built from the groups
+  parser    StatusParser.parse, decoding every field into the shared Status
+  position  the parser plus the position dict that parse_position emits
+"""
+import re
+import time
+import argparse
+import tracemalloc
+
+import benchutil
+import grblstatus
+
+REGEX = r'WPos:(-?[0-9]+\.?[0-9]*),(-?[0-9]+\.?[0-9]*),(-?[0-9]+\.?[0-9]*)'
+ORDER = 'xyz'
+
+REPORTS = {
+    'wpos':'<Idle|WPos:123.456,-78.900,0.000|FS:0,0>',
+    'wpos_full':'<Run|WPos:123.456,-78.900,0.000|Bf:12,96|FS:6000,0'
+            '|Ov:100,100,100>',
+    'mpos_wco':'<Run|MPos:133.456,-68.900,0.000|Bf:12,96|FS:6000,0'
+            '|WCO:10.000,10.000,0.000>',
+}
+
+def regex_path():
+    regex = re.compile(REGEX)
+    def parse(line):
+        match = re.search(regex,line)
+        out = {'x':None, 'y':None, 'z':None}
+        if match:
+            for coord in 'xyz':
+                out[coord] = float(match.groups()[ORDER.index(coord)])
+        return out
+    return parse
+
+def parser_path():
+    return grblstatus.StatusParser().parse
+
+def position_path():
+    parser = grblstatus.StatusParser()
+    def parse(line):
+        if parser.parse(line) is not None:
+            return parser.status.position()
+    return parse
+
+PATHS = {'regex':regex_path, 'parser':parser_path, 'position':position_path}
+
+def bench(make,line,count,repeats):
+    parse = make()
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(count):
+            parse(line)
+        samples.append((time.perf_counter() - start)/count)
+    # memory still held after a burst of parses, and the peak during it
+    tracemalloc.start()
+    for _ in range(count):
+        parse(line)
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "parse_us":benchutil.summarize(samples,1e6),
+        "held_bytes":held,
+        "peak_bytes":peak,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count',type=int,default=20000,
+            help='reports parsed per timing sample')
+    parser.add_argument('--repeats',type=int,default=20,
+            help='timing samples per case')
+    parser.add_argument('--output',help='where to write the JSON results')
+    parser.add_argument('--compare',help='earlier results to compare against')
+    args = parser.parse_args()
+
+    results = []
+    for report, line in REPORTS.items():
+        for name, make in PATHS.items():
+            if name == 'regex' and 'WPos' not in line:
+                # the regex can't get a position out of MPos reports at all
+                continue
+            metrics = bench(make,line,args.count,args.repeats)
+            results.append({"name":'{}/{}'.format(name,report),
+                "params":{"report":line,"count":args.count},
+                "metrics":metrics})
+            print('{:20s} p50={:.2f}us p99={:.2f}us peak={}B'.format(
+                results[-1]["name"],metrics["parse_us"]["p50"],
+                metrics["parse_us"]["p99"],metrics["peak_bytes"]))
+
+    print('results written to',benchutil.save('status',results,args.output))
+    if args.compare:
+        benchutil.compare(args.compare,results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Durable record of how far a scan has got, so it can be resumed after a
+stop, an alarm or a crash.
+
+The serial engine calls Checkpointer.update() as scan commands complete.
+That only swaps in the new state; a background thread writes the latest one
+to disk (to a temporary file, fsynced, then renamed over the old one), so a
+crash leaves either the previous checkpoint or the new one, and a burst of
+updates costs one write.
+"""
+import os
+import json
+import threading
+
+CHECKPOINT_DIR = os.environ.get('TOUCH_O_MATIC_CHECKPOINTS',
+        os.path.join(os.path.expanduser('~'), '.touchomatic', 'checkpoints'))
+
+def path_for(port, directory=CHECKPOINT_DIR):
+    """Where the checkpoint for the machine on port is kept"""
+    name = os.path.basename(port).replace(os.sep, '_') or 'port'
+    return os.path.join(directory, name + '.json')
+
+def load(path):
+    """The last checkpoint written to path, or None"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write(path, state):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class Checkpointer():
+    """ Writes the most recent state given to update() to path """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._cond = threading.Condition()
+        self._pending = None
+        self._closed = False
+        # number of states written, and handed in
+        self.writes = 0
+        self.updates = 0
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                name='checkpoint')
+        self._thread.start()
+
+    def update(self, state):
+        with self._cond:
+            self._pending = state
+            self.updates += 1
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                state, self._pending = self._pending, None
+                if state is None:
+                    return
+            _write(self.path, state)
+            self.writes += 1
+
+    def close(self):
+        """Write whatever is pending and stop the writer"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
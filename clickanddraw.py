@@ -1,6 +1,9 @@
+import math
+import numpy as np
 from PyQt5 import QtCore, QtGui, QtWidgets
 from collections import namedtuple
 from commands import  Action
+from spatialindex import GridIndex
 
 
 Rect = namedtuple('Rect','x0 y0 xf yf')
@@ -95,7 +98,7 @@ class QDragPoint(QtWidgets.QGraphicsEllipseItem):
 
     def _updatePens(self):
         self._normalPen = QtGui.QPen(QtGui.QColor("black"))
-        self._normalPen.setWidth(self.r/8)
+        self._normalPen.setWidth(int(self.r/8))
         self.setPen(self._normalPen)
 
     def setScenePos(self,x,y):
@@ -135,12 +138,13 @@ class QDragPoint(QtWidgets.QGraphicsEllipseItem):
         color = colors[self.action]
         self.setBrush(QtGui.QBrush(QtGui.QColor(color)))
 
-    def setZ(self,z):
+    def setZ(self,z,sf=None):
         # + 50 = twice as large
         # - 50 = half as large
-        dz = self.z - z
+        # sf, the scale factor for the change, if it's already known
+        if sf is None:
+            sf = scaleFactor(self.z - z)
         self.z = z
-        sf = scaleFactor(dz)
         self.scaleSize(sf)
         if self.traceline:
             pen = self.traceline.pen2()
@@ -186,6 +190,10 @@ def onlywhendrawing(function):
 
 class QCDScene(QtWidgets.QGraphicsScene):
     mousedrag = QtCore.pyqtSignal(tuple)
+    # Ctrl+drag draws freehand, dropping a waypoint whenever the stroke is at
+    # least this many snap steps from the last one and has turned this far
+    FREEHAND_SPACING = 3
+    FREEHAND_ANGLE = math.radians(10)
     def __init__(self,parent):
         super(QtWidgets.QGraphicsScene,self).__init__(parent)
         self.parent = parent
@@ -198,16 +206,29 @@ class QCDScene(QtWidgets.QGraphicsScene):
         self.tail = None
         self.head = None
         self.drawing = True
+        # waypoint positions, for picking and rubber band selection
+        self.index = GridIndex()
+        # points being dragged together, cached for the whole gesture
+        self._dragging = []
+        self._dragdx = 0
+        self._dragdy = 0
+        # coalesces selectionChanged while dragging to once per frame
+        self._infoTimer = QtCore.QTimer(self)
+        self._infoTimer.setSingleShot(True)
+        self._infoTimer.setInterval(16)
+        self._infoTimer.timeout.connect(self.selectionChanged.emit)
 
     def _addhead(self):
         self.head = QDragPoint(0,0)
         self.tail = self.head
         self.addItem(self.head)
+        self.index.move(self.head,self.head.x,self.head.y)
         self.machine_icon = QMachineIcon(0,0)
         self.addItem(self.machine_icon)
 
     def setGrid(self, xf, yf,GRID_STEP = 50):
         self.rect = Rect(0, 0, xf, yf)
+        self.index.resize(GRID_STEP)
         self._drawGrid(GRID_STEP)
 
     def _drawGrid(self, GRID_STEP = 50):
@@ -238,7 +259,7 @@ class QCDScene(QtWidgets.QGraphicsScene):
         self._moving = False
         self._lastpos = event.scenePos()
         if event.buttons() == QtCore.Qt.LeftButton:
-            self._mover = self.itemAt(event.scenePos(),QtGui.QTransform())
+            self._mover = self.pick(event.scenePos())
             if not isinstance(self._mover,QDragPoint):
                 self._mover = None
                 self._moving = True
@@ -249,15 +270,43 @@ class QCDScene(QtWidgets.QGraphicsScene):
                 for item in self.selectedItems():
                     item.setSelected(False)
                 self._mover.setSelected(True)
+            self._dragging = [i for i in self.selectedItems()
+                              if isinstance(i, QDragPoint)]
+            self._dragdx = self._dragdy = 0
         elif event.buttons() == QtCore.Qt.RightButton:
-            mover = self.itemAt(event.scenePos(),QtGui.QTransform())
+            mover = self.pick(event.scenePos())
             if isinstance(mover,QDragPoint):
                 self._removeMover(mover)
 
+    def pick(self,pos):
+        """The waypoint under pos, if there is one"""
+        return self.index.nearest(pos.x(),pos.y(),self.head.r)
+
+    def selectArea(self,polygon,add=False):
+        """Select the waypoints inside polygon (in scene coordinates). The
+        selection changes with signals blocked and is announced once."""
+        rect = polygon.boundingRect()
+        hits = set(p for p in self.index.query(rect.left(),rect.top(),
+                                                rect.right(),rect.bottom())
+                   if polygon.containsPoint(QtCore.QPointF(p.x,p.y),
+                                            QtCore.Qt.OddEvenFill))
+        self.blockSignals(True)
+        try:
+            if not add:
+                for item in self.selectedItems():
+                    if item not in hits:
+                        item.setSelected(False)
+            for item in hits:
+                item.setSelected(True)
+        finally:
+            self.blockSignals(False)
+        self.selectionChanged.emit()
+
     def _removeMover(self, mover):
         if mover == self.head:
             return
         self.removeItem(mover)
+        self.index.remove(mover)
         mover.traceline.remove()
         #self.removeItem(mover.traceline)
         if mover.next and mover.next.traceline:
@@ -292,6 +341,7 @@ class QCDScene(QtWidgets.QGraphicsScene):
             self._mover.next = new_mover
             new_mover.prev = self._mover
             self.addItem(new_mover)
+            self.index.move(new_mover,new_mover.x,new_mover.y)
             if self._mover == self.tail:
                 self.tail = new_mover
             self._mover = new_mover
@@ -300,31 +350,92 @@ class QCDScene(QtWidgets.QGraphicsScene):
     def _movenew(self,event):
         self._moved = True
         pos = event.scenePos()
-        if self.traceline:
-            #self.removeItem(self.traceline)
-            self.traceline.remove()
-            self.traceline = None
         start = self.tail
-        self.traceline = self.addLine(start.x,start.y,pos.x(),pos.y(),self._pen)
+        if self.traceline:
+            # move the preview segment in place rather than replacing it
+            self.traceline.setLine(*snap(start.x,start.y),
+                                   *snap(pos.x(),pos.y()))
+        else:
+            self.traceline = self.addLine(start.x,start.y,pos.x(),pos.y(),
+                                          self._pen)
+        if event.modifiers() & QtCore.Qt.ControlModifier:
+            self._freehand(pos)
         self.mousedrag.emit(snap(pos.x(),pos.y()))
 
+    def _freehand(self,pos):
+        """Add a waypoint at pos if the stroke has gone far enough from the
+        last one, and turned enough, to need it"""
+        tail = self.tail
+        dx, dy = pos.x() - tail.x, pos.y() - tail.y
+        if math.hypot(dx,dy) < self.FREEHAND_SPACING*QClickAndDraw._scale:
+            return
+        if tail.prev:
+            px, py = tail.x - tail.prev.x, tail.y - tail.prev.y
+            turn = abs(math.atan2(px*dy - py*dx, px*dx + py*dy))
+            if turn < self.FREEHAND_ANGLE:
+                return
+        self.appendWaypoint(pos.x(),pos.y())
+
     def _moveexisting(self,event):
         pos = event.scenePos()
         self._mover.setScenePos(pos.x(),pos.y())
-        self.selectionChanged.emit()
+        self.index.move(self._mover,self._mover.x,self._mover.y)
+        if not self._infoTimer.isActive():
+            self._infoTimer.start()
 
     def _movemultiple(self,event):
         pos = event.scenePos()
-        dx = pos.x() - self._lastpos.x()
-        dy = pos.y() - self._lastpos.y()
-        for mover in self.selectedItems():
-            if isinstance(mover, QDragPoint):
-                mover.moveScenePos(dx,dy)
+        self._dragdx += pos.x() - self._lastpos.x()
+        self._dragdy += pos.y() - self._lastpos.y()
+        if snap(self._dragdx,self._dragdy) != (0, 0):
+            self.translatePoints(self._dragging,self._dragdx,self._dragdy)
+            self._dragdx = self._dragdy = 0
+            self._moved = True
+
+    def translatePoints(self, points, dx, dy):
+        """Move every point in points by (dx, dy), rewriting each affected
+        line once however many of its ends moved"""
+        lines = {}
+        def endpoints(traceline):
+            if traceline not in lines:
+                line = traceline.line()
+                lines[traceline] = [line.x1(),line.y1(),line.x2(),line.y2()]
+            return lines[traceline]
+        for point in points:
+            point.x += dx
+            point.y += dy
+            point.setPos(point.x - point._x, point.y - point._y)
+            self.index.move(point,point.x,point.y)
+            if point.traceline:
+                endpoints(point.traceline)[2:] = point.x, point.y
+            if point.next and point.next.traceline:
+                endpoints(point.next.traceline)[:2] = point.x, point.y
+        for traceline, ends in lines.items():
+            traceline.setLine(*ends)
+
+    def setPointsZ(self, points, z):
+        """Set the z of every point in points, as setZ() would one at a
+        time, with the scale factors worked out together and points
+        already at z left alone"""
+        points = [p for p in points if p.z != z]
+        if not points:
+            return
+        factors = scaleFactor(np.array([p.z for p in points],float) - z)
+        for point, sf in zip(points, factors.tolist()):
+            point.setZ(z, sf)
 
 
     def removeMultiple(self):
-        for mover in self.selectedItems():
-            self._removeMover(mover)
+        """Remove the selected waypoints. Removing a selected item changes
+        the selection, so signals are blocked until the end and the change
+        announced once."""
+        self.blockSignals(True)
+        try:
+            for mover in self.selectedItems():
+                self._removeMover(mover)
+        finally:
+            self.blockSignals(False)
+        self.selectionChanged.emit()
 
     def appendWaypoint(self,x=0,y=0,z=None,action=None):
         start = self.tail
@@ -340,6 +451,7 @@ class QCDScene(QtWidgets.QGraphicsScene):
         self.tail = new_tail
         self.traceline = None
         self.addItem(new_tail)
+        self.index.move(new_tail,new_tail.x,new_tail.y)
 
     def addLine(self,x0,y0,xf,yf,pen,last=True):
         x0, y0 = snap(x0,y0)
@@ -355,18 +467,27 @@ class QCDScene(QtWidgets.QGraphicsScene):
             return
         if self._mover:
             self._moveexisting(event)
-        elif self._moving and not self.selectedItems():
+        elif self._moving and not self._dragging:
             self._movenew(event)
-        elif self.selectedItems():
+        elif self._dragging:
             self._movemultiple(event)
         self._lastpos = event.scenePos()
 
     @onlywhendrawing
     def mouseReleaseEvent(self,event):
         pos = event.scenePos()
-        if self._moved:
+        if self._dragging and not self._mover:
+            # a group drag: refresh the info panel once, now it's over
+            if self._moved:
+                self._moved = False
+                self.selectionChanged.emit()
+        elif self._moved:
             self._moved = False
-            self.appendWaypoint(pos.x(),pos.y())
+            # unless a freehand stroke already ended on this point
+            if self.traceline or snap(pos.x(),pos.y()) != (
+                    self.tail.x,self.tail.y):
+                self.appendWaypoint(pos.x(),pos.y())
+        self._dragging = []
 
 class QClickAndDraw(QtWidgets.QGraphicsView):
     def __init__(self, parent):
@@ -376,6 +497,12 @@ class QClickAndDraw(QtWidgets.QGraphicsView):
         self.setScene(self._scene)
         self.rotation = 0
         self.scale(1,-1)
+        # Rubber band selection is done here rather than with Qt's
+        # RubberBandDrag, so that it goes through the scene's waypoint index
+        self._selecting = False
+        self._rbOrigin = None
+        self._rubberBand = QtWidgets.QRubberBand(
+                QtWidgets.QRubberBand.Rectangle, self.viewport())
 
     @property
     def waypoints(self):
@@ -405,13 +532,41 @@ class QClickAndDraw(QtWidgets.QGraphicsView):
         self._scene.machine_icon.scaleSize(1.25)
 
     def setRBSelect(self):
-        self.setDragMode(QtWidgets.QGraphicsView.RubberBandDrag)
+        self._selecting = True
         self._scene.drawing = False
 
     def unsetRBSelect(self):
-        self.setDragMode(QtWidgets.QGraphicsView.NoDrag)
+        self._selecting = False
+        self._rbOrigin = None
+        self._rubberBand.hide()
         self._scene.drawing = True
 
+    def mousePressEvent(self,event):
+        if self._selecting and event.button() == QtCore.Qt.LeftButton:
+            self._rbOrigin = event.pos()
+            self._rubberBand.setGeometry(QtCore.QRect(self._rbOrigin,
+                                                      QtCore.QSize()))
+            self._rubberBand.show()
+        else:
+            super().mousePressEvent(event)
+
+    def mouseMoveEvent(self,event):
+        if self._rbOrigin is not None:
+            self._rubberBand.setGeometry(
+                    QtCore.QRect(self._rbOrigin,event.pos()).normalized())
+        else:
+            super().mouseMoveEvent(event)
+
+    def mouseReleaseEvent(self,event):
+        if self._rbOrigin is not None:
+            self._rubberBand.hide()
+            self._rbOrigin = None
+            area = self.mapToScene(self._rubberBand.geometry())
+            add = bool(event.modifiers() & QtCore.Qt.ControlModifier)
+            self._scene.selectArea(area,add)
+        else:
+            super().mouseReleaseEvent(event)
+
     def keyPressEvent(self,event):
         if event.key() == QtCore.Qt.Key_Shift:
             self.setRBSelect()
@@ -445,6 +600,12 @@ class QClickAndDraw(QtWidgets.QGraphicsView):
         self._scene.head.v = speed
         QDragPoint.v = speed
 
+    def waypointIndices(self,waypoints):
+        """Path indices of waypoints, in order, from one walk along the
+        path"""
+        wanted = set(waypoints)
+        return [i for i,wp in enumerate(self.waypoints) if wp in wanted]
+
     def waypointIndex(self,waypoint):
         # Todo: more efficient
         for i,wp in enumerate(self.waypoints):
@@ -456,6 +617,20 @@ class QClickAndDraw(QtWidgets.QGraphicsView):
         return [h.info for h in self.waypoints]
 
     def loadWaypointsInfo(self,info):
-        for point in info[1:]:
-            self._scene.appendWaypoint(**point)
+        self.loadWaypoints(info[1:])
+
+    def loadWaypoints(self,points,chunk=5000):
+        """Append waypoints from any iterable of info dicts, such as a
+        streaming importer. Repaints every chunk points so long loads don't
+        freeze the window."""
+        scene = self._scene
+        for i,point in enumerate(points):
+            scene.appendWaypoint(point['x'],point['y'],point.get('z'))
+            if 'v' in point:
+                scene.tail.v = point['v']
+            if point.get('action') not in (None,Action.NO_ACTION):
+                scene.tail.setAction(point['action'])
+            if i % chunk == chunk - 1:
+                QtWidgets.QApplication.processEvents(
+                        QtCore.QEventLoop.ExcludeUserInputEvents)
 
@@ -1,4 +1,35 @@
 from enum import Enum
+
+# GRBL realtime commands. These are picked out of the input stream as soon as
+# they arrive, so they don't need a line ending or room in the planner.
+REALTIME = {
+    'status': '?',
+    'hold': '!',
+    'resume': '~',
+    'reset': '\x18',
+    # stops a $J= jog and throws away the jogs queued behind it
+    'jog-cancel': '\x85',
+    # feed override: back to 100%, and up/down in 10% and 1% steps
+    'feed-reset': '\x90',
+    'feed+10': '\x91',
+    'feed-10': '\x92',
+    'feed+1': '\x93',
+    'feed-1': '\x94',
+}
+
+# the range GRBL clamps the feed override to, in percent
+FEED_OVERRIDE_RANGE = (10, 200)
+
+def feed_override(percent):
+    """Realtime bytes that set the feed override to percent, whatever it
+    is now: a reset to 100%, then steps of 10% and 1%"""
+    lo, hi = FEED_OVERRIDE_RANGE
+    change = int(round(min(max(percent,lo),hi))) - 100
+    sign = '+' if change > 0 else '-'
+    tens, ones = divmod(abs(change),10)
+    return (REALTIME['feed-reset'] + REALTIME['feed'+sign+'10']*tens +
+            REALTIME['feed'+sign+'1']*ones)
+
 class Action(Enum):
     NO_ACTION = 0
     TAKE_PHOTO = 1
@@ -30,3 +61,18 @@ class Command():
         self.pos = None
         # Do we care about the response from the command?
         self.response = response
+        # (scan id, pass, index in the pass) of scan commands, which the
+        # engine checkpoints as they complete
+        self.scan = None
+        # feed rate in force for a scan command, restored when a scan
+        # resumes there
+        self.feed = None
+        # fractions of a move at which to take a photo without stopping
+        self.captures = None
+        # set on a photo on the move that was skipped, the camera being
+        # still busy with the one before
+        self.late = False
+        # perf_counter() times it was queued, written and answered
+        self.enqueued = None
+        self.written = None
+        self.replied = None
@@ -0,0 +1,255 @@
+import os
+import copy
+import logging
+import codecs
+from PyQt5 import QtCore
+import yaml
+import serial
+import grblsim
+import actions
+import sessionlog
+import ioprocess
+import checkpoint
+from commands import Command
+from serialinfo import SerialInfoThread
+
+def stringdecoder(function):
+    """Wrapper for functions that return a dictionary. Converts the dictionary
+    returned by the function into a dictionary-like object that has all the
+    unicode escape sequences (eg. '\\n') in its string values converted into the 
+    appropriate ascii bytes, and all its other keys unchanged
+    """
+    class __stringdecoder():
+        def __init__(self,dic):
+            self._dict = dic
+        def __getitem__(self,item):
+            if isinstance(self._dict[item],str):
+                return codecs.decode(self._dict[item],'unicode_escape')
+            return self._dict[item]
+
+    def wrapper(self,*args,**kwargs):
+        return __stringdecoder(function(self,*args,**kwargs))
+
+    return wrapper
+
+CONFIG_DIR = os.path.join(os.path.split(__file__)[0],"config")
+# directory to record every session's serial traffic in, if set
+SESSION_DIR = os.environ.get('TOUCH_O_MATIC_SESSIONS')
+# run each machine's serial engine in a child process, if set
+IO_PROCESS = bool(os.environ.get('TOUCH_O_MATIC_IO_PROCESS'))
+
+def open_port(port, baud_rate, machine):
+    """The transport for port: the serial device, a session replay, or the
+    simulator when there is no such device"""
+    if port.startswith(sessionlog.REPLAY_PREFIX):
+        return sessionlog.ReplaySerial(port[len(sessionlog.REPLAY_PREFIX):])
+    try:
+        ser = serial.Serial(port, baud_rate)
+    except:
+        # no hardware: talk to a simulated controller instead. The
+        # profiles never set a feed rate, so start with the default one
+        ser = grblsim.Serial(port, baud_rate,
+                default_feed=machine.get('default-speed'))
+    if SESSION_DIR:
+        os.makedirs(SESSION_DIR, exist_ok=True)
+        ser = sessionlog.RecordingSerial(ser,
+                sessionlog.session_path(SESSION_DIR, port))
+    return ser
+
+def load_machines(config_dir=CONFIG_DIR):
+    """Read every machine profile in config_dir, keyed by its name"""
+    yamls = [y for y in os.listdir(config_dir) if y.endswith('.yaml')]
+    machines = {}
+    for yam in yamls:
+        yam = os.path.join(config_dir,yam)
+        with open(yam) as y:
+            try:
+                data = yaml.safe_load(y)
+                machines[data['name']] = data
+            except:
+                logging.warning("Failed to parse config file {}".format(yam))
+    return machines
+
+class Controller():
+    """ One connected machine: its serial port, profile and I/O thread, and
+    the scan running on it """
+    def __init__(self, port, baud_rate, machine, ser, thread, parent=None):
+        self.port = port
+        self.baud_rate = baud_rate
+        self.machine = machine
+        self.ser = ser
+        self.thread = thread
+        self.pos = {'x':None, 'y':None, 'z':None}
+        self.sent = 0
+        # the scan's commands, its checkpoint name and the pass it is on;
+        # the timer queues the next pass while scanning
+        self.commands = []
+        self.scan = None
+        self.scan_pass = 0
+        self.scanning = False
+        self.scan_timer = QtCore.QTimer(parent)
+        self.scan_timer.timeout.connect(self.next_pass)
+
+    @property
+    def name(self):
+        return self.machine['name']
+
+    @property
+    @stringdecoder
+    def instructions(self):
+        return self.machine['instructions']
+
+    def configure(self):
+        """Set initial machine variables that won't need to be modified during
+        runtime"""
+        self.thread.enqueue(Command(self.instructions['connect']))
+        for key in 'scale', 'invert':
+            self.thread.enqueue(
+                    [Command(c) for c in self.machine.get(key,{}).values()])
+
+    def start_scan(self, commands, scan=None, interval=None, resume=None):
+        """Queue the first pass of a scan on this machine, and another every
+        interval ms if given. resume is the (pass, index) of the last
+        command known to have completed, to carry on after."""
+        self.commands = commands
+        self.scan = scan
+        self.scan_pass = 0
+        first = 0
+        if resume:
+            self.scan_pass, first = resume[0], resume[1] + 1
+            if first >= len(commands):
+                self.scan_pass, first = self.scan_pass + 1, 0
+        self._queue_pass(first, resume is not None)
+        if interval is not None:
+            self.scanning = True
+            self.scan_timer.start(interval)
+
+    def next_pass(self):
+        self.scan_pass += 1
+        self._queue_pass(0)
+
+    def _queue_pass(self, first, resumed=False):
+        if self.scan is None:
+            self.thread.enqueue(self.commands[first:])
+            return
+        batch = []
+        if resumed and first:
+            batch.extend(self._restore(self.commands[first]))
+        for i in range(first,len(self.commands)):
+            # a copy per pass, so each carries its own place in the scan
+            cmd = copy.copy(self.commands[i])
+            cmd.scan = (self.scan,self.scan_pass,i)
+            batch.append(cmd)
+        self.thread.enqueue(batch)
+
+    def _restore(self, cmd):
+        """Commands that put back the motion mode and feed rate in force at
+        cmd. A reset forgets the feed rate and a probe cycle leaves G0 on,
+        and the commands after cmd only carry them when they change."""
+        if cmd.feed is None or not self.machine['instructions'].get('feed'):
+            return []
+        return [Command(self.instructions['feed'].format(v=cmd.feed))]
+
+    def busy(self):
+        """Whether a scan, a job or a streamed file is still running"""
+        return self.scanning or self.thread.busy()
+
+    def stop_scan(self):
+        """Stop repeating the scan and drop whatever is still queued"""
+        self.thread.clear()
+        self.scan_timer.stop()
+        self.scanning = False
+
+    @property
+    def status(self):
+        return {
+            "machine":self.name,
+            "baud-rate":self.baud_rate,
+            "pos":dict(self.pos),
+            "queued":self.thread.queued(),
+            "sent":self.sent,
+            "running":self.thread.isRunning(),
+            "scanning":self.scanning,
+            "busy":self.busy(),
+        }
+
+class ControllerManager(QtCore.QObject):
+    """Keeps any number of machines connected at once, one per serial port.
+
+    Every controller gets its own SerialInfoThread: the serial reads block, so
+    a shared worker would make each machine wait on the others' replies. The
+    threads only meet in the owner's event loop, where their signals are
+    delivered.
+    """
+
+    # port of the machine that changed, and the status of every machine
+    statusChanged = QtCore.pyqtSignal(str,dict)
+
+    def __init__(self, parent=None, interval=100, process=IO_PROCESS):
+        super(ControllerManager,self).__init__(parent)
+        self.interval = interval
+        # see ioprocess: engines run in child processes instead of threads
+        self.process = process
+        self._controllers = {}
+
+    def __getitem__(self,port):
+        return self._controllers[port]
+
+    def __contains__(self,port):
+        return port in self._controllers
+
+    def __iter__(self):
+        return iter(list(self._controllers.values()))
+
+    def __len__(self):
+        return len(self._controllers)
+
+    def open(self, port, baud_rate, machine):
+        """Connect to the machine on port and start polling it"""
+        if port in self._controllers:
+            return self._controllers[port]
+        if self.process:
+            # the child process opens the port itself
+            ser = None
+            thread = ioprocess.ProcessEngine(self, port, baud_rate, machine,
+                    self.interval)
+        else:
+            ser = open_port(port, baud_rate, machine)
+            thread = SerialInfoThread(self, ser,
+                    machine['instructions']['info'], self.interval,
+                    actions.ActionExecutor(machine.get('actions')))
+            thread.checkpoint = checkpoint.Checkpointer(
+                    checkpoint.path_for(port))
+        controller = Controller(port, baud_rate, machine, ser, thread, self)
+        thread.updated.connect(
+                lambda pos, c=controller: self._updated(c,pos))
+        thread.commandSent.connect(
+                lambda cmd, c=controller: self._sent(c,cmd))
+        self._controllers[port] = controller
+        thread.start()
+        controller.configure()
+        self.statusChanged.emit(port,self.status())
+        return controller
+
+    def close(self,port):
+        controller = self._controllers.pop(port)
+        controller.scan_timer.stop()
+        controller.thread.stop()
+        if controller.ser is not None:
+            controller.ser.close()
+        self.statusChanged.emit(port,self.status())
+
+    def closeAll(self):
+        for port in list(self._controllers):
+            self.close(port)
+
+    def status(self):
+        """Aggregated status of every connected machine, keyed by port"""
+        return {port:c.status for port,c in self._controllers.items()}
+
+    def _updated(self,controller,pos):
+        controller.pos = pos
+        self.statusChanged.emit(controller.port,self.status())
+
+    def _sent(self,controller,cmd):
+        controller.sent += 1
@@ -0,0 +1,37 @@
+import os
+import mmap
+from importers import strip_gcode
+
+# files streamed as they are rather than imported as a scan path
+EXTENSIONS = ('.nc', '.gcode', '.ngc', '.tap')
+
+class GcodeFile():
+    """ A G-code file read lazily from disk, for streaming to the machine.
+
+    The file is memory-mapped and walked a line at a time, so memory use is
+    the same for a few kilobytes or a few gigabytes. Iterating yields
+    (offset, line) pairs: the byte offset just past the line, for progress
+    reporting, and the line with comments and whitespace stripped. Lines
+    that strip to nothing are skipped.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        # offset of the last line handed out
+        self.offset = 0
+
+    def __iter__(self):
+        if not self.size:
+            return
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                start = 0
+                while start < self.size:
+                    end = mm.find(b'\n', start)
+                    if end < 0:
+                        end = self.size
+                    line = strip_gcode(mm[start:end].decode('latin-1'))
+                    start = end + 1
+                    if line:
+                        self.offset = min(start, self.size)
+                        yield self.offset, line
@@ -0,0 +1,648 @@
+"""A software GRBL 1.1 controller for running the app without a machine.
+
+GrblSimulator has the parts of pyserial's Serial interface that the app uses,
+so it can be used in-process in place of a port. serve_pty() puts one behind
+a pseudo-terminal instead, so any serial client can connect to it:
+
+    python grblsim.py            # prints the device to connect to
+
+What it models: the 128 byte RX buffer, the planner queue (reported as Bf:),
+ok/error replies, realtime '?' status reports with the machine state, WPos
+and WCO, feed hold/cycle start/soft reset, $J= jogging and jog cancel, feed
+overrides (reported as Ov:), motion time from the feed rate and the
+$110-$112/$120-$122 settings, dwell, the stall of writing a $ setting to
+EEPROM, and G38.2 probing against a surface given as a function of X and Y.
+Things that it does not model: junction speeds (every block starts and ends
+at rest), deceleration into a feed hold (the machine stops on the spot, and
+the same goes for jog cancel), arcs (G2/G3 run as straight lines), and the
+travel of a probe that misses (it alarms straight away, without moving).
+"""
+import os
+import sys
+import re
+import time
+import threading
+import collections
+
+RX_BUFFER_SIZE = 128
+PLANNER_BLOCKS = 15
+EEPROM_DELAY = 0.02 # seconds stalled for each $ setting written
+STARTUP = "\r\nGrbl 1.1h ['$' for help]\r\n"
+
+# GRBL's defaults for the settings the simulator uses
+DEFAULT_SETTINGS = {
+    10: 2, # status report: WPos, buffer state
+    100: 250., 101: 250., 102: 250., # steps/mm
+    110: 500., 111: 500., 112: 500., # max rate mm/min
+    120: 10., 121: 10., 122: 10., # acceleration mm/s^2
+}
+
+# error codes, as listed in GRBL's error_codes_en_US.csv
+ERR_EXPECTED_COMMAND = 1
+ERR_BAD_NUMBER = 2
+ERR_INVALID_STATEMENT = 3
+ERR_IDLE_ERROR = 8
+ERR_SYSTEM_LOCKED = 9
+ERR_UNSUPPORTED_COMMAND = 20
+ERR_UNDEFINED_FEED_RATE = 22
+
+# alarm codes
+ALARM_PROBE_INITIAL = 4
+ALARM_PROBE_FAIL = 5
+
+# machine Z of the bed that probes touch, unless given another surface
+BED_Z = -10.
+
+def flat_bed(x, y):
+    return BED_Z
+
+# realtime feed override commands: change in percent, None for a reset
+FEED_OVERRIDES = {0x90: None, 0x91: 10, 0x92: -10, 0x93: 1, 0x94: -1}
+FEED_OVERRIDE_RANGE = (10, 200)
+
+WORD = re.compile(r'([A-Z])([-+]?[0-9]*\.?[0-9]*)')
+AXES = 'XYZ'
+
+
+class Block():
+    """ One linear move in the planner queue, with a trapezoidal profile """
+    def __init__(self, start, end, rate, accel, begin, jog=False):
+        self.jog = jog
+        # programmed feed and the axes' max rate, set by the simulator so
+        # the block can be replanned when the feed override changes
+        self.feed = None
+        self.max_rate = rate
+        self.start = start
+        self.end = end
+        self.length = sum((e-s)**2 for s,e in zip(start,end))**0.5
+        # mm/min -> mm/s
+        v = rate/60.
+        self.accel = accel
+        if self.length >= v*v/accel:
+            self.v = v
+            self.t_acc = v/accel
+            self.t_cruise = (self.length - v*v/accel)/v
+        else:
+            # never gets up to speed
+            self.v = (self.length*accel)**0.5
+            self.t_acc = self.v/accel
+            self.t_cruise = 0
+        self.duration = 2*self.t_acc + self.t_cruise
+        self.begin = begin
+
+    @property
+    def finish(self):
+        return self.begin + self.duration
+
+    def distance(self,t):
+        """Distance travelled t seconds after the block began"""
+        t = min(max(t,0),self.duration)
+        d_acc = 0.5*self.accel*self.t_acc**2
+        if t < self.t_acc:
+            return 0.5*self.accel*t*t
+        if t < self.t_acc + self.t_cruise:
+            return d_acc + self.v*(t - self.t_acc)
+        return self.length - 0.5*self.accel*(self.duration - t)**2
+
+    def speed(self,t):
+        """Feed rate in mm/min t seconds after the block began"""
+        if t < 0 or t >= self.duration:
+            return 0
+        if t < self.t_acc:
+            return self.accel*t*60
+        if t < self.t_acc + self.t_cruise:
+            return self.v*60
+        return self.accel*(self.duration - t)*60
+
+    def position(self,t):
+        if not self.length:
+            return self.end
+        f = self.distance(t)/self.length
+        return tuple(s + (e-s)*f for s,e in zip(self.start,self.end))
+
+
+class GrblSimulator():
+    """ Simulated GRBL controller with a pyserial-like interface """
+    def __init__(self, port=None, baudrate=115200, timeout=None,
+            speedup=1.0, default_feed=None, rx_size=RX_BUFFER_SIZE,
+            planner_size=PLANNER_BLOCKS, surface=flat_bed):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        # simulated seconds per real second
+        self.speedup = speedup
+        self.rx_size = rx_size
+        self.planner_size = planner_size
+        self.settings = dict(DEFAULT_SETTINGS)
+        # machine Z of the surface at machine (x, y), for probing; None for
+        # nothing to touch
+        self.surface = surface
+        self.is_open = True
+        # characters lost because the RX buffer was full
+        self.rx_overflows = 0
+        self._cond = threading.Condition()
+        self._out = bytearray()
+        self._wall = time.monotonic()
+        self._clock = 0.
+        self._reset()
+        # a stand-in for the feed rate a sender would set at startup; a
+        # soft reset clears it, as on GRBL
+        self._feed = default_feed
+        self._reply(STARTUP)
+
+    def _reset(self):
+        """Power-on state. Machine position survives a reset, like steppers"""
+        self._rx = bytearray()
+        self._planner = collections.deque()
+        self._mpos = getattr(self,'_mpos',(0.,0.,0.))
+        self._wco = getattr(self,'_wco',(0.,0.,0.))
+        self._absolute = True
+        self._rapid = True
+        self._inches = False
+        self._feed = None
+        self._hold = False
+        self._alarm = False
+        self._feed_override = 100
+        self._report_overrides = False
+        # a line that finishes later (dwell, EEPROM write): (time, reply)
+        self._pending = None
+        self._reports = 0
+
+    # pyserial interface
+
+    def write(self,data):
+        if isinstance(data,str):
+            data = bytes(data,'latin-1')
+        with self._cond:
+            self._tick()
+            for byte in data:
+                if not self._realtime(byte):
+                    if len(self._rx) < self.rx_size:
+                        self._rx.append(byte)
+                    else:
+                        self.rx_overflows += 1
+            self._service()
+            self._cond.notify_all()
+        return len(data)
+
+    def readline(self):
+        deadline = None if self.timeout is None else (
+                time.monotonic() + self.timeout)
+        with self._cond:
+            while True:
+                self._tick()
+                self._service()
+                end = self._out.find(b'\n')
+                if end >= 0:
+                    line = bytes(self._out[:end+1])
+                    del self._out[:end+1]
+                    return line
+                wait = self._next_event()
+                if deadline is not None:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        line = bytes(self._out)
+                        self._out.clear()
+                        return line
+                    wait = min(wait,left)
+                self._cond.wait(wait)
+
+    def read(self,size=1):
+        with self._cond:
+            self._tick()
+            self._service()
+            data = bytes(self._out[:size])
+            del self._out[:size]
+            return data
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            self._tick()
+            self._service()
+            return len(self._out)
+
+    def reset_input_buffer(self):
+        with self._cond:
+            self._tick()
+            self._service()
+            self._out.clear()
+
+    def reset_output_buffer(self):
+        # writes are consumed straight away, there's never anything waiting
+        pass
+
+    flushInput = reset_input_buffer
+    flushOutput = reset_output_buffer
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+    # simulation
+
+    def _tick(self):
+        """Advance the simulated clock, unless the machine is held"""
+        now = time.monotonic()
+        if not self._hold and not self._alarm:
+            self._clock += (now - self._wall)*self.speedup
+        self._wall = now
+
+    def _next_event(self):
+        """Real seconds until something in the simulation changes"""
+        times = [self._planner[0].finish] if self._planner else []
+        if self._pending:
+            times.append(self._pending[0])
+        if not times or self._hold:
+            return 0.05
+        return min(max(min(times) - self._clock,0)/self.speedup + 1e-4,0.05)
+
+    def _service(self):
+        """Retire finished blocks, then process lines while there's room"""
+        while self._planner and self._planner[0].finish <= self._clock:
+            self._mpos = self._planner.popleft().end
+        if self._pending:
+            if self._pending[0] > self._clock:
+                return
+            self._reply(self._pending[1])
+            self._pending = None
+        while b'\n' in self._rx and not self._pending:
+            end = self._rx.index(b'\n')
+            line = self._rx[:end].decode('latin-1')
+            line = re.sub(r'\(.*?\)|;.*','',line).replace(' ','').upper()
+            line = line.replace('\r','')
+            if self._needs_sync(line) and self._planner:
+                return
+            if self._is_motion(line) and (
+                    len(self._planner) >= self.planner_size):
+                return
+            del self._rx[:end+1]
+            self._execute(line)
+
+    def _needs_sync(self,line):
+        """$ commands and dwells wait for the planner to empty"""
+        if line.startswith('$J='):
+            return False
+        return line.startswith('$') or bool(re.search(
+            r'G0?4(?![0-9])|G10|G38',line))
+
+    def _is_motion(self,line):
+        return any(a in line for a in AXES) and (
+                not line.startswith('$') or line.startswith('$J='))
+
+    def _reply(self,text):
+        self._out.extend(bytes(text,'latin-1'))
+
+    def _ok(self):
+        self._reply('ok\r\n')
+
+    def _error(self,code):
+        self._reply('error:{}\r\n'.format(code))
+
+    def _realtime(self,byte):
+        """Act on a realtime command. Returns False for ordinary characters"""
+        if byte == ord('?'):
+            self._service()
+            self._reply(self._status() + '\r\n')
+        elif byte == ord('!'):
+            if self._planner:
+                self._hold = True
+        elif byte == ord('~'):
+            self._hold = False
+        elif byte in FEED_OVERRIDES:
+            step = FEED_OVERRIDES[byte]
+            lo, hi = FEED_OVERRIDE_RANGE
+            value = 100 if step is None else min(max(
+                self._feed_override + step,lo),hi)
+            if value != self._feed_override:
+                self._feed_override = value
+                self._replan()
+            self._report_overrides = True
+        elif byte == 0x85:
+            if self._planner and self._planner[0].jog:
+                # stop where it is, and drop the jogs that haven't run yet
+                self._mpos = self.position
+                self._planner.clear()
+                self._rx = bytearray(b''.join(line + b'\n'
+                    for line in self._rx.split(b'\n')[:-1]
+                    if not line.upper().startswith(b'$J=')) +
+                    self._rx.split(b'\n')[-1])
+        elif byte == 0x18:
+            if self._planner:
+                # aborting a move loses position
+                self._mpos = self.position
+                self._reset()
+                self._alarm = True
+                self._reply('ALARM:3\r\n')
+            else:
+                self._reset()
+            self._reply(STARTUP)
+        else:
+            return False
+        return True
+
+    @property
+    def state(self):
+        if self._alarm:
+            return 'Alarm'
+        if self._hold:
+            return 'Hold:0'
+        if self._planner:
+            return 'Jog' if self._planner[0].jog else 'Run'
+        return 'Idle'
+
+    @property
+    def position(self):
+        """Current machine position"""
+        if self._planner:
+            block = self._planner[0]
+            return block.position(self._clock - block.begin)
+        return self._mpos
+
+    def _status(self):
+        mpos = self.position
+        mask = int(self.settings[10])
+        fields = [self.state]
+        if mask & 1:
+            fields.append('MPos:' + self._fmt(mpos))
+        else:
+            fields.append('WPos:' + self._fmt(
+                [m - w for m,w in zip(mpos,self._wco)]))
+        if mask & 2:
+            fields.append('Bf:{},{}'.format(
+                self.planner_size - len(self._planner),
+                self.rx_size - len(self._rx)))
+        speed = 0
+        if self._planner and not self._hold:
+            block = self._planner[0]
+            speed = block.speed(self._clock - block.begin)
+        fields.append('FS:{:.0f},0'.format(speed))
+        if self._reports % 10 == 0:
+            fields.append('WCO:' + self._fmt(self._wco))
+        elif self._reports % 10 == 5 or self._report_overrides:
+            # like GRBL: now and then, and straight after a change
+            fields.append('Ov:{},100,100'.format(self._feed_override))
+            self._report_overrides = False
+        self._reports += 1
+        return '<{}>'.format('|'.join(fields))
+
+    def _fmt(self,xyz):
+        return ','.join('{:.3f}'.format(v) for v in xyz)
+
+    def _execute(self,line):
+        if not line:
+            return self._ok()
+        if line.startswith('$'):
+            return self._system(line)
+        if self._alarm:
+            return self._error(ERR_SYSTEM_LOCKED)
+        words = WORD.findall(line)
+        if ''.join(l+v for l,v in words) != line:
+            return self._error(ERR_EXPECTED_COMMAND)
+        try:
+            words = [(l,float(v)) for l,v in words]
+        except ValueError:
+            return self._error(ERR_BAD_NUMBER)
+        return self._gcode(words)
+
+    def _system(self,line):
+        if line.startswith('$J='):
+            return self._jog(line[3:])
+        if line == '$X':
+            self._alarm = False
+            return self._ok()
+        if line == '$$':
+            for key,value in sorted(self.settings.items()):
+                self._reply('${}={:g}\r\n'.format(key,value))
+            return self._ok()
+        if self._alarm:
+            return self._error(ERR_SYSTEM_LOCKED)
+        match = re.match(r'\$([0-9]+)=([-+]?[0-9]*\.?[0-9]+)$',line)
+        if match:
+            self.settings[int(match.group(1))] = float(match.group(2))
+            self._pending = (self._clock + EEPROM_DELAY,'ok\r\n')
+            return
+        if line in ('$G','$#','$I','$N','$C','$H'):
+            return self._ok()
+        return self._error(ERR_INVALID_STATEMENT)
+
+    def _jog(self,line):
+        """A $J= jog: a feed move that leaves the parser's modes alone, and
+        that only runs while idle or behind other jogs"""
+        if self._alarm:
+            return self._error(ERR_SYSTEM_LOCKED)
+        if any(not b.jog for b in self._planner) or self._hold:
+            return self._error(ERR_IDLE_ERROR)
+        words = WORD.findall(line)
+        if ''.join(l+v for l,v in words) != line:
+            return self._error(ERR_EXPECTED_COMMAND)
+        try:
+            words = [(l,float(v)) for l,v in words]
+        except ValueError:
+            return self._error(ERR_BAD_NUMBER)
+        modes = self._absolute, self._inches, self._rapid, self._feed
+        self._rapid = False
+        self._feed = None
+        target = {}
+        try:
+            for letter,value in words:
+                if letter == 'G' and value in (20,21):
+                    self._inches = value == 20
+                elif letter == 'G' and value in (90,91):
+                    self._absolute = value == 90
+                elif letter == 'F':
+                    self._feed = value*(25.4 if self._inches else 1.)
+                elif letter in AXES:
+                    target[letter] = value
+                else:
+                    return self._error(ERR_INVALID_STATEMENT)
+            if not self._feed:
+                return self._error(ERR_UNDEFINED_FEED_RATE)
+            return self._move(target,25.4 if self._inches else 1.,jog=True)
+        finally:
+            self._absolute, self._inches, self._rapid, self._feed = modes
+
+    def _gcode(self,words):
+        scale = 25.4 if self._inches else 1.
+        target = {}
+        dwell = None
+        set_home = False
+        probe = False
+        for letter,value in words:
+            if letter == 'G':
+                if value == 0:
+                    self._rapid = True
+                elif value in (1,2,3):
+                    self._rapid = False
+                elif value == 4:
+                    dwell = 0.
+                elif value == 10:
+                    set_home = True
+                elif value == 38.2:
+                    probe = True
+                elif value == 20:
+                    self._inches = True
+                    scale = 25.4
+                elif value == 21:
+                    self._inches = False
+                    scale = 1.
+                elif value == 90:
+                    self._absolute = True
+                elif value == 91:
+                    self._absolute = False
+                elif value not in (17,18,19,54,94):
+                    return self._error(ERR_UNSUPPORTED_COMMAND)
+            elif letter == 'F':
+                self._feed = value*scale
+            elif letter in AXES:
+                target[letter] = value
+            elif letter == 'P':
+                if dwell is not None:
+                    dwell = value
+            elif letter not in 'MSTLN':
+                return self._error(ERR_UNSUPPORTED_COMMAND)
+        if dwell is not None:
+            # GRBL dwells take P; the shipped profile uses X, so accept both
+            dwell = dwell or target.get('X',0)
+            self._pending = (self._clock + dwell,'ok\r\n')
+            return
+        if set_home:
+            wpos = [target.get(a) for a in AXES]
+            self._wco = tuple(m - w*scale if w is not None else c
+                    for m,w,c in zip(self._mpos,wpos,self._wco))
+            return self._ok()
+        if probe:
+            return self._probe(target,scale)
+        if target:
+            return self._move(target,scale)
+        return self._ok()
+
+    def _end(self,start,target,scale):
+        """Machine position a move from start to target words ends at"""
+        wpos = [s - w for s,w in zip(start,self._wco)]
+        end = []
+        for i,axis in enumerate(AXES):
+            if axis not in target:
+                end.append(start[i])
+            elif self._absolute:
+                end.append(target[axis]*scale + self._wco[i])
+            else:
+                end.append(wpos[i] + target[axis]*scale + self._wco[i])
+        return end
+
+    def _move(self,target,scale,jog=False):
+        start = self._planner[-1].end if self._planner else self._mpos
+        end = self._end(start,target,scale)
+        moved = [i for i in range(3) if end[i] != start[i]]
+        if not moved:
+            return self._ok()
+        max_rate = min(self.settings[110+i] for i in moved)
+        accel = min(self.settings[120+i] for i in moved)
+        if self._rapid:
+            feed = None
+        elif not self._feed:
+            return self._error(ERR_UNDEFINED_FEED_RATE)
+        else:
+            feed = self._feed
+        begin = self._planner[-1].finish if self._planner else self._clock
+        self._planner.append(self._block(tuple(start),tuple(end),feed,
+            max_rate,accel,begin,jog))
+        self._ok()
+
+    def _probe(self,target,scale):
+        """G38.2: feed towards target until the probe touches the surface.
+        The line's reply, [PRB:...] and ok, waits for the end of the move"""
+        if not self._feed:
+            return self._error(ERR_UNDEFINED_FEED_RATE)
+        start = self._mpos
+        end = self._end(start,target,scale)
+        touching = lambda p: (self.surface is not None and
+                p[2] <= self.surface(p[0],p[1]))
+        if touching(start):
+            return self._alarm_with(ALARM_PROBE_INITIAL)
+        steps = 1000
+        for k in range(1,steps + 1):
+            contact = tuple(s + (e - s)*k/steps for s,e in zip(start,end))
+            if touching(contact):
+                break
+        else:
+            return self._alarm_with(ALARM_PROBE_FAIL)
+        moved = [i for i in range(3) if contact[i] != start[i]]
+        block = self._block(tuple(start),contact,self._feed,
+                min(self.settings[110+i] for i in moved),
+                min(self.settings[120+i] for i in moved),self._clock)
+        self._planner.append(block)
+        self._pending = (block.finish,'[PRB:{}:1]\r\nok\r\n'.format(
+            self._fmt(contact)))
+
+    def _alarm_with(self,code):
+        self._alarm = True
+        self._reply('ALARM:{}\r\n'.format(code))
+
+    def _block(self,start,end,feed,max_rate,accel,begin,jog=False):
+        """A planner block at the overridden feed (rapids, and jogs, which
+        GRBL doesn't override, go at their own rate)"""
+        if feed is None:
+            rate = max_rate
+        elif jog:
+            rate = min(feed,max_rate)
+        else:
+            rate = min(feed*self._feed_override/100.,max_rate)
+        block = Block(start,end,rate,accel,begin,jog)
+        block.feed = feed
+        block.max_rate = max_rate
+        return block
+
+    def _replan(self):
+        """Retime the queued blocks for a new feed override, with the
+        current one carrying on from where it has got to"""
+        if not self._planner:
+            return
+        first = self._planner[0]
+        start = first.position(self._clock - first.begin)
+        begin = self._clock
+        blocks = list(self._planner)
+        self._planner.clear()
+        for block in blocks:
+            new = self._block(start if block is first else block.start,
+                    block.end,block.feed,block.max_rate,block.accel,begin,
+                    block.jog)
+            self._planner.append(new)
+            begin = new.finish
+
+Serial = GrblSimulator
+
+
+def serve_pty(**kwargs):
+    """Run a simulator behind a pseudo-terminal in a daemon thread. Returns
+    the device name clients should open, and the simulator itself.
+    """
+    import tty
+    import select
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    sim = GrblSimulator(os.ttyname(slave),**kwargs)
+
+    def pump():
+        while sim.is_open:
+            ready, _, _ = select.select([master],[],[],0.005)
+            if ready:
+                sim.write(os.read(master,4096))
+            data = sim.read(4096)
+            if data:
+                os.write(master,data)
+
+    threading.Thread(target=pump,daemon=True).start()
+    return os.ttyname(slave), sim
+
+if __name__ == '__main__':
+    device, sim = serve_pty()
+    print(device)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
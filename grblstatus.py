@@ -0,0 +1,137 @@
+"""Decoder for GRBL 1.1 status reports, eg.
+
+    <Run|MPos:10.000,5.000,0.000|Bf:12,96|FS:500,0|WCO:0.000,0.000,0.000>
+
+Every report is decoded into the same Status object, updating its fields in
+place, so a poll loop allocates little beyond the split strings. GRBL only
+sends WCO every so often, so the last one seen is kept and used to work out
+whichever of MPos/WPos the report left out.
+"""
+
+AXES = 'xyz'
+
+class Status():
+    """ The machine state from the most recent status report """
+    __slots__ = ('state', 'substate', 'mpos', 'wpos', 'wco', 'planner', 'rx',
+            'line', 'feed', 'spindle', 'overrides', 'pins', 'accessories',
+            'positioned', 'reports')
+
+    def __init__(self):
+        self.state = None
+        # eg. 0 for Hold:0, the hold has finished; None if not given
+        self.substate = None
+        self.mpos = [0.]*len(AXES)
+        self.wpos = [0.]*len(AXES)
+        self.wco = [0.]*len(AXES)
+        # free planner blocks and RX buffer bytes (Bf:, if $10 asks for it)
+        self.planner = None
+        self.rx = None
+        # line number being executed (Ln:)
+        self.line = None
+        self.feed = 0.
+        self.spindle = 0.
+        # feed, rapid and spindle override percentages (Ov:)
+        self.overrides = [100, 100, 100]
+        # input pins (Pn:) and accessory state (A:), as given
+        self.pins = ''
+        self.accessories = ''
+        # whether the latest report gave MPos or WPos; if not, the position
+        # is still the one before
+        self.positioned = False
+        self.reports = 0
+
+    def __repr__(self):
+        return '<Status {} MPos:{} WPos:{} WCO:{}>'.format(self.state,
+                self.mpos, self.wpos, self.wco)
+
+    def position(self):
+        """Work position as a dict, as emitted by SerialInfoThread.updated"""
+        w = self.wpos
+        return {'x': w[0], 'y': w[1], 'z': w[2]}
+
+class StatusParser():
+    """ Decodes status reports into self.status.
+
+    parse() returns the Status, or None if the line isn't a status report.
+    A garbled report may leave some fields updated.
+    """
+    def __init__(self):
+        self.status = Status()
+
+    def parse(self, line):
+        line = line.strip()
+        if not (line.startswith('<') and line.endswith('>')):
+            return None
+        st = self.status
+        fields = line[1:-1].split('|')
+        state, _, sub = fields[0].partition(':')
+        st.state = state
+        st.substate = int(sub) if sub.isdigit() else None
+        # fields that are only sent when they aren't zero/empty
+        st.line = None
+        st.pins = ''
+        st.accessories = ''
+        work = None
+        try:
+            # decoded inline, most frequent first: this runs on every poll
+            for field in fields[1:]:
+                name, _, value = field.partition(':')
+                if name == 'WPos':
+                    x, y, z = value.split(',')
+                    a = st.wpos
+                    a[0] = float(x)
+                    a[1] = float(y)
+                    a[2] = float(z)
+                    work = True
+                elif name == 'MPos':
+                    x, y, z = value.split(',')
+                    a = st.mpos
+                    a[0] = float(x)
+                    a[1] = float(y)
+                    a[2] = float(z)
+                    work = False
+                elif name == 'FS':
+                    feed, _, spindle = value.partition(',')
+                    st.feed = float(feed)
+                    st.spindle = float(spindle or 0)
+                elif name == 'Bf':
+                    planner, _, rx = value.partition(',')
+                    st.planner = int(planner)
+                    st.rx = int(rx)
+                elif name == 'WCO':
+                    x, y, z = value.split(',')
+                    a = st.wco
+                    a[0] = float(x)
+                    a[1] = float(y)
+                    a[2] = float(z)
+                elif name == 'Ov':
+                    f, r, sp = value.split(',')
+                    a = st.overrides
+                    a[0] = int(f)
+                    a[1] = int(r)
+                    a[2] = int(sp)
+                elif name == 'F':
+                    st.feed = float(value)
+                elif name == 'Ln':
+                    st.line = int(value)
+                elif name == 'Pn':
+                    st.pins = value
+                elif name == 'A':
+                    st.accessories = value
+        except ValueError:
+            return None
+        st.positioned = work is not None
+        # fill in the position the report didn't give from the cached WCO
+        o = st.wco
+        if work:
+            w, m = st.wpos, st.mpos
+            m[0] = w[0] + o[0]
+            m[1] = w[1] + o[1]
+            m[2] = w[2] + o[2]
+        elif work is not None:
+            m, w = st.mpos, st.wpos
+            w[0] = m[0] - o[0]
+            w[1] = m[1] - o[1]
+            w[2] = m[2] - o[2]
+        st.reports += 1
+        return st
@@ -4,111 +4,35 @@ import threading
 import time
 import re
 import queue
+import zlib
 from PyQt5 import QtCore, QtGui, QtWidgets
 import yaml
 import logging
-import codecs
-import serial
-import serial.tools.list_ports
-import dummySerial
 import touch_o_matic
 import clickanddraw
 from commands import Command, Action
+from controllers import ControllerManager, load_machines, stringdecoder
+from ports import PortScanner
+import metrics
+import importers
+import filejob
+import patterns
+import checkpoint
+import jobserver
+import heightmap
 serial_lock = QtCore.QMutex()
 
-class SerialInfoThread(QtCore.QThread):
-    """ Poll the info command repeatedly, and emit its result as a signal """
-
-    # signals
-    commandSent = QtCore.pyqtSignal(Command)
-    updated = QtCore.pyqtSignal(dict)
-    responseReceived = QtCore.pyqtSignal(str)
-
-    def __init__(self, parent, ser_dev, info, interval=100):
-        super(QtCore.QThread,self).__init__(parent)
-        self.ser = ser_dev
-        self.info_cmd = bytes(info['command'],'ascii')
-        self.regex = re.compile(info['regex'])
-        self.order = info['order']
-        self.interval = interval #interval to poll in ms
-        self.tQ = queue.Queue()
-        self._delta = 0
-        self._last_pos = {'x':0,'y':0,'z':0}
-        
-
-    def run(self):
-        #self.setPriority(self.HighPriority)
-        while True:
-            # ping the machine's position
-            self.ping()
-            # send a command if we have one in the pipeline
-            self.send_command()
-            time.sleep(self.interval/1000.)
-
-    def send_command(self):
-        if self.tQ.empty() or (
-                self._delta > 1e-5 and not self._peek().instant):
-            return
-        cmd = self.tQ.get()
-        message = cmd.text
-        self.ser.write(bytes(message+'\r\n','ascii'))
-        cmd.pos = self._last_pos
-        self.commandSent.emit(cmd)
-        if cmd.response:
-            # will block until response is recieved
-            self.responseReceived.emit(self.ser.readline().strip().decode('ascii'))
-
-    def ping(self):
-        self.ser.flushInput()
-        self.ser.flushOutput()
-        self.ser.write(self.info_cmd)
-        result = self.ser.readline().strip().decode('ascii')
-        self.parse_position(result)
-
-    def parse_position(self,position):
-        match = re.search(self.regex,position)
-        out = {'x':None, 'y':None, 'z':None}
-        if match:
-            self._delta = 0
-            for coord in 'xyz':
-                out[coord] = float(match.groups()[self.order.index(coord)])
-                # compute the squared distance travelled since the last ping
-                self._delta += (out[coord]-self._last_pos[coord])**2
-            self._last_pos = out
-            self.updated.emit(out)
-            return True
-
-    def _peek(self):
-        return self.tQ.queue[0]
-
-    def clear(self):
-        while not self.tQ.empty():
-            self.tQ.get()
-
-    def enqueue(self,items):
-        try:
-            [self.tQ.put(item) for item in items]
-        except:
-            self.tQ.put(items)
-
-def stringdecoder(function):
-    """Wrapper for functions that return a dictionary. Converts the dictionary
-    returned by the function into a dictionary-like object that has all the
-    unicode escape sequences (eg. '\\n') in its string values converted into the 
-    appropriate ascii bytes, and all its other keys unchanged
-    """
-    class __stringdecoder():
-        def __init__(self,dic):
-            self._dict = dic
-        def __getitem__(self,item):
-            if isinstance(self._dict[item],str):
-                return codecs.decode(self._dict[item],'unicode_escape')
-            return self._dict[item]
-
-    def wrapper(self,*args,**kwargs):
-        return __stringdecoder(function(self,*args,**kwargs))
-
-    return wrapper
+TEST_PORT = "Test Port (software only)"
+# ms of motion in each jog segment, and between sending them, while a jog
+# button or arrow key is held
+JOG_REFRESH = 50
+# arrow key: axis, direction
+ARROW_JOGS = {
+    QtCore.Qt.Key_Up:('y',1),
+    QtCore.Qt.Key_Down:('y',-1),
+    QtCore.Qt.Key_Right:('x',1),
+    QtCore.Qt.Key_Left:('x',-1),
+}
 
 class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
     def __init__(self,parent = None):
@@ -117,8 +41,14 @@ class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
         
         # Connection Menu
         self.ser = None
+        self.ser_info = None
+        # the selected machine; scans run on it keep their own state
+        self.controller = None
+        self.controllers = ControllerManager(self)
+        self.controllers.statusChanged.connect(self.showMachineStatus)
         self._add_serial_devices()
         self.serialConnect.clicked.connect(self.connect)
+        self.serialPort.currentTextChanged.connect(self.selectController)
 
         # Controls Menu
         self.startScan.clicked.connect(self.startScanning)
@@ -127,6 +57,8 @@ class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
         self.setHome.clicked.connect(self.setNewHome)
         self.goHome.clicked.connect(self.moveToHome)
         self.emergencyStop.clicked.connect(self.emergencyStopScanning)
+        self._setupResume()
+        self._setupProbing()
 
 
         # Manual control
@@ -136,37 +68,357 @@ class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
         self.xMinus.clicked.connect(self.stepxMinus)
         self.directCommand.returnPressed.connect(self.sendDirect)
         self.sendDirectCommand.clicked.connect(self.sendDirect)
-
-        # Scan timer initial value
-        self.scanTimer = QtCore.QTimer(self)
-        self.scanTimer.timeout.connect(self.sendScanCommand)
-        self.scanTimer.setSingleShot(False)
+        self._setupJogging()
+        self._setupFeedOverride()
+        self._setupFileJobs()
+        self._setupJobServer()
 
         # Buttons that can only be used while connected
         self.cmdButtons = [self.startScan, self.stopScan, self.emergencyStop,
                 self.goHome, self.setHome, self.yPlus, self.yMinus, self.xPlus, 
-                self.xMinus, self.startCustom, self.stopCustom]
+                self.xMinus, self.startCustom, self.stopCustom, self.runFile,
+                self.resumeScan, self.probeSurface] + self.feedOverrideButtons
 
         # Widgets for free draw
         self._setupGraphics()
+        self._setupCoverage()
+
+        # Serial engine metrics
+        self._setupDiagnostics()
 
         # List of known CNC machines
         self._readMachineInfo()
 
         # misc state variables
-        self._scanning = False
         self._selected = []
 
     def sendDirect(self):
         self.ser_info.enqueue(Command(self.directCommand.text(),response=True))
 
-    def _add_serial_devices(self):
-        ports = serial.tools.list_ports.comports()
-        good_ports = [p[0] for p in ports if p[2] != 'n/a']
-        if good_ports:
-            self.serialPort.addItems(good_ports)
+    def _setupResume(self):
+        self.resumeScan = QtWidgets.QPushButton("Resume Scan",self.groupBox_4)
+        self.resumeScan.setEnabled(False)
+        self.resumeScan.setToolTip("Carry on with the last scan on this "
+                "machine from the last waypoint it completed")
+        self.resumeScan.clicked.connect(self.resumeScanning)
+        # above the spacer at the bottom of the column
+        spacer = self.gridLayout_7.itemAtPosition(4,0)
+        self.gridLayout_7.removeItem(spacer)
+        self.gridLayout_7.addWidget(self.resumeScan,4,0,1,1)
+        self.gridLayout_7.addItem(spacer,5,0,1,1)
+
+    def _setupProbing(self):
+        # Height map of an uneven specimen, followed by scans in Z
+        self.heightMap = None
+        self._probing = None
+        self.probeSurface = QtWidgets.QPushButton("Probe Height Map",
+                self.groupBox_4)
+        self.probeSurface.setEnabled(False)
+        self.probeSurface.setToolTip("Probe the surface over the whole area, "
+                "with the work zero set on the surface at the origin")
+        self.probeSurface.clicked.connect(self.probeHeightMap)
+        self.compensateZ = QtWidgets.QCheckBox("Follow height map",
+                self.groupBox_4)
+        self.compensateZ.setEnabled(False)
+        self.compensateZ.setToolTip("Raise and lower scans by the probed "
+                "height of the surface under each waypoint")
+        spacer = self.gridLayout_7.itemAtPosition(5,0)
+        self.gridLayout_7.removeItem(spacer)
+        self.gridLayout_7.addWidget(self.probeSurface,5,0,1,1)
+        self.gridLayout_7.addWidget(self.compensateZ,6,0,1,1)
+        self.gridLayout_7.addItem(spacer,7,0,1,1)
+
+    def _setupJogging(self):
+        # Continuous jogging: move while a button or arrow key is held
+        self.continuousJog = QtWidgets.QCheckBox("Hold to jog",self.groupBox_6)
+        self.continuousJog.setToolTip("Jog at the speed below while an "
+                "arrow button is held down. Arrow keys always jog.")
+        self.verticalLayout_3.addWidget(self.continuousJog)
+        for button, axis, sign in ((self.xPlus,'x',1),(self.xMinus,'x',-1),
+                (self.yPlus,'y',1),(self.yMinus,'y',-1)):
+            button.pressed.connect(
+                    lambda a=axis, s=sign: self._jogButton(a,s))
+            button.released.connect(self._jogButtonReleased)
+        self._jog = None
+        self.jogTimer = QtCore.QTimer(self)
+        self.jogTimer.setInterval(JOG_REFRESH)
+        self.jogTimer.timeout.connect(self._sendJog)
+        QtWidgets.QApplication.instance().installEventFilter(self)
+
+    def _jogButton(self,axis,sign):
+        if self.continuousJog.isChecked():
+            self.startJog(axis,sign)
+
+    def _jogButtonReleased(self):
+        if self.continuousJog.isChecked():
+            self.stopJog()
+
+    def _arrowJogs(self):
+        """Whether arrow keys should jog rather than go to the focus widget"""
+        focus = QtWidgets.QApplication.focusWidget()
+        return (self.ser_info is not None and self.isActiveWindow() and
+                self.tabWidget.currentWidget() is self.basicTab and
+                not isinstance(focus,(QtWidgets.QLineEdit,
+                    QtWidgets.QAbstractSpinBox,QtWidgets.QPlainTextEdit)))
+
+    def eventFilter(self,obj,event):
+        if event.type() in (QtCore.QEvent.KeyPress,QtCore.QEvent.KeyRelease
+                ) and event.key() in ARROW_JOGS and self._arrowJogs():
+            if not event.isAutoRepeat():
+                if event.type() == QtCore.QEvent.KeyPress:
+                    self.startJog(*ARROW_JOGS[event.key()])
+                elif self._jog == ARROW_JOGS[event.key()]:
+                    self.stopJog()
+            return True
+        return super(TouchOMaticApp,self).eventFilter(obj,event)
+
+    def startJog(self,axis,sign):
+        """Jog along axis until stopJog(), at the manual speed"""
+        if self.ser_info is None or self._jog is not None:
+            return
+        if not self.machine['instructions'].get('jog'):
+            self.commandLog.appendPlainText(
+                    "{} has no jog instructions.".format(self.machine['name']))
+            return
+        self._jog = (axis,sign)
+        # one segment ahead, so a late timer tick doesn't starve the planner
+        self._sendJog()
+        self._sendJog()
+        self.jogTimer.start()
+
+    def _sendJog(self):
+        axis, sign = self._jog
+        feed = self.speedBox.value()
+        distance = sign*feed/60.*JOG_REFRESH/1000.
+        self.ser_info.jog(self.scaled('jog',axis).format(
+            v=feed,**{axis:distance}))
+
+    def stopJog(self):
+        if self._jog is None:
+            return
+        self.jogTimer.stop()
+        self._jog = None
+        self.ser_info.jog_cancel()
+
+    def _setupFeedOverride(self):
+        # Live feed override, and the value the controller reports back
+        label = QtWidgets.QLabel("Feed Override:",self.groupBox_7)
+        self.gridLayout_9.addWidget(label,2,0,1,1)
+        self.feedOverrideValue = QtWidgets.QLabel("100%",self.groupBox_7)
+        self.feedOverrideValue.setAlignment(QtCore.Qt.AlignRight|
+                QtCore.Qt.AlignTrailing|QtCore.Qt.AlignVCenter)
+        self.gridLayout_9.addWidget(self.feedOverrideValue,2,1,1,1)
+        # put the buttons above the spacer at the bottom of the group
+        spacer = self.gridLayout_9.itemAtPosition(3,0)
+        self.gridLayout_9.removeItem(spacer)
+        buttons = QtWidgets.QHBoxLayout()
+        self.feedOverrideButtons = []
+        for text, step in (("-10","-10"),("-1","-1"),("100%","reset"),
+                ("+1","+1"),("+10","+10")):
+            button = QtWidgets.QToolButton(self.groupBox_7)
+            button.setText(text)
+            button.setEnabled(False)
+            button.clicked.connect(
+                    lambda checked, s=step: self.ser_info.override_feed(s))
+            buttons.addWidget(button)
+            self.feedOverrideButtons.append(button)
+        self.gridLayout_9.addLayout(buttons,3,0,1,2)
+        self.gridLayout_9.addItem(spacer,4,0,1,1)
+
+    def showFeedOverride(self,pos):
+        self.feedOverrideValue.setText(
+                '{}%'.format(self.ser_info.status.overrides[0]))
+
+    def _setupFileJobs(self):
+        self.runFile = QtWidgets.QPushButton("Run File...",self.groupBox_5)
+        self.runFile.setEnabled(False)
+        self.runFile.clicked.connect(self.runGcodeFile)
+        self.horizontalLayout_7.addWidget(self.runFile)
+        self.jobProgress = QtWidgets.QProgressBar(self.groupBox_5)
+        self.jobProgress.setRange(0,1000)
+        self.jobProgress.hide()
+        self.verticalLayout_6.addWidget(self.jobProgress)
+
+    def runGcodeFile(self):
+        """Stream a G-code file produced elsewhere straight from disk"""
+        if self.controller.busy():
+            self.commandLog.appendPlainText("Already running.")
+            return
+        path, _ = QtWidgets.QFileDialog.getOpenFileName(self,"Run G-code File",
+                filter="G-code files (*.nc *.gcode *.ngc *.tap);;All files (*)")
+        if not path:
+            return
+        job = filejob.GcodeFile(path)
+        if not self.ser_info.stream(job):
+            self.commandLog.appendPlainText("Already running.")
+            return
+        self.commandLog.appendPlainText("Streaming {} ({} bytes)".format(
+            path,job.size))
+        self.jobProgress.setValue(0)
+        self.jobProgress.show()
+
+    def _setupJobServer(self):
+        self.jobServer = None
+        self._jobs = {}
+        if not jobserver.SOCKET_PATH:
+            return
+        self.jobServer = jobserver.JobServer(self.controllers,self)
+        if not self.jobServer.start():
+            logging.warning("Can't listen on %s",jobserver.SOCKET_PATH)
+            self.jobServer = None
+
+    def _jobController(self,port):
+        """The machine a job server request is for. The window's selection
+        is left alone, so the operator's controls stay on their machine."""
+        if port is None:
+            port = self.serialPort.currentText()
+        if port not in self.controllers:
+            raise ValueError("{} is not connected".format(port))
+        return self.controllers[port]
+
+    def submitJob(self,path,port=None):
+        """Run a saved scan path, or stream a G-code file, once"""
+        controller = self._jobController(port)
+        port = controller.port
+        if controller.busy():
+            raise ValueError("{} is already running a job".format(port))
+        if os.path.splitext(path)[1].lower() in filejob.EXTENSIONS:
+            job = filejob.GcodeFile(path)
+            if not controller.thread.stream(job):
+                raise ValueError("{} is already running a job".format(port))
+            self.commandLog.appendPlainText(
+                    "Streaming {} on {} ({} bytes)".format(path,port,job.size))
+            return {"port":port,"bytes":job.size}
+        if path.endswith('.yaml'):
+            waypoints = importers.load_saved(path)
         else:
-            self.serialPort.addItems(["Test Port (software only)"])
+            waypoints = importers.load(path,controller.machine)
+        waypoints = [dict(x=wp['x'],y=wp['y'],z=wp.get('z') or 0,
+                v=wp.get('v'),action=wp.get('action')) for wp in waypoints]
+        commands = self._compileWaypoints(waypoints,controller=controller)
+        scan = 'job:' + self._scanName(True,commands).split(':')[1]
+        self._jobs[port] = (commands,scan)
+        self.commandLog.appendPlainText("Running {} on {} ({} waypoints)"
+                .format(path,port,len(waypoints)))
+        controller.start_scan(commands,scan)
+        return {"port":port,"scan":scan,"commands":len(commands)}
+
+    def stopJob(self,port=None):
+        controller = self._jobController(port)
+        self.commandLog.appendPlainText("Stopping scan on {}.".format(
+            controller.port))
+        controller.stop_scan()
+        return {"port":controller.port}
+
+    def resumeJob(self,port=None):
+        """Resume a submitted job from its checkpoint, or else the scan"""
+        controller = self._jobController(port)
+        port = controller.port
+        if controller.busy():
+            raise ValueError("{} is already running a job".format(port))
+        last = checkpoint.load(checkpoint.path_for(port))
+        if last is None:
+            raise ValueError("no interrupted job on {}".format(port))
+        if not last['scan'].startswith('job:'):
+            # the scan's path is whatever the window shows for its machine
+            if controller is not self.controller:
+                raise ValueError("the interrupted scan on {} can only be "
+                        "resumed while it is selected".format(port))
+            self.resumeScanning()
+            return {"port":port,"scan":last['scan']}
+        commands, scan = self._jobs.get(port,(None,None))
+        if scan != last['scan']:
+            raise ValueError("the interrupted job wasn't submitted to this "
+                    "session, so it can't be resumed")
+        controller.start_scan(commands,scan,
+                resume=(last['pass'],last['index']))
+        return {"port":port,"scan":scan,"index":last['index']}
+
+    def showJobProgress(self,offset,size):
+        self.jobProgress.setValue(offset*1000//size if size else 1000)
+
+    def jobFinished(self,complete):
+        self.jobProgress.hide()
+        if self._probing is not None:
+            self._finishProbing(complete)
+            return
+        self.commandLog.appendPlainText(
+                "File finished." if complete else "File stopped.")
+
+    def probeHeightMap(self):
+        """Probe the surface on a grid over the machine's dimensions"""
+        if not self.machine['instructions'].get('probe'):
+            self.commandLog.appendPlainText(
+                    "This machine has no probe instructions.")
+            return
+        if self.controller.busy():
+            self.commandLog.appendPlainText("Already running.")
+            return
+        settings = self.machine.get('probe') or {}
+        dims = self.machine['dimensions']
+        xs, ys = heightmap.grid(dims['x-axis'],dims['y-axis'],
+                settings.get('spacing') or dims['grid-size'])
+        templates = dict((key,self._scaled_key(self.instructions['probe'],
+            key)) for key in ('travel-z','travel','probe'))
+        job = heightmap.ProbeJob(heightmap.probe_order(xs,ys),templates,
+                settings.get('clearance',5),settings.get('depth',20),
+                settings.get('feed',100))
+        if not self.ser_info.stream(job):
+            self.commandLog.appendPlainText("Already running.")
+            return
+        self._probing = (xs,ys,[])
+        self.commandLog.appendPlainText("Probing {} points.".format(
+            len(xs)*len(ys)))
+        self.jobProgress.setValue(0)
+        self.jobProgress.show()
+
+    def handleProbeResponse(self,text):
+        if self._probing is None:
+            return
+        z = heightmap.parse_probe(text)
+        if z is not None:
+            self._probing[2].append(z)
+
+    def _finishProbing(self,complete):
+        xs, ys, heights = self._probing
+        self._probing = None
+        if not complete or len(heights) != len(xs)*len(ys):
+            self.commandLog.appendPlainText("Probing stopped after {} of {} "
+                    "points; the height map is unchanged.".format(
+                        len(heights),len(xs)*len(ys)))
+            return
+        self.heightMap = heightmap.HeightMap.from_probes(xs,ys,heights)
+        self.heightMap.save(heightmap.path_for(self.serialPort.currentText()))
+        self.compensateZ.setEnabled(True)
+        self.compensateZ.setChecked(True)
+        self.commandLog.appendPlainText("Height map done: the surface is "
+                "{:.2f} to {:.2f} {} from the origin.".format(
+                    self.heightMap.z.min(),self.heightMap.z.max(),
+                    self.machine['units']))
+
+    def _add_serial_devices(self):
+        # Ports are found in the background so the window isn't held up by
+        # the sysfs scan; offer the software port until something shows up
+        self.serialPort.addItem(TEST_PORT)
+        self.portScanner = PortScanner(self)
+        self.portScanner.portsChanged.connect(self._update_serial_devices)
+        self.portScanner.start()
+
+    def _update_serial_devices(self,added,removed):
+        for port in removed:
+            idx = self.serialPort.findText(port)
+            # keep the entry of a machine that is still connected
+            if idx >= 0 and port not in self.controllers:
+                self.serialPort.removeItem(idx)
+        for port in added:
+            if self.serialPort.findText(port) < 0:
+                self.serialPort.addItem(port)
+        test = self.serialPort.findText(TEST_PORT)
+        if self.portScanner.ports and test >= 0 and (
+                TEST_PORT not in self.controllers):
+            self.serialPort.removeItem(test)
+        elif not self.portScanner.ports and test < 0:
+            self.serialPort.addItem(TEST_PORT)
 
     @property
     def machine(self):
@@ -183,12 +435,12 @@ class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
         return self.machine['dimensions']
 
  
-    def _scaled_key(self,dic,key):
+    def _scaled_key(self,dic,key,machine=None):
         """Another awful meta class that replaces the string formatting
         function with one that multiplies numeric values by a scale factor
         """
         try:
-            scale = self.machine['scale-factor']
+            scale = (machine or self.machine)['scale-factor']
         except:
             scale = dict(x=1,y=1,z=1)
         
@@ -205,21 +457,13 @@ class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
 
         return _keyscaler(string,scale)
 
-    def scaled(self,key1,key2):
-        return self._scaled_key(self.instructions[key1],key2)
+    def scaled(self,key1,key2,machine=None):
+        if machine is None:
+            return self._scaled_key(self.instructions[key1],key2)
+        return self._scaled_key(machine['instructions'][key1],key2,machine)
 
     def _readMachineInfo(self):
-        config_dir = os.path.join(os.path.split(__file__)[0],"config")
-        yamls = [y for y in os.listdir(config_dir) if y.endswith('.yaml')]
-        self.machines = {}
-        for yam in yamls:
-            yam = os.path.join(config_dir,yam)
-            with open(yam) as y:
-                try:
-                    data = yaml.safe_load(y)
-                    self.machines[data['name']] = data
-                except:
-                    logging.warning("Failed to parse config file {}".format(yam))
+        self.machines = load_machines()
 
         for i,name in enumerate(sorted(self.machines.keys())):
             self.cncSelect.addItem(name)
@@ -234,6 +478,13 @@ class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
         self.secondary_units.setText(self.machine['units'])
         self.manual_units.setText(self.machine['units'])
         self.yLengthValue.setValue(self.machine['dimensions']['y-axis'])
+        coverage = self.machine.get('coverage') or {}
+        self.coverStep.setValue(coverage.get('step-over',
+            self.machine['dimensions']['grid-size']))
+        self.coverStep.setSuffix(' ' + self.machine['units'])
+        self.captureSpacing.setSuffix(' ' + self.machine['units'])
+        self._coverMargin = coverage.get('margin',0)
+        self._coverRaster = coverage.get('raster',False)
 
     def _setupGraphics(self):
         # Add View to GUI
@@ -257,9 +508,57 @@ class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
         # Z position / Velocity positons
         self.zSlider.valueChanged.connect(self.changeZ)
         self.vSlider.valueChanged.connect(self.changeV)
+        # while a slider is held its changes wait for it to be let go
+        self._edits = None
+        for slider in (self.zSlider, self.vSlider):
+            slider.sliderPressed.connect(self.beginEdit)
+            slider.sliderReleased.connect(self.commitEdit)
         # Mouse drag
         self.freeDrawView.mousedrag.connect(self._update_wpos)
 
+    def _setupCoverage(self):
+        # Standard scans can sweep the whole area instead of one line
+        self.coverArea = QtWidgets.QCheckBox("Cover area",self.groupBox_3)
+        self.coverArea.setToolTip("Sweep the primary axis in passes across "
+                "the secondary axis, from 0 to the position above")
+        self.gridLayout_4.addWidget(self.coverArea,2,0,1,2)
+        self.coverStepLabel = QtWidgets.QLabel("Step-over:",self.groupBox_3)
+        self.gridLayout_4.addWidget(self.coverStepLabel,3,0,1,1)
+        self.coverStep = QtWidgets.QSpinBox(self.groupBox_3)
+        self.coverStep.setRange(1,1000)
+        self.gridLayout_4.addWidget(self.coverStep,3,1,1,1)
+        # ... or load the same path into the drawing for editing
+        self.coverCustom = QtWidgets.QToolButton(self.customTab)
+        self.coverCustom.setText("Cover")
+        self.coverCustom.setToolTip("Append an area coverage path")
+        self.coverCustom.clicked.connect(self.loadCoverage)
+        self.gridLayout_13.addWidget(self.coverCustom,2,0,1,1)
+        # photos spaced along the drawn path when it is scanned
+        self.captureSpacing = QtWidgets.QSpinBox(self.customTab)
+        self.captureSpacing.setRange(0,10000)
+        self.captureSpacing.setPrefix("Photo every ")
+        self.captureSpacing.setSpecialValueText("No spaced photos")
+        self.captureSpacing.setToolTip("Take a photo at this spacing along "
+                "the path: on the move if the machine's photo-on-the-move "
+                "is set, otherwise stopping at waypoints added where none "
+                "is in place")
+        self.gridLayout_13.addWidget(self.captureSpacing,3,0,1,1)
+
+    def coveragePath(self):
+        """Vertices of the area coverage path for the current settings"""
+        return patterns.coverage(self.yLengthValue.value(),
+                self.xLengthValue.value(),self.coverStep.value(),
+                primary=self.machine.get('primary-axis','y'),
+                margin=self._coverMargin,boustrophedon=not self._coverRaster)
+
+    def loadCoverage(self):
+        xy = self.coveragePath()
+        if not xy[0].any():
+            # the drawing already starts at the origin
+            xy = xy[1:]
+        self.freeDrawView.loadWaypoints(patterns.to_waypoints(xy,
+            v=self.machine['default-speed']))
+
     def _fmtWaypointList(self,idxs):
         pass
 
@@ -271,12 +570,15 @@ class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
 
     def showWaypointInfo(self):
         if len(self.freeDrawView.scene.selectedItems()):
-            # find the index of the added item (inefficient)
             selected = self.freeDrawView.scene.selectedItems()
             self._selected = selected
-            idxs = set(self.freeDrawView.waypointIndex(s)for s in selected)
-            min_idx = min(idxs)
-            max_idx = max(idxs)
+            idxs = self.freeDrawView.waypointIndices(selected)
+            min_idx = idxs[0]
+            max_idx = idxs[-1]
+            # the controls follow the selection without editing it
+            controls = (self.zSlider, self.vSlider, self.actionBox)
+            for control in controls:
+                control.blockSignals(True)
             if len(selected) == 1:
                 self.waypointLabel.setText("Waypoint {}".format(min_idx))
                 self._waypoint, = selected
@@ -293,16 +595,17 @@ class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
                         self.actionBox.findData(info['action']))
             else:
                 self.waypointLabel.setText("Waypoints {}-{}".format(min_idx,max_idx))
-                xs = [int(w.info['x']) for w in self._selected]
-                ys = [int(w.info['y']) for w in self._selected]
-                zs = [int(w.info['z']) for w in self._selected]
-                vs = [int(w.info['v']) for w in self._selected]
-                actions = [w.info['action'] for w in self._selected]
+                infos = [w.info for w in self._selected]
+                xs = [int(i['x']) for i in infos]
+                ys = [int(i['y']) for i in infos]
+                zs = [int(i['z']) for i in infos]
+                vs = [int(i['v']) for i in infos]
+                actions = [i['action'] for i in infos]
 
                 x = int(xs[0]/self.machine['units-scale']) if len(set(xs)) == 1 else '--'
                 y = int(ys[0]/self.machine['units-scale']) if len(set(ys)) == 1 else '--'
                 z = int(zs[0]/self.machine['units-scale']) if len(set(zs)) == 1 else '--'
-                v = '{:.1f}'.format(vs[0]/self.machine['speed-scale']) if len(set(zs)) == 1 else '--'
+                v = '{:.1f}'.format(vs[0]/self.machine['speed-scale']) if len(set(vs)) == 1 else '--'
                 self.wPos.setText('({},{},{})'.format(x,y,z))
                 self.vVal.setText('{}'.format(v))
                 if len(set(actions)) == 1:
@@ -310,6 +613,8 @@ class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
                             self.actionBox.findData(actions[0]))
                 else:
                     self.actionBox.setCurrentText("--")
+            for control in controls:
+                control.blockSignals(False)
         else:
             self.waypointLabel.setText("Waypoint --")
             self.wPos.setText('(--,--,--)')
@@ -320,17 +625,78 @@ class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
         for wp in self._selected:
             wp.setAction(value)
 
+    def beginEdit(self):
+        """Hold slider changes to the selection until commitEdit()"""
+        self._edits = {}
+
+    def commitEdit(self):
+        """Apply the held changes to the whole selection at once, then
+        refresh the info panel"""
+        edits, self._edits = self._edits or {}, None
+        if 'z' in edits:
+            self.freeDrawView.scene.setPointsZ(self._selected,edits['z'])
+        if 'v' in edits:
+            for waypoint in self._selected:
+                waypoint.v = edits['v']
+        if edits:
+            self.showWaypointInfo()
+
+    def _edit(self,field,value):
+        if self._edits is None:
+            # a key press or click on the slider, applied straight away
+            self._edits = {field:value}
+            self.commitEdit()
+        else:
+            self._edits[field] = value
 
     def changeZ(self,value):
-        for waypoint in self._selected:
-            waypoint.setZ(value)
-        self.showWaypointInfo()
+        self._edit('z',value)
 
     def changeV(self,value):
-        for waypoint in self._selected:
-            waypoint.v = value
-        self.showWaypointInfo()
-
+        self._edit('v',value)
+        self.vVal.setText('{:.1f}'.format(value/self.machine['speed-scale']))
+
+
+    def _setupDiagnostics(self):
+        self.diagnosticsTab = QtWidgets.QWidget()
+        layout = QtWidgets.QVBoxLayout(self.diagnosticsTab)
+        self.diagnosticsText = QtWidgets.QPlainTextEdit(self.diagnosticsTab)
+        self.diagnosticsText.setReadOnly(True)
+        self.diagnosticsText.setFont(QtGui.QFontDatabase.systemFont(
+            QtGui.QFontDatabase.FixedFont))
+        layout.addWidget(self.diagnosticsText)
+        buttons = QtWidgets.QHBoxLayout()
+        buttons.addStretch()
+        self.exportMetrics = QtWidgets.QPushButton("Export Metrics...",
+                self.diagnosticsTab)
+        self.exportMetrics.clicked.connect(self.exportMetricsFile)
+        buttons.addWidget(self.exportMetrics)
+        layout.addLayout(buttons)
+        self.tabWidget.addTab(self.diagnosticsTab,"Diagnostics")
+        # Also keep a metrics file up to date, if asked to (eg. for a
+        # node_exporter textfile collector)
+        self.metricsFile = os.environ.get('TOUCH_O_MATIC_METRICS')
+        self.diagnosticsTimer = QtCore.QTimer(self)
+        self.diagnosticsTimer.timeout.connect(self.refreshDiagnostics)
+        self.diagnosticsTimer.start(1000)
+
+    def refreshDiagnostics(self):
+        registries = [c.thread.metrics for c in self.controllers]
+        if self.metricsFile:
+            metrics.write(self.metricsFile,registries)
+        if self.tabWidget.currentWidget() is not self.diagnosticsTab:
+            return
+        lines = []
+        for controller in self.controllers:
+            lines.append('{} ({})'.format(controller.port,controller.name))
+            lines.extend('  ' + l for l in controller.thread.metrics.summary())
+        self.diagnosticsText.setPlainText('\n'.join(lines) or "Not connected")
+
+    def exportMetricsFile(self):
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(self,"Export Metrics",
+                filter="Prometheus metrics (*.prom)")
+        if path:
+            metrics.write(path,[c.thread.metrics for c in self.controllers])
 
     def saveCustomFile(self):
         to_save = QtWidgets.QFileDialog.getSaveFileName(self,"Save Scan Path",
@@ -342,49 +708,97 @@ class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
          
     def loadCustomFile(self):
         to_load = QtWidgets.QFileDialog.getOpenFileName(self,"Load Scan Path",
-                filter="YAML files (*.yaml)")
-        if to_load:
-            with open(to_load[0]) as tl:
-                info = yaml.load(tl.read())
-                self.freeDrawView.loadWaypointsInfo(info)
+                filter="Scan paths (*.yaml {});;YAML files (*.yaml)".format(
+                    ' '.join('*' + ext for ext in importers.IMPORTERS)))
+        if not to_load[0]:
+            return
+        if to_load[0].endswith('.yaml'):
+            try:
+                info = importers.load_saved(to_load[0])
+            except (OSError, ValueError) as e:
+                self.commandLog.appendPlainText(
+                        "Can't load {}: {}".format(to_load[0],e))
+                return
+            self.freeDrawView.loadWaypointsInfo(info)
+        else:
+            self.freeDrawView.loadWaypoints(
+                    importers.load(to_load[0],self.machine))
 
     def connect(self):
-        try:
-            self.ser = serial.Serial(self.serialPort.currentText(),
-                    self.baudRateValue.value())
-        except:
-            self.ser = dummySerial.Serial(self.serialPort.currentText(),
-                    self.baudRateValue.value())
-
-        self.ser_info = SerialInfoThread(self,self.ser,
-                self.instructions['info'])
-
-        self.ser_info.updated.connect(self.moveMachineMarker)
-        self.ser_info.commandSent.connect(self.handleCommand)
-        self.ser_info.responseReceived.connect(self.commandLog.appendPlainText)
-        self.ser_info.start()
+        port = self.serialPort.currentText()
+        if port in self.controllers:
+            self.commandLog.appendPlainText(
+                    "Already connected to {}".format(port))
+            self.selectController(port)
+            return
+        self.controllers.open(port,self.baudRateValue.value(),self.machine)
+        self.selectController(port)
 
         self.commandLog.appendPlainText(
                 "Connected to {} at baudrate {}"
-                .format(self.serialPort.currentText(), self.baudRateValue.value()))
+                .format(port, self.baudRateValue.value()))
 
-        self.configure()
         for button in self.cmdButtons:
              button.setEnabled(True)
 
-    def configure(self):
-        """Set initial machine variables that won't need to be modified during
-        runtime"""
-        connect_command = Command(self.instructions['connect'])
-        scale_commands = [Command(c) for c in self.machine['scale'].values()]
-        invert_commands = [Command(c) for c in self.machine['invert'].values()]
-        self.ser_info.enqueue(connect_command)
-        self.ser_info.enqueue(scale_commands)
-        self.ser_info.enqueue(invert_commands)
-
+    def selectController(self,port):
+        """Point the controls and the machine marker at the machine on port"""
+        if port not in self.controllers:
+            return
+        if self.ser_info:
+            self.ser_info.updated.disconnect(self.moveMachineMarker)
+            self.ser_info.commandSent.disconnect(self.handleCommand)
+            self.ser_info.responseReceived.disconnect(
+                    self.commandLog.appendPlainText)
+            self.ser_info.realtimeSent.disconnect(self.handleRealtime)
+            self.ser_info.jobProgress.disconnect(self.showJobProgress)
+            self.ser_info.jobFinished.disconnect(self.jobFinished)
+            self.ser_info.actionFinished.disconnect(self.handleActionFinished)
+            self.ser_info.updated.disconnect(self.showFeedOverride)
+            self.ser_info.responseReceived.disconnect(
+                    self.handleProbeResponse)
+        controller = self.controllers[port]
+        self.controller = controller
+        self.ser = controller.ser
+        self.ser_info = controller.thread
+        self.ser_info.updated.connect(self.moveMachineMarker)
+        self.ser_info.commandSent.connect(self.handleCommand)
+        self.ser_info.responseReceived.connect(self.commandLog.appendPlainText)
+        self.ser_info.realtimeSent.connect(self.handleRealtime)
+        self.ser_info.jobProgress.connect(self.showJobProgress)
+        self.ser_info.jobFinished.connect(self.jobFinished)
+        self.ser_info.actionFinished.connect(self.handleActionFinished)
+        self.ser_info.updated.connect(self.showFeedOverride)
+        self.ser_info.responseReceived.connect(self.handleProbeResponse)
+        self.heightMap = heightmap.load(heightmap.path_for(port))
+        self.compensateZ.setEnabled(self.heightMap is not None)
+        self.compensateZ.setChecked(self.heightMap is not None)
+        self.cncSelect.setCurrentText(controller.name)
+
+    def showMachineStatus(self,port,status):
+        """Summarise every connected machine in the status bar"""
+        def fmt(p):
+            return '--' if p is None else '{:.0f}'.format(p)
+        parts = []
+        for port, st in sorted(status.items()):
+            pos = st['pos']
+            parts.append('{} {} ({},{},{}) q={}'.format(port, st['machine'],
+                fmt(pos['x']), fmt(pos['y']), fmt(pos['z']), st['queued']))
+        self.statusbar.showMessage(' | '.join(parts))
+
+    def closeEvent(self,event):
+        self.stopJog()
+        if self.jobServer:
+            self.jobServer.close()
+        self.portScanner.stop()
+        self.controllers.closeAll()
+        super(TouchOMaticApp,self).closeEvent(event)
 
     def handleCommand(self,cmd):
         if cmd.sequence is None:
+            if cmd.text.startswith('$J='):
+                # too many to be worth logging
+                return
             # Don't do anything special for commands that aren't part of a sequence
             self.commandLog.appendPlainText('--> {}'.format(cmd.text))
             return
@@ -397,6 +811,18 @@ class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
             self.commandLog.appendPlainText(
                     '{:2d}> {}'.format(cmd.sequence,cmd.text))
 
+    def handleActionFinished(self,cmd,ok,seconds):
+        if cmd.late:
+            self.commandLog.appendPlainText('   && {} skipped: the last one '
+                    'was still being taken'.format(cmd.action))
+            return
+        self.commandLog.appendPlainText('   && {} {} ({:.2f} s)'.format(
+            cmd.action,'done' if ok else 'FAILED',seconds))
+
+    def handleRealtime(self,data,latency):
+        self.commandLog.appendPlainText('!-> {!r} ({:.2f} ms)'.format(
+            data,latency*1000))
+
     def moveMachineMarker(self,event):
         try:
             scale = self.machine['scale-factor']
@@ -407,19 +833,24 @@ class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
         z = event['z']/scale['z']
         self.freeDrawView.moveMachineMarker(x,y,z)
         
+    def _step(self,axis,sign):
+        if self.continuousJog.isChecked():
+            # the button jogged while it was held
+            return
+        self.ser_info.enqueue(Command(self.scaled('relative',axis)
+            .format(**{axis:sign*self.manualStepValue.value()}),instant=True))
+
     def stepxPlus(self):
-        self.ser_info.enqueue(Command(self.scaled('relative','x')
-            .format(x=self.manualStepValue.value()),instant=True))
+        self._step('x',1)
 
     def stepxMinus(self):
-        self.ser_info.enqueue(Command(self.scaled('relative','x')
-            .format(x=-self.manualStepValue.value()),instant=True))
+        self._step('x',-1)
+
     def stepyPlus(self):
-        self.ser_info.enqueue(Command(self.scaled('relative','y')
-            .format(y=self.manualStepValue.value()),instant=True))
+        self._step('y',1)
+
     def stepyMinus(self):
-        self.ser_info.enqueue(Command(self.scaled('relative','y')
-            .format(y=-self.manualStepValue.value()),instant=True))
+        self._step('y',-1)
 
 
     def _getTimeInfo(self,custom = False):
@@ -439,45 +870,131 @@ class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
 
     def moveToHome(self):
         cmd = Command(self.scaled('absolute','xy').format(x=0,y=0))
-        self.sendScanCommand(commands=[cmd])
+        self.ser_info.enqueue(cmd)
         
     def setNewHome(self):
         cmd = Command(self.instructions['set-home'])
-        self.sendScanCommand(commands=[cmd])
+        self.ser_info.enqueue(cmd)
         self.freeDrawView.moveMachineMarker(0,0)
         
-    def _startScanning(self,custom=False):
-        if self._scanning:
-            self.commandLog.appendPlainText("Already scanning.")
+    def _startScanning(self,custom=False,resume=None):
+        if self.controller.busy():
+            self.commandLog.appendPlainText("Already running.")
             return
-        self._scanning = True
-        time_info = self._getTimeInfo(custom=custom)
-        self.commandLog.appendPlainText("Starting scan on {} {} interval."
-                .format(time_info["interval"],time_info["units"]))
         if custom:
             waypoints = self.freeDrawView.dumpWaypointsInfo()
-            commands = []
-            v = None
-            for i,wp in enumerate(waypoints):
-                text = self.scaled('absolute','xyz').format(**wp)
-                commands.append(Command(text,i))
-                if wp['action'] != "No Action":
-                    commands.append(Command(self.instructions['wait'].format(t=5),i))
-                    commands[-1].action = wp['action']
-                if wp['v'] != v:
-                    v = wp['v']
-                    cmd = Command(self.instructions['set-speed'].format(v=v),i)
-                    cmd.action = "Set Speed {}".format(v)
-                    commands.append(cmd)
-				
+            if (self.machine.get('actions') or {}).get('photo-on-the-move'):
+                waypoints = patterns.with_capture_triggers(waypoints,
+                        self.captureSpacing.value())
+            else:
+                waypoints = patterns.with_captures(waypoints,
+                        self.captureSpacing.value())
+            commands = self._compileWaypoints(waypoints)
+        elif self.coverArea.isChecked():
+            commands = self._compileWaypoints(
+                    patterns.to_waypoints(self.coveragePath()),'xy')
         else:
             there = Command(self.scaled('absolute','y').format(
                     y=self.yLengthValue.value()),0)
             back = Command(self.scaled('absolute','y').format(
                     y=0),1)
             commands = [there,back]
-        self.sendScanCommand(commands=commands)
-        self.scanTimer.start(time_info["interval_s"]*1000)
+        scan = self._scanName(custom,commands)
+        if resume is not None and resume['scan'] != scan:
+            self.commandLog.appendPlainText("The scan has changed since it "
+                    "was interrupted, so it can't be resumed.")
+            return
+        time_info = self._getTimeInfo(custom=custom)
+        self.commandLog.appendPlainText("Starting scan on {} {} interval."
+                .format(time_info["interval"],time_info["units"]))
+        if resume is not None:
+            self.commandLog.appendPlainText(
+                    "Resuming pass {} after waypoint {}.".format(
+                        resume['pass'] + 1,resume['sequence']))
+            if (self.ser_info.status.state or '').startswith('Alarm'):
+                self.commandLog.appendPlainText("Clearing the alarm.")
+                self.ser_info.enqueue(Command('$X',instant=True))
+            resume = (resume['pass'],resume['index'])
+        # the scan stays on this machine whichever is selected later
+        self.controller.start_scan(commands,scan,
+                time_info["interval_s"]*1000,resume)
+
+    def _scanName(self,custom,commands):
+        """Names the scan in checkpoints: its kind and a hash of its
+        commands, so a resume can tell if the path has been edited since"""
+        text = '\n'.join('{} {}'.format(c.text,c.action) +
+                (' {}'.format(c.captures) if c.captures else '')
+                for c in commands)
+        return '{}:{:08x}'.format('custom' if custom else 'standard',
+                zlib.crc32(text.encode('utf-8')))
+
+    def resumeScanning(self):
+        """Pick up the scan this machine was running where it left off"""
+        port = self.serialPort.currentText()
+        last = checkpoint.load(checkpoint.path_for(port))
+        if last is None:
+            self.commandLog.appendPlainText(
+                    "No interrupted scan to resume on {}.".format(port))
+            return
+        self._startScanning(custom=last['scan'].startswith('custom:'),
+                resume=last)
+
+    def _compileWaypoints(self,waypoints,axes='xyz',controller=None):
+        """Turn waypoint info dicts into the commands for one scan.
+
+        A waypoint's speed is for the segment leaving it. With the profile's
+        speed-mode set to 'feed', it rides on the next move as a modal F
+        word (the absolute-feed instructions); otherwise it is a separate
+        set-speed command after the move to the waypoint. With a height map
+        followed, every waypoint is first raised or lowered by the height of
+        the surface under it.
+
+        The commands are for the selected machine, or else for controller,
+        with its own profile and stored height map.
+        """
+        if controller is None:
+            machine, instructions = self.machine, self.instructions
+        else:
+            machine, instructions = controller.machine, controller.instructions
+        if controller is None or controller is self.controller:
+            heightMap = self.heightMap if self.compensateZ.isChecked() else None
+        else:
+            heightMap = heightmap.load(heightmap.path_for(controller.port))
+        if heightMap is not None:
+            waypoints = heightMap.compensate(waypoints)
+            axes = 'xyz'
+        inline = machine.get('speed-mode') == 'feed'
+        move = self.scaled('absolute',axes,machine)
+        if inline:
+            feed_move = self.scaled('absolute-feed',axes,machine)
+        commands = []
+        # the speed the path has set so far, and the last F word sent
+        v = None
+        feed = None
+        for i,wp in enumerate(waypoints):
+            # GRBL refuses feed moves until it has been given a rate
+            speed = machine['default-speed'] if v is None else v
+            if inline and speed != feed:
+                feed = speed
+                cmd = Command(feed_move.format(**dict(wp,v=feed)),i)
+            else:
+                cmd = Command(move.format(**wp),i)
+            # None unless feed mode, whose resumes have to restore it
+            cmd.feed = feed
+            cmd.captures = wp.get('captures')
+            commands.append(cmd)
+            if wp['action'] not in (None,Action.NO_ACTION):
+                # no text: the serial thread runs it through its executor
+                cmd = Command(None,i,action=wp['action'])
+                cmd.feed = feed
+                commands.append(cmd)
+            if wp['v'] is not None and wp['v'] != v:
+                v = wp['v']
+                if not inline:
+                    cmd = Command(instructions['set-speed'].format(v=v),i)
+                    cmd.action = "Set Speed {}".format(v)
+                    commands.append(cmd)
+        return commands
 
     def startScanning(self):
         self._startScanning(custom=False)
@@ -486,19 +1003,14 @@ class TouchOMaticApp(QtWidgets.QMainWindow, touch_o_matic.Ui_MainWindow):
         self._startScanning(custom=True)
 
     def stopScanning(self):
-        self.commandLog.appendPlainText("Stopping scan.")
-        self.ser_info.clear()
-        self.scanTimer.stop()
-        self._scanning = False
+        self.commandLog.appendPlainText("Stopping scan on {}.".format(
+            self.controller.port))
+        self.controller.stop_scan()
 
     def emergencyStopScanning(self):
+        # write the stop bytes before anything else, then drop the queues
+        self.ser_info.realtime(self.instructions['stop'])
         self.stopScanning()
-        self.ser_info.enqueue(Command(self.instructions['stop'],instant=True))
-
-    def sendScanCommand(self,commands=None):
-        if commands:
-            self._commands = commands
-        self.ser_info.enqueue(self._commands)
 
 def run():
     app = QtWidgets.QApplication(sys.argv)
@@ -0,0 +1,130 @@
+"""Height maps of uneven specimens, and the Z compensation they give paths.
+
+The machine probes a grid over the scan area: at each point it rises to a
+clearance height, moves over the point and feeds down with G38.2 until the
+probe touches, and GRBL reports where with a [PRB:x,y,z:1] line. The map
+keeps those heights relative to the first point, the work origin, so a path
+drawn for a flat bed can be lifted or lowered by the interpolated height
+under each waypoint before it is compiled.
+"""
+import os
+import re
+import json
+import numpy as np
+
+HEIGHTMAP_DIR = os.environ.get('TOUCH_O_MATIC_HEIGHTMAPS',
+        os.path.join(os.path.expanduser('~'), '.touchomatic', 'heightmaps'))
+
+PRB = re.compile(r'\[PRB:([-+.0-9]+),([-+.0-9]+),([-+.0-9]+):([01])\]')
+
+def path_for(port, directory=HEIGHTMAP_DIR):
+    """Where the height map for the machine on port is kept"""
+    name = os.path.basename(port).replace(os.sep, '_') or 'port'
+    return os.path.join(directory, name + '.json')
+
+def grid(x_length, y_length, spacing):
+    """Probe coordinates along each axis: evenly spread from 0 to the far
+    edge, no further apart than spacing"""
+    def axis(length):
+        count = int(np.ceil(length/spacing)) + 1 if length > 0 else 1
+        return np.linspace(0, length, count)
+    return axis(x_length), axis(y_length)
+
+def probe_order(xs, ys):
+    """(n, 2) array of the grid points in probing order: along x, back and
+    forth, one row of y at a time"""
+    gx, gy = np.meshgrid(xs, ys)
+    gx[1::2] = gx[1::2, ::-1]
+    return np.column_stack([gx.ravel(), gy.ravel()])
+
+def parse_probe(line):
+    """The machine Z of a successful probe report, or None"""
+    match = PRB.match(line)
+    if match and match.group(4) == '1':
+        return float(match.group(3))
+    return None
+
+class ProbeJob():
+    """ The probe cycle, as a job for SerialInfoThread.stream().
+
+    `instructions` are the profile's probe instructions: travel-z and travel
+    for the moves between points, and probe, the G38.2 move. Lines are
+    numbered for progress, since there's no file behind them.
+    """
+    def __init__(self, points, instructions, clearance, depth, feed):
+        lines = []
+        for x, y in points:
+            lines.append(instructions['travel-z'].format(z=clearance))
+            lines.append(instructions['travel'].format(x=round(float(x),3),
+                y=round(float(y),3)))
+            lines.append(instructions['probe'].format(z=-depth, f=feed))
+        lines.append(instructions['travel-z'].format(z=clearance))
+        self.lines = lines
+        self.size = len(lines)
+
+    def __iter__(self):
+        for i, line in enumerate(self.lines):
+            yield i + 1, line
+
+class HeightMap():
+    """ Surface heights on a grid, z[row of ys, column of xs] """
+    def __init__(self, xs, ys, z):
+        self.xs = np.asarray(xs, dtype=float)
+        self.ys = np.asarray(ys, dtype=float)
+        self.z = np.asarray(z, dtype=float).reshape(len(self.ys),
+                len(self.xs))
+
+    @classmethod
+    def from_probes(cls, xs, ys, heights):
+        """A map from probe heights in probe_order(), relative to the
+        first"""
+        z = np.array(heights, dtype=float).reshape(len(ys), len(xs))
+        z[1::2] = z[1::2, ::-1]
+        return cls(xs, ys, z - z[0, 0])
+
+    def offsets(self, x, y):
+        """Bilinearly interpolated heights at the points (x, y), held at
+        the edge value outside the grid"""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        nx, ny = len(self.xs), len(self.ys)
+        # fractional grid indices, clamped to the grid
+        fx = np.interp(x, self.xs, np.arange(nx))
+        fy = np.interp(y, self.ys, np.arange(ny))
+        i = np.minimum(fx.astype(int), nx - 1)
+        j = np.minimum(fy.astype(int), ny - 1)
+        i1 = np.minimum(i + 1, nx - 1)
+        j1 = np.minimum(j + 1, ny - 1)
+        tx = fx - i
+        ty = fy - j
+        z = self.z
+        bottom = z[j, i]*(1 - tx) + z[j, i1]*tx
+        top = z[j1, i]*(1 - tx) + z[j1, i1]*tx
+        return bottom*(1 - ty) + top*ty
+
+    def compensate(self, waypoints):
+        """Add the surface height to the z of each waypoint info dict, in
+        place, and return them"""
+        n = len(waypoints)
+        x = np.fromiter((wp['x'] for wp in waypoints), float, n)
+        y = np.fromiter((wp['y'] for wp in waypoints), float, n)
+        z = np.fromiter((wp['z'] or 0 for wp in waypoints), float, n)
+        z = np.round(z + self.offsets(x, y), 3).tolist()
+        for wp, h in zip(waypoints, z):
+            wp['z'] = h
+        return waypoints
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({"x":self.xs.tolist(), "y":self.ys.tolist(),
+                "z":self.z.tolist()}, f)
+
+def load(path):
+    """The height map saved at path, or None"""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        return HeightMap(data['x'], data['y'], data['z'])
+    except (OSError, ValueError, KeyError):
+        return None
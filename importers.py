@@ -0,0 +1,475 @@
+"""Streaming importers that turn SVG paths, DXF polylines and G-code files
+into waypoints.
+
+Each importer is a generator of {'x','y','z'} dicts in machine units. Files
+are read incrementally (iterparse for SVG, line by line for DXF and G-code)
+and curves are flattened to a tolerance as they are met, so memory use
+doesn't grow with the size of the file. load() picks the importer from the
+file extension and snaps the result to the machine's grid.
+
+load_saved() reads back the YAML paths the app saves itself.
+"""
+import os
+import re
+import math
+import numbers
+import xml.etree.ElementTree as ET
+import yaml
+from commands import Action
+
+# millimetres per unit
+UNITS = {'mm':1., 'cm':10., 'm':1000., 'in':25.4, 'pt':25.4/72, 'pc':25.4/6,
+         'px':25.4/96}
+
+def flatten_arc(x0, y0, cx, cy, x1, y1, clockwise, tolerance):
+    """Points along a circular arc around (cx, cy) from (x0, y0) to (x1, y1),
+    excluding the start, with a chord error of at most tolerance"""
+    r = math.hypot(x0 - cx, y0 - cy)
+    a0 = math.atan2(y0 - cy, x0 - cx)
+    a1 = math.atan2(y1 - cy, x1 - cx)
+    sweep = a1 - a0
+    if clockwise and sweep >= 0:
+        sweep -= 2*math.pi
+    elif not clockwise and sweep <= 0:
+        sweep += 2*math.pi
+    if r <= tolerance:
+        yield x1, y1
+        return
+    step = 2*math.acos(1 - tolerance/r)
+    n = max(1, int(math.ceil(abs(sweep)/step)))
+    for i in range(1, n):
+        a = a0 + sweep*i/n
+        yield cx + r*math.cos(a), cy + r*math.sin(a)
+    yield x1, y1
+
+def flatten_bezier(points, tolerance):
+    """Points along a quadratic or cubic Bezier given its control points,
+    excluding the start"""
+    (x0, y0), (xn, yn) = points[0], points[-1]
+    # distance of the control points from the chord bounds the error
+    chord = math.hypot(xn - x0, yn - y0) or 1e-12
+    dev = max(abs((xn - x0)*(y0 - y) - (x0 - x)*(yn - y0))/chord
+              for x, y in points[1:-1])
+    n = max(1, int(math.ceil(math.sqrt(dev/tolerance))))
+    for i in range(1, n+1):
+        t = i/n
+        pts = list(points)
+        while len(pts) > 1:
+            pts = [(a[0] + (b[0] - a[0])*t, a[1] + (b[1] - a[1])*t)
+                   for a, b in zip(pts, pts[1:])]
+        yield pts[0]
+
+# SVG
+
+_SVG_TOKEN = re.compile(
+        r'[MmLlHhVvCcSsQqTtAaZz]|[-+]?(?:\d*\.\d+|\d+\.?)(?:[eE][-+]?\d+)?')
+_SVG_ARGS = {'M':2, 'L':2, 'H':1, 'V':1, 'C':6, 'S':4, 'Q':4, 'T':2, 'A':7,
+             'Z':0}
+
+def _svg_length(value):
+    """(number, mm per unit) for an SVG length such as '210mm'"""
+    match = re.match(r'\s*([-+0-9.eE]+)\s*([a-z%]*)', value or '')
+    if not match:
+        return None, None
+    return float(match.group(1)), UNITS.get(match.group(2) or 'px')
+
+def _svg_arc(x0, y0, rx, ry, phi, large, sweep, x1, y1, tolerance):
+    """Flatten an SVG endpoint-parameterised elliptical arc"""
+    if not rx or not ry:
+        yield x1, y1
+        return
+    rx, ry = abs(rx), abs(ry)
+    phi = math.radians(phi)
+    cos, sin = math.cos(phi), math.sin(phi)
+    dx, dy = (x0 - x1)/2, (y0 - y1)/2
+    x1p, y1p = cos*dx + sin*dy, -sin*dx + cos*dy
+    scale = (x1p/rx)**2 + (y1p/ry)**2
+    if scale > 1:
+        rx, ry = rx*math.sqrt(scale), ry*math.sqrt(scale)
+    num = rx*rx*ry*ry - rx*rx*y1p*y1p - ry*ry*x1p*x1p
+    den = rx*rx*y1p*y1p + ry*ry*x1p*x1p
+    coef = math.sqrt(max(0, num/den)) if den else 0
+    if large == sweep:
+        coef = -coef
+    cxp, cyp = coef*rx*y1p/ry, -coef*ry*x1p/rx
+    cx = cos*cxp - sin*cyp + (x0 + x1)/2
+    cy = sin*cxp + cos*cyp + (y0 + y1)/2
+    def angle(ux, uy):
+        return math.atan2(uy, ux)
+    t0 = angle((x1p - cxp)/rx, (y1p - cyp)/ry)
+    dt = angle((-x1p - cxp)/rx, (-y1p - cyp)/ry) - t0
+    if sweep and dt < 0:
+        dt += 2*math.pi
+    elif not sweep and dt > 0:
+        dt -= 2*math.pi
+    step = 2*math.acos(max(-1, 1 - tolerance/max(rx, ry)))
+    n = max(1, int(math.ceil(abs(dt)/step)))
+    for i in range(1, n):
+        t = t0 + dt*i/n
+        x, y = rx*math.cos(t), ry*math.sin(t)
+        yield cos*x - sin*y + cx, sin*x + cos*y + cy
+    yield x1, y1
+
+def svg_path(d, tolerance):
+    """Points along an SVG path's d attribute, in user units"""
+    tokens = _SVG_TOKEN.findall(d)
+    i = 0
+    cmd = None
+    x = y = sx = sy = 0.
+    # last control point, for the smooth curve commands
+    ctrl = None
+    while i < len(tokens):
+        if tokens[i].isalpha():
+            cmd = tokens[i]
+            i += 1
+        n = _SVG_ARGS[cmd.upper()]
+        args = [float(t) for t in tokens[i:i+n]]
+        i += n
+        rel = cmd.islower()
+        op = cmd.upper()
+        ox, oy = (x, y) if rel else (0., 0.)
+        last_ctrl, ctrl = ctrl, None
+        if op == 'M':
+            x, y = ox + args[0], oy + args[1]
+            sx, sy = x, y
+            yield x, y
+            # further pairs are implicit line-tos
+            cmd = 'l' if rel else 'L'
+        elif op == 'L':
+            x, y = ox + args[0], oy + args[1]
+            yield x, y
+        elif op == 'H':
+            x = ox + args[0]
+            yield x, y
+        elif op == 'V':
+            y = oy + args[0]
+            yield x, y
+        elif op == 'Z':
+            x, y = sx, sy
+            yield x, y
+            if i < len(tokens) and not tokens[i].isalpha():
+                raise ValueError("Numbers after Z in path")
+        elif op in 'CS':
+            if op == 'C':
+                c1 = (ox + args[0], oy + args[1])
+                args = args[2:]
+            else:
+                c1 = (2*x - last_ctrl[0], 2*y - last_ctrl[1]) \
+                    if last_ctrl and last_ctrl[2] == 'C' else (x, y)
+            c2 = (ox + args[0], oy + args[1])
+            end = (ox + args[2], oy + args[3])
+            for p in flatten_bezier([(x, y), c1, c2, end], tolerance):
+                yield p
+            ctrl = c2 + ('C',)
+            x, y = end
+        elif op in 'QT':
+            if op == 'Q':
+                c = (ox + args[0], oy + args[1])
+                args = args[2:]
+            else:
+                c = (2*x - last_ctrl[0], 2*y - last_ctrl[1]) \
+                    if last_ctrl and last_ctrl[2] == 'Q' else (x, y)
+            end = (ox + args[0], oy + args[1])
+            for p in flatten_bezier([(x, y), c, end], tolerance):
+                yield p
+            ctrl = c + ('Q',)
+            x, y = end
+        elif op == 'A':
+            end = (ox + args[5], oy + args[6])
+            for p in _svg_arc(x, y, args[0], args[1], args[2], bool(args[3]),
+                              bool(args[4]), end[0], end[1], tolerance):
+                yield p
+            x, y = end
+
+def iter_svg(path, tolerance=0.5, units='mm'):
+    """Waypoints along every path, polyline, polygon and line in an SVG file.
+    Element transforms are not applied. The y axis is flipped so the drawing
+    keeps its orientation on the machine's bed."""
+    to_mm = UNITS['px']
+    height = None
+    root = None
+    target = UNITS[units]
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if event == 'start':
+            if root is None:
+                root = elem
+                # work out the size of a user unit from width and viewBox;
+                # without a viewBox, user units are px
+                width, w_mm = _svg_length(elem.get('width'))
+                h, h_mm = _svg_length(elem.get('height'))
+                box = elem.get('viewBox')
+                if box:
+                    box = [float(v) for v in re.split(r'[\s,]+', box.strip())]
+                    height = box[1] + box[3]
+                    if width and w_mm and box[2]:
+                        to_mm = width*w_mm/box[2]
+                elif h and h_mm:
+                    height = h*h_mm/to_mm
+            continue
+        # scale from user units, tolerance is in machine units
+        tol = tolerance*target/to_mm
+        points = ()
+        if tag == 'path':
+            points = svg_path(elem.get('d', ''), tol)
+        elif tag in ('polyline', 'polygon'):
+            nums = [float(v) for v in _SVG_TOKEN.findall(
+                elem.get('points', ''))]
+            points = list(zip(nums[::2], nums[1::2]))
+            if tag == 'polygon' and points:
+                points.append(points[0])
+        elif tag == 'line':
+            points = [(float(elem.get('x1', 0)), float(elem.get('y1', 0))),
+                      (float(elem.get('x2', 0)), float(elem.get('y2', 0)))]
+        for px, py in points:
+            if height is not None:
+                py = height - py
+            yield {'x':px*to_mm/target, 'y':py*to_mm/target, 'z':None}
+        if elem is not root:
+            elem.clear()
+            root.clear()
+
+# DXF
+
+# $INSUNITS codes
+_DXF_UNITS = {1:'in', 4:'mm', 5:'cm', 6:'m'}
+
+def _dxf_pairs(f):
+    while True:
+        code = f.readline()
+        value = f.readline()
+        if not value:
+            return
+        yield int(code), value.strip()
+
+def _bulge(x0, y0, x1, y1, bulge, tolerance):
+    """Points along a polyline segment with a bulge, excluding the start"""
+    if not bulge:
+        yield x1, y1
+        return
+    # bulge = tan(included angle/4); find the centre from the chord
+    theta = 4*math.atan(bulge)
+    chord = math.hypot(x1 - x0, y1 - y0)
+    r = chord/(2*math.sin(theta/2))
+    mx, my = (x0 + x1)/2, (y0 + y1)/2
+    h = r*math.cos(theta/2)
+    nx, ny = -(y1 - y0)/chord, (x1 - x0)/chord
+    cx, cy = mx + nx*h, my + ny*h
+    for p in flatten_arc(x0, y0, cx, cy, x1, y1, bulge < 0, tolerance):
+        yield p
+
+def iter_dxf(path, tolerance=0.5, units='mm'):
+    """Waypoints along the LINE, LWPOLYLINE and POLYLINE entities of an
+    ASCII DXF file. Vertices are produced as they are read, so a single huge
+    polyline doesn't have to be held in memory."""
+    to_mm = 1.
+    target = UNITS[units]
+    tol = tolerance
+    entity = None
+    # the vertex being read: [x, y, z, bulge]
+    vertex = None
+    # previous vertex of the current polyline, and its first one
+    prev = first = None
+    closed = False
+    line = {}
+
+    def emit(v):
+        nonlocal prev
+        if prev is None:
+            points = [(v[0], v[1])]
+        else:
+            points = _bulge(prev[0], prev[1], v[0], v[1], prev[3], tol)
+        for x, y in points:
+            yield {'x':x*to_mm/target, 'y':y*to_mm/target,
+                   'z':v[2]*to_mm/target if v[2] is not None else None}
+        prev = v
+
+    def finish():
+        """Flush the entity that just ended"""
+        nonlocal vertex, prev, first, closed
+        if entity == 'LINE' and line:
+            for v in ([line.get(10, 0), line.get(20, 0), line.get(30), 0],
+                      [line.get(11, 0), line.get(21, 0), line.get(31), 0]):
+                yield from emit(v)
+        elif entity in ('LWPOLYLINE', 'VERTEX') and vertex:
+            yield from emit(vertex)
+            if first is None:
+                first = vertex
+        if entity in ('LWPOLYLINE', 'SEQEND') and closed and first and prev:
+            yield from emit(list(first))
+        if entity in ('LWPOLYLINE', 'SEQEND', 'LINE'):
+            prev = first = None
+            closed = False
+        vertex = None
+
+    with open(path, errors='replace') as f:
+        pairs = _dxf_pairs(f)
+        variable = None
+        for code, value in pairs:
+            if code == 9:
+                variable = value
+            elif variable == '$INSUNITS' and code == 70:
+                to_mm = UNITS[_DXF_UNITS.get(int(value), 'mm')]
+                tol = tolerance*target/to_mm
+                variable = None
+            elif code == 0:
+                yield from finish()
+                entity = value
+                line = {}
+                if entity == 'POLYLINE':
+                    prev = first = None
+                    closed = False
+            elif entity == 'LINE' and 10 <= code <= 31:
+                line[code] = float(value)
+            elif entity in ('LWPOLYLINE', 'VERTEX', 'POLYLINE'):
+                if code == 70 and entity != 'VERTEX':
+                    closed = bool(int(value) & 1)
+                elif entity == 'POLYLINE':
+                    continue
+                elif code == 10:
+                    if entity == 'LWPOLYLINE' and vertex:
+                        yield from emit(vertex)
+                        if first is None:
+                            first = vertex
+                    vertex = [float(value), 0., None, 0.]
+                elif code == 20 and vertex:
+                    vertex[1] = float(value)
+                elif code == 30 and vertex:
+                    vertex[2] = float(value)
+                elif code == 42 and vertex:
+                    vertex[3] = float(value)
+        yield from finish()
+
+# G-code
+
+_GCODE_WORD = re.compile(r'([A-Z])\s*([-+]?[0-9]*\.?[0-9]*)')
+
+def strip_gcode(line):
+    """Line without comments or whitespace, upper cased"""
+    line = re.sub(r'\(.*?\)|;.*', '', line)
+    return ''.join(line.split()).upper()
+
+def iter_gcode(path, tolerance=0.5, units='mm'):
+    """Waypoints along the G0/G1/G2/G3 moves of a G-code file (XY plane)"""
+    target = UNITS[units]
+    to_mm = 1.
+    absolute = True
+    motion = 0
+    pos = [0., 0., 0.]
+    with open(path, errors='replace') as f:
+        for raw in f:
+            words = _GCODE_WORD.findall(strip_gcode(raw))
+            if not words:
+                continue
+            axes = {}
+            for letter, value in words:
+                if not value:
+                    continue
+                value = float(value)
+                if letter == 'G':
+                    if value in (0, 1, 2, 3):
+                        motion = int(value)
+                    elif value == 20:
+                        to_mm = 25.4
+                    elif value == 21:
+                        to_mm = 1.
+                    elif value == 90:
+                        absolute = True
+                    elif value == 91:
+                        absolute = False
+                elif letter in 'XYZIJR':
+                    axes[letter] = value
+            if not any(a in axes for a in 'XYZ'):
+                continue
+            end = list(pos)
+            for i, axis in enumerate('XYZ'):
+                if axis in axes:
+                    end[i] = (axes[axis]*to_mm if absolute
+                              else pos[i] + axes[axis]*to_mm)
+            if motion in (2, 3):
+                if 'R' in axes:
+                    cx, cy = _center_from_radius(pos, end, axes['R']*to_mm,
+                                                 motion == 2)
+                else:
+                    cx = pos[0] + axes.get('I', 0)*to_mm
+                    cy = pos[1] + axes.get('J', 0)*to_mm
+                points = flatten_arc(pos[0], pos[1], cx, cy, end[0], end[1],
+                                     motion == 2, tolerance*target)
+            else:
+                points = [(end[0], end[1])]
+            for x, y in points:
+                yield {'x':x/target, 'y':y/target, 'z':end[2]/target}
+            pos = end
+
+def _center_from_radius(start, end, r, clockwise):
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    d = math.hypot(dx, dy)
+    h = math.sqrt(max(0, r*r - d*d/4))
+    # G2 with positive R takes the short way round, to the right
+    if clockwise == (r > 0):
+        h = -h
+    return (start[0] + dx/2 - h*dy/d, start[1] + dy/2 + h*dx/d)
+
+IMPORTERS = {
+    '.svg':iter_svg,
+    '.dxf':iter_dxf,
+    '.nc':iter_gcode,
+    '.gcode':iter_gcode,
+    '.ngc':iter_gcode,
+    '.tap':iter_gcode,
+}
+
+def snapped(points, step):
+    """Round points onto the step grid and drop consecutive duplicates, which
+    the scene would snap together anyway"""
+    last = None
+    for point in points:
+        key = (round(point['x']/step), round(point['y']/step), point['z'])
+        if key != last:
+            last = key
+            yield dict(point, x=key[0]*step, y=key[1]*step)
+
+def load(path, machine):
+    """Waypoints from any supported file, in machine units and snapped to the
+    machine's units-scale. The tolerance is half a snap step."""
+    importer = IMPORTERS[os.path.splitext(path)[1].lower()]
+    step = machine.get('units-scale', 1)
+    return snapped(importer(path, tolerance=step/2., units=machine['units']),
+                   step)
+
+# saved paths
+
+class _SavedPathLoader(yaml.SafeLoader):
+    """ Safe YAML, plus the tag yaml.dump() gives waypoint actions """
+
+def _action(loader, node):
+    value, = loader.construct_sequence(node)
+    return Action(value)
+
+_SavedPathLoader.add_constructor(
+        'tag:yaml.org,2002:python/object/apply:commands.Action', _action)
+
+def load_saved(path):
+    """The waypoint info dicts of a path saved with dumpWaypointsInfo(),
+    head first. Raises ValueError if the file isn't one."""
+    with open(path) as f:
+        try:
+            info = yaml.load(f, Loader=_SavedPathLoader)
+        except yaml.YAMLError as e:
+            raise ValueError("{} isn't valid YAML: {}".format(path, e))
+    if not isinstance(info, list):
+        raise ValueError("{} doesn't hold a list of waypoints".format(path))
+    for i, wp in enumerate(info):
+        if not isinstance(wp, dict):
+            raise ValueError("waypoint {} isn't a mapping".format(i))
+        for key in 'x', 'y', 'z', 'v':
+            value = wp.get(key)
+            if isinstance(value, bool) or not (
+                    isinstance(value, numbers.Real) or
+                    (value is None and key in 'zv')):
+                raise ValueError("waypoint {} has {} {!r}".format(i, key,
+                    value))
+        if not isinstance(wp.get('action'), (Action, type(None))):
+            raise ValueError("waypoint {} has action {!r}".format(i,
+                wp.get('action')))
+    return info
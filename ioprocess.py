@@ -0,0 +1,240 @@
+"""Run a machine's serial engine in a child process, so its timing doesn't
+depend on how busy the GUI keeps the interpreter.
+
+The child owns the port and runs an ordinary SerialInfoThread loop.
+ProcessEngine stands in for that thread in the GUI process, with the same
+signals and methods:
+
+- commands, realtime bytes, stream()/clear()/stop() go to the child down a
+  pipe;
+- the machine position and state come back through a shared memory block,
+  guarded by a sequence counter, which the child rewrites after every poll;
+- every other signal comes back down a second pipe, along with a copy of
+  the engine metrics once a second.
+"""
+import time
+import struct
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from PyQt5 import QtCore
+from commands import Command
+import grblstatus
+import metrics
+
+# sequence counter, then the published state. The counter is odd while the
+# child is writing; readers retry until they see the same even value on both
+# sides of their copy.
+SEQ = struct.Struct('<I')
+STATE = struct.Struct('<3d3d3diid3ii?16s')
+
+# seconds between metrics snapshots from the child
+METRICS_INTERVAL = 1.
+
+def _serve(port, baud_rate, machine, interval, shm_name, commands, events):
+    """Child process: open the port and run the engine until told to stop"""
+    import controllers
+    import actions
+    import checkpoint
+    from serialinfo import SerialInfoThread
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    send_lock = threading.Lock()
+    def send(*message):
+        with send_lock:
+            events.send(message)
+
+    ser = controllers.open_port(port, baud_rate, machine)
+    engine = SerialInfoThread(None, ser, machine['instructions']['info'],
+            interval, actions.ActionExecutor(machine.get('actions')))
+    engine.checkpoint = checkpoint.Checkpointer(checkpoint.path_for(port))
+    status = engine.status
+    buf = shm.buf
+    seq = [0]
+
+    def publish(pos):
+        seq[0] += 1
+        SEQ.pack_into(buf, 0, seq[0])
+        STATE.pack_into(buf, SEQ.size, *status.mpos,
+                pos['x'], pos['y'], pos['z'], *status.wco,
+                -1 if status.planner is None else status.planner,
+                -1 if status.rx is None else status.rx, status.feed,
+                *status.overrides, engine.queued(), engine.busy(),
+                (status.state or '').encode('ascii', 'replace'))
+        seq[0] += 1
+        SEQ.pack_into(buf, 0, seq[0])
+
+    direct = QtCore.Qt.DirectConnection
+    engine.updated.connect(publish, direct)
+    for name in ('commandSent', 'responseReceived', 'realtimeSent',
+            'jobProgress', 'jobFinished', 'actionFinished'):
+        getattr(engine, name).connect(
+                lambda *args, name=name: send(name, *args), direct)
+
+    def receive():
+        last_metrics = 0
+        while True:
+            if commands.poll(METRICS_INTERVAL):
+                name, args = commands.recv()
+                if name == 'stop':
+                    engine.stop()
+                    return
+                getattr(engine, name)(*args)
+            now = time.monotonic()
+            if now - last_metrics >= METRICS_INTERVAL:
+                send('metrics', engine.metrics)
+                last_metrics = now
+
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+    try:
+        engine.run()
+    finally:
+        receiver.join(1)
+        ser.close()
+        send('stopped')
+        del buf
+        shm.close()
+
+class ProcessEngine(QtCore.QThread):
+    """ Drop-in for SerialInfoThread that runs the engine in a child process.
+
+    The QThread itself only relays the child's events into signals and
+    watches the shared memory block for new positions.
+    """
+
+    commandSent = QtCore.pyqtSignal(Command)
+    updated = QtCore.pyqtSignal(dict)
+    responseReceived = QtCore.pyqtSignal(str)
+    realtimeSent = QtCore.pyqtSignal(str,float)
+    jobProgress = QtCore.pyqtSignal(int,int)
+    jobFinished = QtCore.pyqtSignal(bool)
+    actionFinished = QtCore.pyqtSignal(Command,bool,float)
+
+    def __init__(self, parent, port, baud_rate, machine, interval=100):
+        super(ProcessEngine,self).__init__(parent)
+        self.port = port
+        self.interval = interval
+        self.status = grblstatus.Status()
+        # replaced by the child's snapshots as they arrive
+        self.metrics = metrics.Metrics('touchomatic_serial', {'port':port})
+        self._queued = 0
+        # the child's busy(), and whether a file sent to it is unfinished
+        self._busy = False
+        self._streaming = False
+        self._seq = 0
+        self._running = False
+        self._shm = shared_memory.SharedMemory(create=True,
+                size=SEQ.size + STATE.size)
+        self._shm.buf[:SEQ.size] = SEQ.pack(0)
+        ctx = multiprocessing.get_context('spawn')
+        self._commands, child_commands = ctx.Pipe()
+        child_events, self._events = ctx.Pipe()
+        self._send_lock = threading.Lock()
+        self.process = ctx.Process(target=_serve, name='touchomatic-io',
+                args=(port, baud_rate, machine, interval, self._shm.name,
+                    child_commands, child_events), daemon=True)
+        self.process.start()
+
+    def _send(self, name, *args):
+        with self._send_lock:
+            self._commands.send((name, args))
+
+    def run(self):
+        self._running = True
+        # check for new positions a few times per poll of the child
+        wait = self.interval/4000.
+        while self._running:
+            if self._events.poll(wait):
+                try:
+                    message = self._events.recv()
+                except EOFError:
+                    break
+                name, args = message[0], message[1:]
+                if name == 'stopped':
+                    break
+                if name == 'metrics':
+                    self.metrics, = args
+                    continue
+                if name == 'jobFinished':
+                    self._streaming = False
+                getattr(self, name).emit(*args)
+            self._read_state()
+
+    def _read_state(self):
+        buf = self._shm.buf
+        while True:
+            seq, = SEQ.unpack_from(buf, 0)
+            if seq == self._seq:
+                return
+            if seq & 1:
+                continue
+            fields = STATE.unpack_from(buf, SEQ.size)
+            if SEQ.unpack_from(buf, 0)[0] == seq:
+                break
+        self._seq = seq
+        st = self.status
+        st.mpos[:] = fields[0:3]
+        st.wpos[:] = fields[3:6]
+        st.wco[:] = fields[6:9]
+        st.planner = None if fields[9] < 0 else fields[9]
+        st.rx = None if fields[10] < 0 else fields[10]
+        st.feed = fields[11]
+        st.overrides[:] = fields[12:15]
+        self._queued = fields[15]
+        self._busy = fields[16]
+        st.state = fields[17].rstrip(b'\0').decode('ascii') or None
+        st.reports += 1
+        self.updated.emit(st.position())
+
+    def stop(self):
+        """Stop the child's engine and wait for both sides to exit"""
+        if self.process.is_alive():
+            self._send('stop')
+            self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self._running = False
+        self.wait()
+        self._shm.close()
+        self._shm.unlink()
+
+    def queued(self):
+        return self._queued
+
+    def enqueue(self, items):
+        self._send('enqueue', items)
+
+    def realtime(self, data):
+        """Ask the child to write a realtime command. realtimeSent reports
+        the child's write; the value returned here is the time taken to
+        hand the command over."""
+        start = time.perf_counter()
+        self._send('realtime', data)
+        return time.perf_counter() - start
+
+    def override_feed(self, step):
+        self._send('override_feed', step)
+
+    def set_feed_override(self, percent):
+        self._send('set_feed_override', percent)
+
+    def jog(self, line):
+        self._send('jog', line)
+
+    def jog_cancel(self):
+        self._send('jog_cancel')
+
+    def busy(self):
+        """As of the child's last snapshot, or a file sent since"""
+        return self._streaming or self._busy
+
+    def stream(self, job):
+        if self._streaming:
+            return False
+        self._streaming = True
+        self._send('stream', job)
+        return True
+
+    def clear(self):
+        self._send('clear')
@@ -0,0 +1,243 @@
+"""Local control socket, for scripts that queue scans and watch the machines.
+
+The server listens on a Unix domain socket and speaks newline-delimited
+JSON. Each request is one object with an "op", and an optional "id" that is
+copied into its reply:
+
+    {"op": "status"}
+    {"op": "submit", "path": "/scans/leaf.yaml", "port": "/dev/ttyUSB0"}
+    {"op": "stop", "port": ...}
+    {"op": "resume", "port": ...}
+    {"op": "subscribe", "topics": ["position", "commands"], "port": ...}
+    {"op": "unsubscribe", "topics": [...]}
+
+Replies are {"id": ..., "ok": true, ...} or {"id": ..., "ok": false,
+"error": "..."}. Subscribers also get event objects, {"event": topic,
+"port": ..., ...}, for the topics in TOPICS. "port" is optional everywhere;
+without it requests go to the selected machine and subscriptions cover all
+of them.
+
+The server runs in the GUI thread on Qt's event loop. The serial threads
+only emit their signals as before; each event is encoded once and handed to
+every subscriber's socket buffer without waiting for it to be read, and a
+subscriber that has fallen more than MAX_BACKLOG bytes behind misses events
+until it catches up.
+
+Run as a script for a minimal client:
+
+    python jobserver.py '{"op": "status"}'
+    python jobserver.py --watch position commands
+"""
+import os
+import sys
+import json
+import logging
+from PyQt5 import QtCore, QtNetwork
+
+SOCKET_PATH = os.environ.get('TOUCH_O_MATIC_SOCKET')
+# bytes a subscriber may have unread before events to it are dropped
+MAX_BACKLOG = 1 << 20
+
+TOPICS = ('position', 'commands', 'responses', 'status', 'jobs', 'actions')
+
+def command_info(cmd):
+    return {"text":cmd.text, "sequence":cmd.sequence,
+            "action":None if cmd.action is None else str(cmd.action),
+            "scan":cmd.scan}
+
+class _Client():
+    def __init__(self, socket):
+        self.socket = socket
+        self.partial = b''
+        self.topics = set()
+        self.port = None
+        self.dropped = 0
+
+class JobServer(QtCore.QObject):
+    """ Serves requests from local scripts and fans the machines' events out
+    to them.
+
+    `handler` runs the jobs: it needs submitJob(path, port), stopJob(port)
+    and resumeJob(port), raising ValueError or OSError for requests it
+    can't carry out. TouchOMaticApp is one. Any exception a request raises
+    is sent back as its error reply.
+    """
+    def __init__(self, controllers, handler, path=SOCKET_PATH, parent=None):
+        super(JobServer,self).__init__(parent)
+        self.controllers = controllers
+        self.handler = handler
+        self.path = path
+        self._server = QtNetwork.QLocalServer(self)
+        self._server.newConnection.connect(self._accept)
+        self._clients = []
+        # ports whose engine signals are connected, and their connections
+        self._watched = {}
+        controllers.statusChanged.connect(self._statusChanged)
+
+    def start(self):
+        """Start listening. Returns False if the socket couldn't be made"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # a socket left behind by an instance that crashed
+        QtNetwork.QLocalServer.removeServer(self.path)
+        self._server.setSocketOptions(QtNetwork.QLocalServer.UserAccessOption)
+        return self._server.listen(self.path)
+
+    def close(self):
+        for client in list(self._clients):
+            client.socket.disconnectFromServer()
+        self._server.close()
+
+    # connections
+
+    def _accept(self):
+        while self._server.hasPendingConnections():
+            socket = self._server.nextPendingConnection()
+            client = _Client(socket)
+            self._clients.append(client)
+            socket.readyRead.connect(lambda c=client: self._read(c))
+            socket.disconnected.connect(lambda c=client: self._drop(c))
+
+    def _drop(self, client):
+        if client in self._clients:
+            self._clients.remove(client)
+            client.socket.deleteLater()
+
+    def _read(self, client):
+        data = client.partial + bytes(client.socket.readAll())
+        *lines, client.partial = data.split(b'\n')
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("requests are JSON objects")
+            except ValueError as e:
+                self._send(client, {"ok":False, "error":str(e)})
+                continue
+            reply = {"id":request.get('id')}
+            try:
+                reply.update(self._handle(client, request) or {})
+                reply["ok"] = True
+            except (ValueError, KeyError, OSError) as e:
+                reply.update(ok=False, error=str(e))
+            except Exception as e:
+                # an exception escaping a Qt slot aborts the whole app,
+                # along with any scan it is running
+                logging.exception("Job server request %r failed", request)
+                reply.update(ok=False, error="{}: {}".format(
+                    type(e).__name__, e))
+            self._send(client, reply)
+
+    def _send(self, client, message):
+        client.socket.write(json.dumps(message).encode('utf-8') + b'\n')
+
+    # requests
+
+    def _handle(self, client, request):
+        op = request.get('op')
+        port = request.get('port')
+        if op == 'status':
+            return {"status":self.controllers.status()}
+        if op == 'submit':
+            return self.handler.submitJob(request['path'], port)
+        if op == 'stop':
+            return self.handler.stopJob(port)
+        if op == 'resume':
+            return self.handler.resumeJob(port)
+        if op in ('subscribe', 'unsubscribe'):
+            topics = set(request.get('topics', TOPICS))
+            unknown = topics.difference(TOPICS)
+            if unknown:
+                raise ValueError("unknown topics: {}".format(
+                    ', '.join(sorted(unknown))))
+            if op == 'subscribe':
+                client.topics |= topics
+                client.port = port
+            else:
+                client.topics -= topics
+            return {"topics":sorted(client.topics)}
+        raise ValueError("unknown op {!r}".format(op))
+
+    # events
+
+    def publish(self, topic, port, **fields):
+        """Send an event to everyone subscribed to topic on port"""
+        data = None
+        for client in self._clients:
+            if topic not in client.topics or client.port not in (None, port):
+                continue
+            if client.socket.bytesToWrite() > MAX_BACKLOG:
+                client.dropped += 1
+                continue
+            if data is None:
+                fields.update(event=topic, port=port)
+                data = json.dumps(fields).encode('utf-8') + b'\n'
+            client.socket.write(data)
+
+    def _statusChanged(self, port, status):
+        self.publish('status', port, status=status.get(port))
+        if port in self.controllers and port not in self._watched:
+            self._watch(port)
+        elif port not in self.controllers:
+            self._watched.pop(port, None)
+
+    def _watch(self, port):
+        thread = self.controllers[port].thread
+        p = self.publish
+        connections = [
+            (thread.updated, lambda pos: p('position', port, pos=pos)),
+            (thread.commandSent, lambda cmd: p('commands', port,
+                command=command_info(cmd))),
+            (thread.responseReceived, lambda text: p('responses', port,
+                response=text)),
+            (thread.jobProgress, lambda offset, size: p('jobs', port,
+                offset=offset, size=size)),
+            (thread.jobFinished, lambda complete: p('jobs', port,
+                finished=complete)),
+            (thread.actionFinished, lambda cmd, ok, seconds: p('actions',
+                port, command=command_info(cmd), ok=ok, seconds=seconds)),
+        ]
+        for signal, slot in connections:
+            signal.connect(slot)
+        self._watched[port] = connections
+
+def request(path, message):
+    """Send one request and return the reply, for scripts"""
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall(json.dumps(message).encode('utf-8') + b'\n')
+        return json.loads(s.makefile('rb').readline())
+
+def main():
+    import argparse
+    import socket
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('request', nargs='?', help='a JSON request to send')
+    parser.add_argument('--socket', default=SOCKET_PATH,
+            help='server socket (default $TOUCH_O_MATIC_SOCKET)')
+    parser.add_argument('--watch', nargs='+', metavar='TOPIC',
+            help='subscribe to topics and print events until interrupted')
+    args = parser.parse_args()
+    if not args.socket:
+        parser.error('no socket given and TOUCH_O_MATIC_SOCKET is not set')
+    if args.request:
+        print(json.dumps(request(args.socket, json.loads(args.request))))
+    if args.watch:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(args.socket)
+            s.sendall(json.dumps({"op":"subscribe",
+                "topics":args.watch}).encode('utf-8') + b'\n')
+            try:
+                for line in s.makefile('rb'):
+                    sys.stdout.write(line.decode('utf-8'))
+                    sys.stdout.flush()
+            except KeyboardInterrupt:
+                pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""Counters and latency histograms for the serial engine, exported in the
+Prometheus text exposition format.
+
+Recording is a couple of attribute updates and a bisect, so it is cheap
+enough for the serial thread's hot path. Readers on other threads may see a
+histogram mid-update; the numbers are for monitoring, not accounting.
+"""
+import os
+import bisect
+
+# seconds, from 50us up to 5s
+LATENCY_BUCKETS = (5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2,
+        2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1., 2.5, 5.)
+
+class Counter():
+    __slots__ = ('name', 'help', 'value')
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self, labels):
+        yield self.name + '_total', labels, self.value
+
+class Histogram():
+    __slots__ = ('name', 'help', 'buckets', 'counts', 'sum', 'count')
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # the last slot counts values above every bucket
+        self.counts = [0]*(len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate the q quantile by interpolating within its bucket"""
+        if not self.count:
+            return None
+        rank = q*self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lo = self.buckets[i-1] if i else 0.
+                if i == len(self.buckets):
+                    return lo
+                return lo + (self.buckets[i] - lo)*(rank - seen)/n
+            seen += n
+        return self.buckets[-1]
+
+    def samples(self, labels):
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            yield self.name + '_bucket', labels + (('le', repr(bound)),), seen
+        yield self.name + '_bucket', labels + (('le', '+Inf'),), self.count
+        yield self.name + '_sum', labels, self.sum
+        yield self.name + '_count', labels, self.count
+
+class Metrics():
+    """ A set of metrics that share labels, eg. everything for one port """
+    def __init__(self, prefix='touchomatic', labels=None):
+        self.prefix = prefix
+        self.labels = tuple(sorted((labels or {}).items()))
+        self._metrics = []
+
+    def counter(self, name, help):
+        metric = Counter('{}_{}'.format(self.prefix, name), help)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        metric = Histogram('{}_{}'.format(self.prefix, name), help, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def __iter__(self):
+        return iter(self._metrics)
+
+    def summary(self):
+        """Human readable lines for the diagnostics panel"""
+        lines = []
+        for metric in self._metrics:
+            name = metric.name[len(self.prefix)+1:]
+            if metric.kind == 'counter':
+                lines.append('{:28s} {:d}'.format(name, metric.value))
+            elif metric.count:
+                lines.append('{:28s} n={:<7d} mean={:8.2f}ms '
+                        'p50={:8.2f}ms p95={:8.2f}ms'.format(name,
+                        metric.count, metric.sum/metric.count*1000,
+                        metric.quantile(.5)*1000, metric.quantile(.95)*1000))
+            else:
+                lines.append('{:28s} n=0'.format(name))
+        return lines
+
+def _fmt_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+        .replace('"', '\\"')) for k, v in labels) + '}'
+
+def exposition(registries):
+    """Prometheus text format for every metric in registries. Metrics with the
+    same name in several registries share one HELP/TYPE header.
+    """
+    families = {}
+    for registry in registries:
+        for metric in registry:
+            families.setdefault(metric.name, []).append((registry, metric))
+    lines = []
+    for name, members in families.items():
+        lines.append('# HELP {} {}'.format(name, members[0][1].help))
+        lines.append('# TYPE {} {}'.format(name, members[0][1].kind))
+        for registry, metric in members:
+            for sample, labels, value in metric.samples(registry.labels):
+                lines.append('{}{} {}'.format(sample, _fmt_labels(labels),
+                    repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+def write(path, registries):
+    """Write the exposition atomically, for node_exporter's textfile
+    collector and the like."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(exposition(registries))
+    os.replace(tmp, path)
@@ -0,0 +1,134 @@
+"""Scan path generators. Paths are built as NumPy arrays of (x, y) vertices,
+so dense patterns cost a few array operations rather than a Python loop per
+point, and are turned into waypoint dicts only at the end.
+"""
+import numpy as np
+from commands import Action
+
+def coverage(primary_length, secondary_length, step, primary='y', margin=0,
+        boustrophedon=True):
+    """Vertices of a path covering the rectangle from the origin to
+    (primary_length, secondary_length), inset by margin.
+
+    Passes run along the primary axis and are spaced at most step apart on
+    the secondary axis, with the first and last passes on the edges. A
+    boustrophedon (serpentine) path alternates the pass direction; a raster
+    path runs every pass the same way and travels back between them.
+    Returns an (n, 2) array of x, y.
+    """
+    p0, p1 = margin, primary_length - margin
+    s0, s1 = margin, secondary_length - margin
+    passes = int(np.ceil(abs(s1 - s0)/step)) + 1 if step > 0 else 1
+    sec = np.linspace(s0, s1, passes)
+    if boustrophedon:
+        prim = np.empty(2*passes)
+        prim[0::4] = p0
+        prim[1::4] = p1
+        prim[2::4] = p1
+        prim[3::4] = p0
+        sec = np.repeat(sec, 2)
+    else:
+        # pass start, pass end, and the travel back (dropped on the last)
+        prim = np.tile([p0, p1, p0], passes)[:-1]
+        sec = np.repeat(sec, 3)[:-1]
+    if primary == 'y':
+        return np.column_stack([sec, prim])
+    return np.column_stack([prim, sec])
+
+def to_waypoints(xy, z=0, v=None, action=Action.NO_ACTION):
+    """Waypoint info dicts, as used by QClickAndDraw and the scan compiler"""
+    return [{"x":x, "y":y, "z":z, "v":v, "action":action}
+            for x, y in xy.tolist()]
+
+def captures(path, spacing, start=0., tolerance=1e-6):
+    """Resample a polyline for captures every spacing of arc length, from
+    start along it.
+
+    path is an (n, d) array of vertices. A capture that lands within
+    tolerance of a vertex uses it; the others get a vertex of their own,
+    interpolated along their segment, so the path only grows by the
+    captures that fall between vertices. Returns the new vertices and, for
+    each, whether to capture there, the index of the original vertex (or
+    for added ones, of the vertex ending their segment), and whether it was
+    added.
+    """
+    path = np.asarray(path, dtype=float)
+    n = len(path)
+    # arc length at each vertex
+    s = np.concatenate([[0.], np.cumsum(np.linalg.norm(np.diff(path, axis=0),
+        axis=1))])
+    marks = np.arange(start, s[-1] + tolerance, spacing)
+    idx = np.searchsorted(s, marks - tolerance)
+    on_vertex = (idx < n) & (s[np.minimum(idx, n - 1)] <= marks + tolerance)
+    trigger = np.zeros(n, dtype=bool)
+    trigger[idx[on_vertex]] = True
+    between = marks[~on_vertex]
+    ends = idx[~on_vertex]
+    added = np.column_stack([np.interp(between, s, path[:, k])
+        for k in range(path.shape[1])])
+    # each added vertex goes just before the vertex ending its segment
+    order = np.argsort(np.concatenate([np.arange(n), ends - 0.5]),
+            kind='stable')
+    points = np.concatenate([path, added])[order]
+    triggers = np.concatenate([trigger, np.ones(len(ends), dtype=bool)])
+    source = np.concatenate([np.arange(n), ends])
+    inserted = np.arange(n + len(ends)) >= n
+    return points, triggers[order], source[order], inserted[order]
+
+def with_captures(waypoints, spacing, action=Action.TAKE_PHOTO):
+    """Waypoint info dicts with action every spacing of arc length along
+    them. Added waypoints take the speed of the move they split; a waypoint
+    that already has another action is followed by a copy that captures."""
+    if len(waypoints) < 2 or spacing <= 0:
+        return waypoints
+    path = np.array([(wp['x'], wp['y'], wp['z'] or 0) for wp in waypoints])
+    points, triggers, source, inserted = captures(path, spacing)
+    out = []
+    for (x, y, z), capture, i, new in zip(points.tolist(), triggers.tolist(),
+            source.tolist(), inserted.tolist()):
+        wp = waypoints[i]
+        if new:
+            out.append(dict(wp, x=x, y=y, z=z, action=action))
+        elif not capture or wp['action'] in (action, None, Action.NO_ACTION):
+            out.append(dict(wp, action=action) if capture else wp)
+        else:
+            out.append(wp)
+            out.append(dict(wp, action=action))
+    return out
+
+def capture_marks(path, spacing, start=0., tolerance=1e-6):
+    """Captures every spacing of arc length along a polyline, from start,
+    placed on its segments instead of added as vertices.
+
+    Returns, for each capture, the index of the vertex ending its segment
+    and the fraction of the segment covered when it is reached. A capture
+    on a vertex is at the end of the segment into it, 1; one on the first
+    vertex is at the end of the move to it.
+    """
+    path = np.asarray(path, dtype=float)
+    n = len(path)
+    s = np.concatenate([[0.], np.cumsum(np.linalg.norm(np.diff(path, axis=0),
+        axis=1))])
+    marks = np.arange(start, s[-1] + tolerance, spacing)
+    idx = np.minimum(np.searchsorted(s, marks - tolerance), n - 1)
+    prev = s[np.maximum(idx - 1, 0)]
+    length = s[idx] - prev
+    frac = np.ones(len(marks))
+    np.divide(marks - prev, length, out=frac, where=length > 0)
+    return idx, np.clip(frac, 0., 1.)
+
+def with_capture_triggers(waypoints, spacing):
+    """Waypoint info dicts with a capture every spacing of arc length,
+    taken on the move: a waypoint whose incoming move passes captures gets
+    a 'captures' list of the fractions of that move to take them at. No
+    waypoints are added, so the machine doesn't stop for them."""
+    if len(waypoints) < 2 or spacing <= 0:
+        return waypoints
+    path = np.array([(wp['x'], wp['y'], wp['z'] or 0) for wp in waypoints])
+    idx, frac = capture_marks(path, spacing)
+    out = list(waypoints)
+    for i, f in zip(idx.tolist(), frac.tolist()):
+        if out[i] is waypoints[i]:
+            out[i] = dict(waypoints[i], captures=[])
+        out[i]['captures'].append(f)
+    return out
@@ -0,0 +1,40 @@
+import serial.tools.list_ports
+from PyQt5 import QtCore
+
+class PortScanner(QtCore.QThread):
+    """ Enumerate serial ports in the background and report hotplug changes """
+
+    # ports that appeared, ports that disappeared
+    portsChanged = QtCore.pyqtSignal(list,list)
+
+    def __init__(self, parent=None, interval=2000):
+        super(PortScanner,self).__init__(parent)
+        self.interval = interval #interval to rescan in ms
+        # cached result of the last scan, in the order comports() gave it
+        self.ports = []
+        self._running = False
+
+    def run(self):
+        self._running = True
+        while self._running:
+            self.scan()
+            # sleep in short steps so stop() doesn't wait a whole interval
+            for _ in range(max(1,self.interval//100)):
+                if not self._running:
+                    break
+                self.msleep(100)
+
+    def stop(self):
+        self._running = False
+        self.wait()
+
+    def scan(self):
+        """Rescan once, and emit portsChanged if the set of ports changed"""
+        ports = [p[0] for p in serial.tools.list_ports.comports()
+                 if p[2] != 'n/a']
+        added = [p for p in ports if p not in self.ports]
+        removed = [p for p in self.ports if p not in ports]
+        self.ports = ports
+        if added or removed:
+            self.portsChanged.emit(added,removed)
+        return added, removed
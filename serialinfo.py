@@ -0,0 +1,524 @@
+import time
+import re
+import queue
+import threading
+import collections
+from PyQt5 import QtCore
+from commands import Command, Action, REALTIME, feed_override
+import metrics
+import actions
+import grblstatus
+
+# bytes of GRBL's serial receive buffer, used to pace streamed files
+RX_BUFFER_SIZE = 128
+# poll interval while jogging, in ms, so the jog latencies are measured
+# finely and a released jog is seen to stop quickly
+JOG_INTERVAL = 20
+# likewise while photos on the move are due or being taken, so each is
+# taken, and its position read, close to its place
+CAPTURE_INTERVAL = 20
+# axis words of an absolute move, which a scan command has to reach before
+# it counts as done, and how close it has to get in work units
+ABSOLUTE_MOVE = re.compile(r'G90\b')
+AXIS_WORD = re.compile(r'([XYZ])\s*([-+]?[0-9]*\.?[0-9]+)')
+TARGET_TOLERANCE = 0.01
+
+def move_target(text):
+    """{axis: position} an absolute move line ends at, or None"""
+    if not text or '\n' in text.strip() or not ABSOLUTE_MOVE.match(text):
+        return None
+    return dict((a.lower(), float(v)) for a, v in AXIS_WORD.findall(text)
+            ) or None
+
+class SerialInfoThread(QtCore.QThread):
+    """ Poll the info command repeatedly, and emit its result as a signal """
+
+    # signals
+    commandSent = QtCore.pyqtSignal(Command)
+    updated = QtCore.pyqtSignal(dict)
+    responseReceived = QtCore.pyqtSignal(str)
+    realtimeSent = QtCore.pyqtSignal(str,float)
+    # bytes of the streamed file acknowledged so far, and its size
+    jobProgress = QtCore.pyqtSignal(int,int)
+    # whether the whole file was streamed without an alarm or being stopped
+    jobFinished = QtCore.pyqtSignal(bool)
+    # action command, whether its handler succeeded, and seconds it took
+    actionFinished = QtCore.pyqtSignal(Command,bool,float)
+
+    def __init__(self, parent, ser_dev, info, interval=100, executor=None):
+        super(QtCore.QThread,self).__init__(parent)
+        self.ser = ser_dev
+        self.info_cmd = bytes(info['command'],'ascii')
+        self.regex = re.compile(info['regex'])
+        self.order = info['order']
+        # GRBL status reports are decoded in full; the profile's regex is
+        # only needed for controllers that answer with something else
+        self.parser = grblstatus.StatusParser()
+        self.status = self.parser.status
+        self.interval = interval #interval to poll in ms
+        # scan commands, sent in order once the machine stops moving
+        self.tQ = queue.Queue()
+        # manual/instant commands, sent ahead of anything in tQ
+        self.iQ = queue.Queue()
+        # held only while writing, so realtime bytes never wait on a readline
+        self.lock = QtCore.QMutex()
+        self._delta = 0
+        self._last_pos = {'x':0,'y':0,'z':0}
+        # seconds taken by the most recent realtime write
+        self.last_realtime_latency = None
+        self._running = False
+        # file being streamed, see stream()
+        self._job = None
+        self._job_cancelled = False
+        # runs waypoint actions; scan commands wait on the _action future
+        self.executor = executor or actions.ActionExecutor()
+        self._action = None
+        # perf_counter() of the jog press/release still waiting to be seen
+        # in a status report, and whether a jog is under way
+        self._jog_pressed = None
+        self._jog_released = None
+        self._jogging = False
+        # checkpoint.Checkpointer recording completed scan commands, if any,
+        # and the last scan command written that isn't known to be done yet,
+        # with where it moves to
+        self.checkpoint = None
+        self._inflight = None
+        self._target = None
+        # photos still to take on the move in flight: fractions of it, and
+        # where it starts and ends
+        self._captures = collections.deque()
+        self._capture_path = None
+        # set to cut the poll interval short, e.g. when an action finishes
+        self._wake = threading.Event()
+        self._setup_metrics()
+
+    def _setup_metrics(self):
+        m = self.metrics = metrics.Metrics('touchomatic_serial',
+                {'port':getattr(self.ser,'port',None)})
+        self.m_ping = m.histogram('ping_seconds',
+                'Status query round trip, from flush to parsed reply')
+        self.m_readline = m.histogram('readline_seconds',
+                'Time spent blocked in readline()')
+        self.m_queued = m.histogram('queue_wait_seconds',
+                'Time commands spent queued before being written')
+        self.m_write = m.histogram('write_seconds',
+                'Time to write a command line, including the port lock')
+        self.m_realtime = m.histogram('realtime_write_seconds',
+                'Time to write a realtime command, including the port lock')
+        self.m_sent = m.counter('commands_sent','Command lines written')
+        self.m_acks = m.counter('acks','ok replies received')
+        self.m_errors = m.counter('errors','error and alarm replies received')
+        self.m_polls = m.counter('polls','Status queries sent')
+        self.m_poll_misses = m.counter('poll_misses',
+                'Status queries without a parsable reply')
+        self.m_action = m.histogram('action_seconds',
+                'Time taken by waypoint action handlers')
+        self.m_jog_start = m.histogram('jog_start_seconds',
+                'Time from starting a jog to the controller reporting Jog')
+        self.m_jog_stop = m.histogram('jog_stop_seconds',
+                'Time from cancelling a jog to the controller leaving Jog')
+
+    def run(self):
+        #self.setPriority(self.HighPriority)
+        self._running = True
+        while self._running:
+            if self._job is not None:
+                self._stream_job()
+                continue
+            # ping the machine's position
+            self.ping()
+            # send a command if we have one in the pipeline
+            self.send_command()
+            if self._jogging:
+                interval = JOG_INTERVAL
+            elif self._captures or self.executor.capturing():
+                interval = CAPTURE_INTERVAL
+            else:
+                interval = self.interval
+            self._wake.wait(interval/1000.)
+            self._wake.clear()
+
+    def stop(self):
+        """Finish the current poll cycle and wait for the thread to exit"""
+        self._running = False
+        self._wake.set()
+        self.wait()
+        self.executor.shutdown()
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+
+    def stream(self,job):
+        """Stream a filejob.GcodeFile (or any iterable of (offset, line)) to
+        the machine. It replaces the normal poll loop until the file is done
+        or clear() is called; queued commands wait until then. Returns
+        False, leaving the running job alone, if a file is still streaming.
+        """
+        if self._job is not None:
+            return False
+        self._job_cancelled = False
+        self._job = job
+        return True
+
+    def _stream_job(self):
+        """Send the job with GRBL's character counting flow control: keep as
+        many lines in flight as fit in the controller's receive buffer, and
+        free their space as each ok or error comes back. A line too long for
+        the buffer ends the job there, unfinished."""
+        job = self._job
+        size = getattr(job,'size',0)
+        lines = iter(job)
+        # (length, offset) of each line waiting for its reply
+        inflight = collections.deque()
+        buffered = 0
+        pending = next(lines,None)
+        offset = 0
+        alarm = False
+        partial = b''
+        last_poll = last_progress = 0
+        timeout = self.ser.timeout
+        # wake up at least once a poll interval to ask for the position
+        self.ser.timeout = self.interval/1000.
+        try:
+            while self._running and not self._job_cancelled and (
+                    pending or inflight):
+                while pending and (
+                        buffered + len(pending[1]) + 1 <= RX_BUFFER_SIZE):
+                    line_offset, text = pending
+                    self._write(bytes(text+'\n','latin-1'))
+                    self.m_sent.inc()
+                    inflight.append((len(text)+1,line_offset))
+                    buffered += len(text)+1
+                    pending = next(lines,None)
+                if pending and not inflight:
+                    # won't fit even in the empty buffer, so would never go
+                    self.responseReceived.emit('error: the line ending at '
+                            'byte {} is longer than the {} byte receive '
+                            'buffer'.format(pending[0],RX_BUFFER_SIZE - 1))
+                    break
+                now = time.perf_counter()
+                if now - last_poll >= self.interval/1000.:
+                    self._write(self.info_cmd)
+                    self.m_polls.inc()
+                    last_poll = now
+                start = time.perf_counter()
+                data = partial + self.ser.readline()
+                self.m_readline.observe(time.perf_counter() - start)
+                if not data.endswith(b'\n'):
+                    # timed out part way through a line
+                    partial = data
+                    continue
+                partial = b''
+                reply = data.strip().decode('latin-1')
+                if reply.startswith('<'):
+                    self.parse_position(reply)
+                elif reply.startswith(('ok','error')) and inflight:
+                    self._count_reply(reply)
+                    length, offset = inflight.popleft()
+                    buffered -= length
+                    if reply.startswith('error'):
+                        self.responseReceived.emit(
+                                '{} (at byte {})'.format(reply,offset))
+                elif reply.startswith('ALARM'):
+                    self._count_reply(reply)
+                    self.responseReceived.emit(reply)
+                    alarm = True
+                    break
+                elif reply:
+                    self.responseReceived.emit(reply)
+                if now - last_progress >= 0.1:
+                    self.jobProgress.emit(offset,size)
+                    last_progress = now
+        finally:
+            self.ser.timeout = timeout
+            self._job = None
+        self.jobProgress.emit(offset,size)
+        self.jobFinished.emit(not (alarm or self._job_cancelled or pending))
+
+    def send_command(self):
+        if not self.iQ.empty():
+            cmd = self.iQ.get()
+        elif self.tQ.empty() or self._delta > 1e-5 or (
+                self._action is not None and not self._action.done()):
+            return
+        else:
+            # the machine is at rest, so the last scan command has finished
+            self._settled()
+            cmd = self.tQ.get()
+        if cmd.text is None and cmd.action is not None:
+            self._start_action(cmd)
+            return
+        if cmd.scan is not None:
+            self._inflight = cmd
+            self._target = move_target(cmd.text)
+            self._captures = collections.deque(sorted(cmd.captures or ()))
+            if self._captures and self._target is not None:
+                end = dict(self._last_pos)
+                end.update(self._target)
+                self._capture_path = (dict(self._last_pos),end)
+            else:
+                self._capture_path = None
+        message = cmd.text
+        self._write(bytes(message+'\r\n','ascii'))
+        cmd.written = time.perf_counter()
+        self.m_queued.observe(cmd.written - cmd.enqueued)
+        self.m_sent.inc()
+        cmd.pos = self._last_pos
+        self.commandSent.emit(cmd)
+        if cmd.response:
+            # will block until response is recieved
+            response = self._readline()
+            cmd.replied = time.perf_counter()
+            self._count_reply(response)
+            self.responseReceived.emit(response)
+
+    def _start_action(self,cmd):
+        """Hand an action to the executor once the machine has reached its
+        waypoint. Blocking actions hold back the next scan command until the
+        handler returns; the others run alongside the following moves."""
+        cmd.written = time.perf_counter()
+        self.m_queued.observe(cmd.written - cmd.enqueued)
+        cmd.pos = self._last_pos
+        self.commandSent.emit(cmd)
+        future = self.executor.submit(cmd,self._action_done)
+        if self.executor.blocks(cmd.action):
+            self._action = future
+        else:
+            self._completed(cmd)
+
+    def _action_done(self,cmd,future):
+        ok, seconds = future.result()
+        cmd.replied = time.perf_counter()
+        if not cmd.late:
+            self.m_action.observe(seconds)
+        if ok and self.executor.blocks(cmd.action):
+            self._completed(cmd)
+        self.actionFinished.emit(cmd,ok,seconds)
+        # send the next move now rather than at the end of the poll interval
+        self._wake.set()
+
+    def _settled(self,pos=None):
+        """Count the last scan command written as done once the machine is
+        at rest where it moves to. A hold or an open door may still let it
+        finish; an alarm or a reset means it never will."""
+        if self._inflight is None:
+            return
+        state = self.status.state or ''
+        if state.startswith('Alarm'):
+            self._inflight = None
+            self._captures.clear()
+            return
+        if state.startswith(('Hold','Door')):
+            return
+        if self._target is not None:
+            pos = pos or self._last_pos
+            if any(abs(pos[a] - v) > TARGET_TOLERANCE
+                    for a, v in self._target.items()):
+                return
+        # the move is over, so whatever it passed has been reached
+        self._capture(pos or self._last_pos,arrived=True)
+        self._completed(self._inflight)
+        self._inflight = None
+
+    def _capture(self,pos,arrived=False):
+        """Take the photos on the move in flight that the machine has got
+        to, without holding it up"""
+        if arrived:
+            reached = 1.
+        elif self._capture_path is None:
+            return
+        else:
+            # how far along the move the machine is, as a fraction of it
+            start, end = self._capture_path
+            d = [end[a] - start[a] for a in 'xyz']
+            length = sum(x*x for x in d) or 1.
+            reached = sum((pos[a] - start[a])*x
+                    for a, x in zip('xyz',d))/length
+        while self._captures and self._captures[0] <= reached + 1e-6:
+            self._captures.popleft()
+            cmd = Command(None,self._inflight.sequence,
+                    action=Action.TAKE_PHOTO)
+            cmd.enqueued = cmd.written = time.perf_counter()
+            self.commandSent.emit(cmd)
+            # positioned when the photo is taken, not where it was due
+            self.executor.capture(cmd,self._position,self._action_done)
+
+    def _position(self):
+        return dict(self._last_pos)
+
+    def _completed(self,cmd):
+        if self.checkpoint is None or cmd.scan is None:
+            return
+        scan, scan_pass, index = cmd.scan
+        self.checkpoint.update({"scan":scan, "pass":scan_pass, "index":index,
+            "sequence":cmd.sequence, "time":time.time()})
+
+    def ping(self):
+        start = time.perf_counter()
+        self.lock.lock()
+        try:
+            self.ser.flushInput()
+            self.ser.flushOutput()
+            self.ser.write(self.info_cmd)
+        finally:
+            self.lock.unlock()
+        self.m_polls.inc()
+        result = self._readline()
+        if not self.parse_position(result):
+            self.m_poll_misses.inc()
+        self.m_ping.observe(time.perf_counter() - start)
+
+    def _readline(self):
+        start = time.perf_counter()
+        line = self.ser.readline()
+        self.m_readline.observe(time.perf_counter() - start)
+        return line.strip().decode('ascii')
+
+    def _count_reply(self,reply):
+        if reply.startswith('ok'):
+            self.m_acks.inc()
+        elif reply.startswith(('error','ALARM')):
+            self.m_errors.inc()
+
+    def _write(self,data):
+        start = time.perf_counter()
+        self.lock.lock()
+        try:
+            self.ser.write(data)
+        finally:
+            self.lock.unlock()
+        self.m_write.observe(time.perf_counter() - start)
+
+    def realtime(self,data):
+        """Write a realtime command (feed hold, cycle start, soft reset,
+        status query) to the port right away, bypassing both queues. `data`
+        is either a name from commands.REALTIME or the raw characters.
+        Safe to call from any thread. Returns the write latency in seconds.
+        """
+        data = REALTIME.get(data,data)
+        if isinstance(data,str):
+            data = bytes(data,'latin-1')
+        if REALTIME['reset'].encode('latin-1') in data:
+            # whatever was moving has been aborted
+            self._inflight = None
+            self._captures.clear()
+        start = time.perf_counter()
+        self.lock.lock()
+        try:
+            self.ser.write(data)
+            # make sure the next ping's flushOutput can't discard it
+            self.ser.flush()
+        finally:
+            self.lock.unlock()
+        latency = time.perf_counter() - start
+        self.m_realtime.observe(latency)
+        self.last_realtime_latency = latency
+        self.realtimeSent.emit(data.decode('latin-1'),latency)
+        return latency
+
+    def override_feed(self,step):
+        """Nudge the feed override: step is '+10', '-10', '+1', '-1' or
+        'reset'. Takes effect on the running scan straight away, without
+        touching the queued commands."""
+        return self.realtime('feed' + step if step != 'reset' else
+                'feed-reset')
+
+    def set_feed_override(self,percent):
+        """Set the feed override to percent (10-200) in one realtime write"""
+        return self.realtime(feed_override(percent))
+
+    def jog(self,line):
+        """Send a $J= jog line ahead of any scan commands. Call it again
+        before the previous jog runs out to keep the machine moving."""
+        if not self._jogging:
+            self._jogging = True
+            self._jog_pressed = time.perf_counter()
+            self._jog_released = None
+        self.enqueue(Command(line,instant=True))
+        self._wake.set()
+
+    def jog_cancel(self):
+        """Stop jogging straight away, including jogs not yet sent"""
+        with self.iQ.mutex:
+            self.iQ.queue = collections.deque(c for c in self.iQ.queue
+                    if not (c.text or '').startswith('$J='))
+        self.realtime('jog-cancel')
+        if self._jogging:
+            self._jog_released = time.perf_counter()
+            self._wake.set()
+
+    def _jog_state(self,state):
+        """Time the controller's reaction to jog presses and releases"""
+        now = time.perf_counter()
+        if self._jog_pressed is not None and state == 'Jog':
+            self.m_jog_start.observe(now - self._jog_pressed)
+            self._jog_pressed = None
+        if self._jog_released is not None and state != 'Jog':
+            self.m_jog_stop.observe(now - self._jog_released)
+            self._jog_released = self._jog_pressed = None
+            self._jogging = False
+
+    def parse_position(self,position):
+        if self.parser.parse(position) is not None:
+            if self._jogging:
+                self._jog_state(self.status.state)
+            if not self.status.positioned:
+                # state only or cut short: the last position isn't news,
+                # and mustn't make the machine look like it has stopped
+                if self._inflight is not None and (
+                        self.status.state or '').startswith('Alarm'):
+                    self._settled()
+                return
+            out = self.status.position()
+            if self._inflight is not None and (self.status.state == 'Idle'
+                    or (self.status.state or '').startswith('Alarm')):
+                self._settled(out)
+            if self._captures and self._inflight is not None:
+                self._capture(out)
+        else:
+            match = re.search(self.regex,position)
+            if not match:
+                return
+            out = {}
+            for coord in 'xyz':
+                out[coord] = float(match.groups()[self.order.index(coord)])
+        # the squared distance travelled since the last ping
+        last = self._last_pos
+        self._delta = sum((out[c] - last[c])**2 for c in 'xyz')
+        self._last_pos = out
+        self.updated.emit(out)
+        return True
+
+    def clear(self):
+        # stop feeding a streamed file; lines already sent still run
+        self._job_cancelled = True
+        # don't hold the next scan for an action that is still running, or
+        # count a dropped one as done
+        self._action = None
+        self._inflight = None
+        self._captures.clear()
+        for q in self.tQ, self.iQ:
+            with q.mutex:
+                q.queue.clear()
+
+    def queued(self):
+        """Commands waiting to be sent"""
+        return self.tQ.qsize() + self.iQ.qsize()
+
+    def busy(self):
+        """Whether a file is streaming, or scan commands are still to run"""
+        return (self._job is not None or not self.tQ.empty() or
+                self._inflight is not None or
+                (self._action is not None and not self._action.done()))
+
+    def _put(self,item):
+        item.enqueued = time.perf_counter()
+        if item.instant:
+            self.iQ.put(item)
+        else:
+            self.tQ.put(item)
+
+    def enqueue(self,items):
+        try:
+            [self._put(item) for item in items]
+        except:
+            self._put(items)
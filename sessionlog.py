@@ -0,0 +1,309 @@
+"""Record everything sent to and received from a machine, and play it back.
+
+A session log is an 8 byte magic, the wall clock start time as a double, and
+then one record per write, read or input flush. Writes of nothing but GRBL
+realtime bytes (status queries, hold, resume, reset, jog cancel, overrides)
+are recorded as their own kind, apart from command lines:
+
+    kind (u8) | microseconds since the previous record (u32) | length (u16)
+    | data
+
+Timestamps come from the monotonic clock. Writes longer than 64 KiB are
+split over several records.
+
+RecordingSerial wraps a serial port and logs its traffic; ReplaySerial is a
+serial-like transport that answers with the received side of a log, at the
+recorded pace or as fast as it is read. Run as a script to dump a log, or to
+replay it through a SerialInfoThread and print the engine's metrics:
+
+    python sessionlog.py dump session.tomlog
+    python sessionlog.py replay session.tomlog [--speed 10 | --fast]
+"""
+import os
+import sys
+import time
+import struct
+import threading
+
+MAGIC = b'TOMLOG\x00\x01'
+HEADER = struct.Struct('<d')
+RECORD = struct.Struct('<BIH')
+MAX_DATA = 0xffff
+MAX_DELTA = 0xffffffff
+
+# record kinds
+TX = 0
+RX = 1
+FLUSH = 2
+REALTIME = 3
+KINDS = {TX:'tx', RX:'rx', FLUSH:'flush', REALTIME:'rt'}
+
+# bytes GRBL picks out of the input as soon as they arrive, wherever they are
+REALTIME_BYTES = b'?!~\x18' + bytes(range(0x80, 0x100))
+
+# ControllerManager.open() replays the log named after this prefix
+REPLAY_PREFIX = 'replay:'
+
+class SessionWriter():
+    """ Appends records to a session log. Safe to use from several threads.
+
+    Every record is flushed to the OS as it is written, so a crash of the
+    app, the thing the log is there to explain, doesn't lose its tail.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC + HEADER.pack(time.time()))
+        self._lock = threading.Lock()
+        self._last = time.monotonic_ns()
+
+    def record(self, kind, data=b''):
+        with self._lock:
+            if self._file.closed:
+                return
+            now = time.monotonic_ns()
+            delta = min((now - self._last)//1000, MAX_DELTA)
+            self._last += delta*1000
+            for i in range(0, max(len(data), 1), MAX_DATA):
+                chunk = data[i:i+MAX_DATA]
+                self._file.write(RECORD.pack(kind, delta, len(chunk)))
+                self._file.write(chunk)
+                delta = 0
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+                self._file.close()
+
+def read_session(path):
+    """The log's start time, and a list of (seconds since start, kind, data)
+    records"""
+    records = []
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a session log".format(path))
+        start, = HEADER.unpack(f.read(HEADER.size))
+        t = 0
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                break
+            kind, delta, length = RECORD.unpack(head)
+            t += delta
+            records.append((t/1e6, kind, f.read(length)))
+    return start, records
+
+class RecordingSerial():
+    """ Serial port wrapper that logs every byte written and read.
+
+    Anything it doesn't intercept is passed through to the wrapped port.
+    """
+    def __init__(self, ser, path):
+        self.ser = ser
+        self.log = SessionWriter(path)
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    @property
+    def timeout(self):
+        return self.ser.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.ser.timeout = value
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = bytes(data, 'latin-1')
+        self.log.record(REALTIME if is_realtime(data) else TX, data)
+        return self.ser.write(data)
+
+    def readline(self):
+        data = self.ser.readline()
+        self.log.record(RX, data)
+        return data
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        if data:
+            self.log.record(RX, data)
+        return data
+
+    def reset_input_buffer(self):
+        self.log.record(FLUSH)
+        self.ser.reset_input_buffer()
+
+    flushInput = reset_input_buffer
+
+    def close(self):
+        self.ser.close()
+        self.log.close()
+
+def is_realtime(data):
+    """Whether data is nothing but realtime bytes"""
+    return bool(data) and not data.translate(None, REALTIME_BYTES)
+
+def _lines(data):
+    text = data.translate(None, REALTIME_BYTES).decode('latin-1')
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+class ReplaySerial():
+    """ Serial-like transport that plays back the received side of a log.
+
+    Each read returns the next received record, held back until its
+    recorded time divided by speed has passed since the port was opened;
+    with speed=None, straight away. Writes are checked against the recorded
+    command lines and otherwise dropped; `divergences` counts the lines that
+    differ. Realtime bytes such as status queries aren't checked, since
+    when they are sent is up to the poll loop.
+    """
+    def __init__(self, path, speed=1.0, timeout=None):
+        self.port = path
+        self.speed = speed
+        self.timeout = timeout
+        self.is_open = True
+        self.start_time, records = read_session(path)
+        self._rx = [(t, data) for t, kind, data in records if kind == RX]
+        self._next = 0
+        self._sent = b''.join(data for t, kind, data in records if kind == TX)
+        self._expected = self.commands()
+        self._checked = 0
+        self.divergences = 0
+        self._opened = time.monotonic()
+
+    @property
+    def finished(self):
+        """Whether every received record has been read back"""
+        return self._next >= len(self._rx)
+
+    def commands(self):
+        """The command lines written in the session, without the realtime
+        bytes, for feeding back through SerialInfoThread.enqueue()"""
+        return _lines(self._sent)
+
+    def _due(self):
+        """Seconds until the next received record is due"""
+        if self.speed is None:
+            return 0
+        t = self._rx[self._next][0]
+        return self._opened + t/self.speed - time.monotonic()
+
+    def _take(self):
+        if self.finished:
+            # the session is over: behave like a port that has gone quiet
+            time.sleep(0.05 if self.timeout is None else self.timeout)
+            return b''
+        wait = self._due()
+        if self.timeout is not None and wait > self.timeout:
+            time.sleep(self.timeout)
+            return b''
+        if wait > 0:
+            time.sleep(wait)
+        data = self._rx[self._next][1]
+        self._next += 1
+        return data
+
+    def readline(self):
+        return self._take()
+
+    def read(self, size=1):
+        return self._take()
+
+    @property
+    def in_waiting(self):
+        if self.finished or self._due() > 0:
+            return 0
+        return len(self._rx[self._next][1])
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = bytes(data, 'latin-1')
+        for line in _lines(data):
+            expected = self._expected[self._checked:self._checked+1]
+            if [line] != expected:
+                self.divergences += 1
+            self._checked += 1
+        return len(data)
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+    flushInput = reset_input_buffer
+    flushOutput = reset_output_buffer
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+def session_path(directory, port):
+    """A new log file name for port in directory"""
+    name = os.path.basename(port).replace(os.sep, '_') or 'port'
+    return os.path.join(directory, '{}-{}.tomlog'.format(name,
+        time.strftime('%Y%m%d-%H%M%S')))
+
+def dump(path, out=sys.stdout):
+    start, records = read_session(path)
+    out.write('session started {}\n'.format(time.strftime(
+        '%Y-%m-%d %H:%M:%S', time.localtime(start))))
+    for t, kind, data in records:
+        out.write('{:12.6f} {:5s} {!r}\n'.format(t, KINDS.get(kind, kind),
+            data))
+
+# what replay() polls with: GRBL status reports are decoded without it, but
+# SerialInfoThread still wants a profile style info section
+INFO = {
+    'command':'?',
+    'regex':r'WPos:(-?[0-9]+\.?[0-9]*),(-?[0-9]+\.?[0-9]*),(-?[0-9]+\.?[0-9]*)',
+    'order':'xyz',
+}
+
+def replay(path, speed=1.0, interval=100):
+    """Run a SerialInfoThread over a replayed session, resending its
+    commands, and return the thread once the log runs out"""
+    from serialinfo import SerialInfoThread
+    from commands import Command
+    ser = ReplaySerial(path, speed)
+    thread = SerialInfoThread(None, ser, INFO, interval)
+    thread.start()
+    thread.enqueue([Command(line) for line in ser.commands()])
+    while not ser.finished:
+        time.sleep(0.05)
+    thread.stop()
+    return thread
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('action', choices=['dump', 'replay'])
+    parser.add_argument('log')
+    parser.add_argument('--speed', type=float, default=1.0,
+            help='replay this many times faster than recorded')
+    parser.add_argument('--fast', action='store_true',
+            help='replay as fast as the engine reads')
+    parser.add_argument('--interval', type=int, default=100,
+            help='poll interval to replay with, in ms; no longer than the '
+            'recorded one, or reading falls behind the log')
+    args = parser.parse_args()
+    if args.action == 'dump':
+        dump(args.log)
+        return
+    from PyQt5 import QtCore
+    app = QtCore.QCoreApplication([])
+    start = time.perf_counter()
+    thread = replay(args.log, None if args.fast else args.speed,
+            args.interval)
+    print('replayed in {:.2f} s, {} command lines differed from the log'.format(
+        time.perf_counter() - start, thread.ser.divergences))
+    print('\n'.join(thread.metrics.summary()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+from collections import defaultdict
+
+class GridIndex():
+    """ Uniform grid over point positions, for picking and box selection.
+
+    Items are bucketed by the cell their position falls in, so a lookup only
+    looks at the few cells around it instead of every item in the scene.
+    """
+    def __init__(self, cell=50):
+        self.cell = cell
+        self._cells = defaultdict(set)
+        # item -> (x, y, cell key)
+        self._where = {}
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, item):
+        return item in self._where
+
+    def _key(self, x, y):
+        return (int(x//self.cell), int(y//self.cell))
+
+    def resize(self, cell):
+        """Change the cell size and rebucket everything"""
+        items = [(item, x, y) for item, (x, y, _) in self._where.items()]
+        self.cell = cell
+        self.clear()
+        for item, x, y in items:
+            self.insert(item, x, y)
+
+    def clear(self):
+        self._cells.clear()
+        self._where.clear()
+
+    def insert(self, item, x, y):
+        key = self._key(x, y)
+        self._cells[key].add(item)
+        self._where[item] = (x, y, key)
+
+    def remove(self, item):
+        x, y, key = self._where.pop(item)
+        cell = self._cells[key]
+        cell.discard(item)
+        if not cell:
+            del self._cells[key]
+
+    def move(self, item, x, y):
+        """Update item's position, inserting it if it isn't indexed yet"""
+        where = self._where.get(item)
+        key = self._key(x, y)
+        if where is not None and where[2] != key:
+            self.remove(item)
+            self._cells[key].add(item)
+        elif where is None:
+            self._cells[key].add(item)
+        self._where[item] = (x, y, key)
+
+    def _keys(self, x0, y0, x1, y1):
+        """Occupied cell keys that overlap the rectangle"""
+        i0, j0 = self._key(x0, y0)
+        i1, j1 = self._key(x1, y1)
+        if (i1 - i0 + 1)*(j1 - j0 + 1) > len(self._cells):
+            # cheaper to check the occupied cells than the whole range
+            return [k for k in self._cells
+                    if i0 <= k[0] <= i1 and j0 <= k[1] <= j1]
+        return [(i, j) for i in range(i0, i1+1) for j in range(j0, j1+1)
+                if (i, j) in self._cells]
+
+    def query(self, x0, y0, x1, y1):
+        """Every item with a position inside the rectangle"""
+        x0, x1 = sorted((x0, x1))
+        y0, y1 = sorted((y0, y1))
+        where = self._where
+        for key in self._keys(x0, y0, x1, y1):
+            for item in self._cells[key]:
+                x, y, _ = where[item]
+                if x0 <= x <= x1 and y0 <= y <= y1:
+                    yield item
+
+    def nearest(self, x, y, radius):
+        """The item closest to (x, y), if there is one within radius"""
+        best, best_d = None, radius*radius
+        for item in self.query(x - radius, y - radius, x + radius, y + radius):
+            ix, iy, _ = self._where[item]
+            d = (ix - x)**2 + (iy - y)**2
+            if d <= best_d:
+                best, best_d = item, d
+        return best